@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the checkout hot paths.
+
+Each case is run against the PayPal simulator (paypal.simulator) and an
+in-memory test database, and reports its p50/p99 latency, peak memory
+allocated during a call and the number of database queries.  Results are
+compared with a stored baseline and the run fails if any case has regressed::
+
+    python benchmarks/run.py
+    python benchmarks/run.py --filter set_txn
+    python benchmarks/run.py --save-baseline
+
+Latency depends on the machine, so regenerate the baseline when moving the
+benchmarks to a new one.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from decimal import Decimal as D
+
+import django
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# How much worse than the baseline a result can be before it counts as a
+# regression.  Query counts must not increase at all.
+LATENCY_TOLERANCE = 0.5
+ALLOCATION_TOLERANCE = 0.2
+
+WARMUP = 3
+
+DESCRIPTION = '<p>%s</p>' % ' '.join(['<b>Lorem</b> ipsum dolor sit amet, consectetur adipiscing elit.'] * 40)
+
+
+def setup_django():
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+
+class Cases:
+    """
+    The benchmark cases.  Each method returns a (setup, run) pair: ``setup``
+    prepares the argument for ``run`` outside the timed section.
+    """
+
+    def __init__(self):
+        from django.test import Client
+        from oscar.core.loading import get_class, get_model
+
+        from paypal.express_checkout.gateway import PaymentProcessor
+
+        self.Basket = get_model('basket', 'Basket')
+        self.Selector = get_class('partner.strategy', 'Selector')
+        get_model('address', 'Country').objects.get_or_create(
+            iso_3166_1_a2='GB', defaults={'name': 'United Kingdom', 'is_shipping_country': True})
+
+        self.baskets = {size: self.create_basket(size) for size in (1, 50, 500)}
+        # Products with long HTML descriptions, as in a real catalogue
+        self.baskets['50,described'] = self.create_basket(50, description=DESCRIPTION)
+        self.client = Client()
+        self.processor = PaymentProcessor()
+
+    def create_basket(self, num_lines, description=''):
+        from oscar.test.factories import create_product
+
+        basket = self.Basket.objects.create()
+        basket.strategy = self.Selector().strategy()
+        for _ in range(num_lines):
+            product = create_product(price=D('9.99'), num_in_stock=100)
+            if description:
+                product.description = description
+                product.save()
+            basket.add_product(product)
+        return basket.id
+
+    def load_basket(self, size):
+        # Load the basket afresh for each call, as a view would
+        basket = self.Basket.objects.get(id=self.baskets[size])
+        basket.strategy = self.Selector().strategy()
+        return basket
+
+    def all(self):
+        return [
+            ('set_txn[1]', 200) + self.set_txn(1),
+            ('set_txn[50]', 50) + self.set_txn(50),
+            ('set_txn[500]', 10) + self.set_txn(500),
+            ('set_txn_payload[50]', 200) + self.set_txn_payload(50),
+            ('set_txn_payload[500]', 50) + self.set_txn_payload(500),
+            ('set_txn_payload[50,described]', 200) + self.set_txn_payload('50,described'),
+            ('fetch_response', 200) + self.fetch_response(),
+            ('fetch_response[write_behind]', 200) + self.fetch_response(write_behind=True),
+            ('build_order_create_request_body[1]', 200) + self.build_order_create_request_body(1),
+            ('build_order_create_request_body[50]', 50) + self.build_order_create_request_body(50),
+            ('build_order_create_request_body[500]', 10) + self.build_order_create_request_body(500),
+            ('build_order_create_request_body[50,described]', 50) + self.build_order_create_request_body(
+                '50,described'),
+            ('shipping_options[1]', 100) + self.shipping_options(1),
+            ('shipping_options[50]', 50) + self.shipping_options(50),
+            ('shipping_options[50,uncached]', 50) + self.shipping_options(50, cached=False),
+            ('payflow_transaction', 200) + self.payflow_transaction(),
+            ('create_order', 200) + self.create_order(),
+        ]
+
+    def set_txn(self, size):
+        from oscar.apps.shipping.methods import Free
+
+        from paypal.express import gateway
+
+        def run(basket):
+            gateway.set_txn(basket, [Free()], 'GBP', 'http://localhost/success', 'http://localhost/cancel')
+        return lambda: self.load_basket(size), run
+
+    def set_txn_payload(self, size):
+        from oscar.apps.shipping.methods import Free
+
+        from paypal.express import gateway
+
+        def setup():
+            basket = self.load_basket(size)
+            # Fetch the lines, prices and product classes up front, to time
+            # building the payload on its own
+            for line in basket.all_lines():
+                line.unit_price_incl_tax, line.product.is_shipping_required
+            return basket
+
+        def run(basket):
+            params = gateway._get_set_txn_params(
+                basket, [Free()], 'GBP', 'http://localhost/success', 'http://localhost/cancel')
+            params.encode()
+        return setup, run
+
+    def fetch_response(self, write_behind=False):
+        from django.test.utils import override_settings
+        from oscar.apps.shipping.methods import Free
+
+        from paypal.express import gateway
+
+        url = gateway.set_txn(self.load_basket(1), [Free()], 'GBP', 'http://localhost/success',
+                              'http://localhost/cancel')
+        token = url.split('token=')[1]
+
+        def run(arg):
+            gateway._fetch_response(gateway.GET_EXPRESS_CHECKOUT, {'TOKEN': token})
+
+        def run_write_behind(arg):
+            with override_settings(PAYPAL_AUDIT_WRITE_BEHIND=True):
+                run(arg)
+        return None, run_write_behind if write_behind else run
+
+    def build_order_create_request_body(self, size):
+        def run(basket):
+            self.processor.build_order_create_request_body(
+                basket, 'GBP', 'http://localhost/success', 'http://localhost/cancel',
+                order_total=basket.total_incl_tax)
+        return lambda: self.load_basket(size), run
+
+    def shipping_options(self, size, cached=True):
+        from django.core.cache import caches
+        from django.urls import reverse
+
+        url = reverse('paypal-shipping-options', kwargs={'basket_id': self.baskets[size], 'country_code': 'GB'})
+        data = {'SHIPTOCOUNTRY': 'GB', 'SHIPTOSTREET': '1 Main Terrace', 'SHIPTOCITY': 'Wolverhampton',
+                'SHIPTOZIP': 'W12 4LQ', 'CURRENCYCODE': 'GBP'}
+
+        def setup():
+            if not cached:
+                caches['default'].clear()
+
+        def run(arg):
+            response = self.client.post(url, data)
+            assert response.status_code == 200, response.status_code
+        return setup, run
+
+    def payflow_transaction(self):
+        from paypal.payflow import gateway
+
+        def run(arg):
+            gateway.sale('100001', '4111111111111111', '123', '1230', D('10.00'))
+        return None, run
+
+    def create_order(self):
+        def run(basket):
+            self.processor.create_order(
+                basket, 'GBP', 'http://localhost/success', 'http://localhost/cancel',
+                order_total=basket.total_incl_tax, intent='CAPTURE')
+        return lambda: self.load_basket(1), run
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[index]
+
+
+class QueryCounter:
+    """
+    Count the queries run, including those made while handling a request
+    through the test client (which resets ``connection.queries``).
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def measure(setup, run, iterations):
+    from django.db import connection
+
+    def call():
+        run(setup() if setup else None)
+
+    for _ in range(WARMUP):
+        call()
+
+    timings = []
+    for _ in range(iterations):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        run(arg)
+        timings.append((time.perf_counter() - start) * 1000.0)
+
+    arg = setup() if setup else None
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        run(arg)
+
+    arg = setup() if setup else None
+    tracemalloc.start()
+    try:
+        run(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'alloc_peak_kib': round(peak / 1024.0, 1),
+        'queries': queries.count,
+    }
+
+
+def find_regressions(name, result, baseline):
+    expected = baseline.get(name)
+    if expected is None:
+        return []
+    regressions = []
+    if result['queries'] > expected['queries']:
+        regressions.append('queries %d > %d' % (result['queries'], expected['queries']))
+    if result['alloc_peak_kib'] > expected['alloc_peak_kib'] * (1 + ALLOCATION_TOLERANCE):
+        regressions.append('alloc_peak_kib %.1f > %.1f' % (result['alloc_peak_kib'], expected['alloc_peak_kib']))
+    if result['p50_ms'] > expected['p50_ms'] * (1 + LATENCY_TOLERANCE):
+        regressions.append('p50_ms %.3f > %.3f' % (result['p50_ms'], expected['p50_ms']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--filter', help="Only run cases whose name contains this")
+    parser.add_argument('--baseline', default=BASELINE, help="Baseline file to compare with")
+    parser.add_argument('--save-baseline', action='store_true', help="Store the results as the new baseline")
+    parser.add_argument('--scale', type=float, default=1.0, help="Multiply the number of iterations by this")
+    args = parser.parse_args(argv)
+
+    setup_django()
+
+    from django.test.utils import override_settings
+
+    from paypal.simulator import Simulator, make_server
+
+    server = make_server('127.0.0.1', 0, Simulator(seed=1))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://%s:%d' % server.server_address[:2]
+    override_settings(
+        PAYPAL_NVP_URL=url + '/nvp', PAYPAL_PAYFLOW_URL=url + '/payflow', PAYPAL_REST_API_URL=url).enable()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    failed = False
+    print('%-46s %10s %10s %12s %8s' % ('case', 'p50 ms', 'p99 ms', 'alloc KiB', 'queries'))
+    for name, iterations, setup, run in Cases().all():
+        if args.filter and args.filter not in name:
+            continue
+        result = measure(setup, run, max(int(iterations * args.scale), 1))
+        results[name] = result
+        regressions = [] if args.save_baseline else find_regressions(name, result, baseline)
+        failed = failed or bool(regressions)
+        print('%-46s %10.3f %10.3f %12.1f %8d  %s' % (
+            name, result['p50_ms'], result['p99_ms'], result['alloc_peak_kib'], result['queries'],
+            'REGRESSION: ' + ', '.join(regressions) if regressions else ''))
+
+    server.shutdown()
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Saved baseline to %s' % args.baseline)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
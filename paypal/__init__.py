@@ -1 +1,4 @@
 VERSION = '2.0.0'
+
+# Django 3.2 and later find the app config by themselves
+default_app_config = 'paypal.apps.PayPalConfig'
@@ -1,2 +1,3 @@
+from paypal.batch.admin import *  # noqa F403
 from paypal.express.admin import *  # noqa F403
 from paypal.payflow.admin import *  # noqa F403
@@ -0,0 +1,21 @@
+from django.apps import AppConfig
+from django.utils.translation import gettext_lazy as _
+
+
+class PayPalConfig(AppConfig):
+    name = 'paypal'
+    verbose_name = _('PayPal')
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+        from oscar.core.loading import get_model
+
+        from . import cache, conf
+
+        # Check the PAYPAL_* settings now, rather than on the first payment
+        conf.get_config()
+
+        for model in (get_model('address', 'Country'), get_model('payment', 'SourceType')):
+            post_save.connect(cache.clear_lookups, sender=model, dispatch_uid='paypal_clear_lookups')
+            post_delete.connect(cache.clear_lookups, sender=model, dispatch_uid='paypal_clear_lookups')
@@ -0,0 +1,164 @@
+"""
+Saving of the transaction models which record each call to PayPal.
+
+By default each transaction is saved as soon as the call returns.  With
+``PAYPAL_AUDIT_WRITE_BEHIND`` enabled, transactions are instead buffered and
+written in batches by a background thread, which takes a database round-trip
+off every PayPal call.  The transaction returned to the caller has all its
+fields set; only its primary key is missing until it has been written.
+
+Calls which move money (eg captures and refunds) are always saved straight
+away, as they are looked up again to find the payment to act on and to make
+sure it isn't captured or refunded twice.  Transactions which can't be
+written are kept in the buffer and written with the next batch, until they
+have failed ``PAYPAL_AUDIT_MAX_ATTEMPTS`` times, when they are logged and
+dropped.
+"""
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from paypal import gateway
+
+logger = logging.getLogger('paypal.audit')
+
+_buffer = []
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_wakeup = threading.Event()
+_writer = None
+
+_write_through = ContextVar('paypal_audit_write_through', default=False)
+
+
+def is_write_behind():
+    return getattr(settings, 'PAYPAL_AUDIT_WRITE_BEHIND', False) and not _write_through.get()
+
+
+@contextmanager
+def write_through():
+    """
+    Save transactions straight away within the block, eg where the caller
+    needs the primary key of the new transaction.
+    """
+    token = _write_through.set(True)
+    try:
+        yield
+    finally:
+        _write_through.reset(token)
+
+
+def save(txn, write_through=False):
+    """
+    Save a transaction model, now or in the background.
+
+    :write_through: Save it now even if writing behind, eg as it records a
+                    call that moved money
+    """
+    if write_through or not is_write_behind():
+        txn.save()
+        return
+    txn.prepare_to_save()
+    with _lock:
+        _buffer.append(txn)
+        size = len(_buffer)
+    _ensure_writer()
+    if size >= getattr(settings, 'PAYPAL_AUDIT_BATCH_SIZE', 100):
+        _wakeup.set()
+
+
+async def asave(txn, write_through=False):
+    """
+    Asynchronous version of `save`
+    """
+    if not write_through and is_write_behind():
+        save(txn)
+    else:
+        await gateway.run_sync(txn.save)
+
+
+def flush():
+    """
+    Write all buffered transactions to the database.
+    """
+    global _buffer
+    with _flush_lock:
+        with _lock:
+            pending, _buffer = _buffer, []
+        if not pending:
+            return
+
+        batch_size = getattr(settings, 'PAYPAL_AUDIT_BATCH_SIZE', 100)
+        by_model = {}
+        for txn in pending:
+            by_model.setdefault(type(txn), []).append(txn)
+        failed = []
+        for model, txns in by_model.items():
+            try:
+                model.objects.bulk_create(txns, batch_size=batch_size)
+            except Exception:
+                logger.exception("Unable to save %d %s records, saving them one at a time", len(txns),
+                                 model.__name__)
+                failed.extend(_save_each(txns))
+        if failed:
+            # Keep them for the next flush, ahead of newer transactions
+            with _lock:
+                _buffer[:0] = failed
+
+
+def _save_each(txns):
+    """
+    Save each transaction on its own, so that one bad record doesn't lose the
+    rest of a batch.  Return the transactions which couldn't be saved and
+    should be tried again.
+    """
+    max_attempts = getattr(settings, 'PAYPAL_AUDIT_MAX_ATTEMPTS', 3)
+    failed = []
+    for txn in txns:
+        # The failed batch was rolled back, so any primary keys it set are
+        # gone
+        txn.pk = None
+        try:
+            txn.save(force_insert=True)
+        except Exception:
+            txn.pk = None
+            txn._audit_attempts = getattr(txn, '_audit_attempts', 0) + 1
+            if txn._audit_attempts < max_attempts:
+                failed.append(txn)
+            else:
+                # Log the record so that it can still be recovered
+                logger.exception("Unable to save %s record after %d attempts, dropping it: "
+                                 "raw_request=%r raw_response=%r", type(txn).__name__, txn._audit_attempts,
+                                 txn.raw_request, txn.raw_response)
+    if failed:
+        logger.error("Unable to save %d %s records, they will be saved with the next batch",
+                     len(failed), type(failed[0]).__name__)
+    return failed
+
+
+def _ensure_writer():
+    global _writer
+    if _writer is not None and _writer.is_alive():
+        return
+    with _lock:
+        # The writer thread doesn't survive forking, so check it is alive
+        # rather than just started.
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_run_writer, name='paypal-audit-writer', daemon=True)
+            _writer.start()
+
+
+def _run_writer():
+    while True:
+        _wakeup.wait(getattr(settings, 'PAYPAL_AUDIT_FLUSH_INTERVAL', 1.0))
+        _wakeup.clear()
+        close_old_connections()
+        flush()
+
+
+atexit.register(flush)
@@ -1,8 +1,11 @@
 from urllib.parse import parse_qsl
 
+from django.conf import settings
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
+from paypal.fields import ResponseDataField
+
 
 class ResponseModel(models.Model):
 
@@ -10,6 +13,9 @@ class ResponseModel(models.Model):
     raw_request = models.TextField(max_length=512)
     raw_response = models.TextField(max_length=512)
 
+    # The parsed response, as a dict of key-value pairs
+    response_data = ResponseDataField(null=True, blank=True, editable=False)
+
     response_time = models.FloatField(help_text=_("Response time in milliseconds"))
 
     date_created = models.DateTimeField(auto_now_add=True)
@@ -19,6 +25,28 @@ class ResponseModel(models.Model):
         ordering = ('-date_created',)
         app_label = 'paypal'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Use the stored response data rather than parsing the raw response
+        data = instance.__dict__.get('response_data')
+        if data is not None and 'raw_response' in instance.__dict__:
+            instance._context_cache = (
+                instance.raw_response, {key: [val] for key, val in data.items()})
+        return instance
+
+    def save(self, *args, **kwargs):
+        self.prepare_to_save()
+        return super().save(*args, **kwargs)
+
+    def prepare_to_save(self):
+        """
+        Prepare the fields for storage.  This is called by `save` and before
+        transactions are written in bulk, which bypasses `save`.
+        """
+        if getattr(settings, 'PAYPAL_STORE_RESPONSE_DATA', True):
+            self.response_data = {key: val[0] for key, val in self.context.items()}
+
     def request(self):
         request_params = self.context
         return self._as_dl(request_params)
@@ -42,11 +70,28 @@ class ResponseModel(models.Model):
 
     @property
     def context(self):
-        ctx = {}
-        for key, val in parse_qsl(self.raw_response):
-            ctx[key] = [val]
-        return ctx
+        """
+        The response parameters, as a dict of lists.
+
+        The response is only parsed again when ``raw_response`` changes, so
+        the same dict is returned each time and shouldn't be modified.
+        """
+        raw_response = self.raw_response
+        cached = self.__dict__.get('_context_cache')
+        if cached is None or cached[0] is not raw_response:
+            ctx = {}
+            for key, val in parse_qsl(raw_response):
+                ctx[key] = [val]
+            cached = self._context_cache = (raw_response, ctx)
+        return cached[1]
 
     def value(self, key, default=None):
         ctx = self.context
         return ctx[key][0] if key in ctx else default
+
+    def values(self, *keys, default=None):
+        """
+        Return a tuple with the value of each key, in the order given.
+        """
+        ctx = self.context
+        return tuple(ctx[key][0] if key in ctx else default for key in keys)
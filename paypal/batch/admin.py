@@ -0,0 +1,24 @@
+from django.contrib import admin
+
+from paypal import models
+
+
+class BatchResultAdmin(admin.ModelAdmin):
+    list_display = ['batch_id', 'action', 'integration', 'order_number', 'status',
+                    'transaction_id', 'error_message', 'date_created']
+    list_filter = ['action', 'integration', 'status']
+    search_fields = ['batch_id', 'order_number']
+    readonly_fields = [
+        'batch_id',
+        'action',
+        'integration',
+        'order_number',
+        'reference',
+        'transaction_id',
+        'status',
+        'error_message',
+        'response_time',
+        'date_created']
+
+
+admin.site.register(models.BatchResult, BatchResultAdmin)
@@ -0,0 +1,370 @@
+"""
+Capturing, refunding and voiding of payments in bulk, eg for the orders
+dispatched in a day or the orders of a recalled product.
+
+The orders are handled concurrently by a bounded pool of threads, at no more
+than a given number of calls a second, and the outcome for each order is
+recorded as a `BatchResult`.  Results are written in chunks, which are also
+the checkpoints of a batch.  An order is skipped if its payment has already
+been handled by this or an earlier batch, or outside of a batch, so a batch
+can be resumed or run again without eg refunding a payment twice.
+
+Each chunk of orders is recorded as pending before the calls for it are made,
+and an order whose call failed without a response is recorded as unknown, as
+PayPal may have carried it out.  Such orders aren't sent again unless the
+batch is run with ``retry_unknown``, once they have been checked at PayPal.
+"""
+import csv
+import logging
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections, transaction
+from django.db.models import QuerySet
+from oscar.core.loading import get_model
+from paypalhttp.http_error import HttpError
+
+from paypal import audit, conf, exceptions
+from paypal.batch.models import BatchResult
+from paypal.express import facade as express_facade
+from paypal.express.gateway import DO_CAPTURE, DO_EXPRESS_CHECKOUT, DO_VOID, REFUND_TRANSACTION
+from paypal.express.models import ExpressTransaction
+from paypal.express_checkout import facade as express_checkout_facade
+from paypal.express_checkout.models import ExpressCheckoutTransaction
+from paypal.payflow import codes
+from paypal.payflow import facade as payflow_facade
+from paypal.payflow.models import PayflowTransaction
+
+logger = logging.getLogger('paypal.batch')
+
+Source = get_model('payment', 'Source')
+
+# Fields of the report written by `write_report`
+REPORT_FIELDS = ('order_number', 'action', 'integration', 'status', 'reference', 'transaction_id',
+                 'error_message', 'date_created')
+
+
+class RateLimiter:
+    """
+    Spaces out calls from any number of threads so that no more than
+    ``rate`` are made a second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(self._next, now) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def new_batch_id():
+    return time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8]
+
+
+def capture(orders, integration, **kwargs):
+    """
+    Capture the authorized payments of ``orders``.
+
+    See `run` for the arguments.
+    """
+    return run(BatchResult.CAPTURE, orders, integration, **kwargs)
+
+
+def refund(orders, integration, **kwargs):
+    """
+    Refund the payments of ``orders`` in full.
+
+    See `run` for the arguments.
+    """
+    return run(BatchResult.REFUND, orders, integration, **kwargs)
+
+
+def void(orders, integration, **kwargs):
+    """
+    Void the authorized payments of ``orders``.
+
+    See `run` for the arguments.
+    """
+    return run(BatchResult.VOID, orders, integration, **kwargs)
+
+
+def run(action, orders, integration, batch_id=None, workers=None, rate=None, chunk_size=500,
+        retry_unknown=False):
+    """
+    Carry out ``action`` on the payments of ``orders``, and return a dict
+    with the ``batch_id`` and the number of orders that ``succeeded``,
+    ``failed``, whose outcome is ``unknown`` or that were ``skipped`` as they
+    had already been handled.
+
+    :orders: A queryset of orders, or an iterable of order numbers
+    :integration: The integration the orders were paid with - one of
+                  ``BatchResult.EXPRESS``, ``EXPRESS_CHECKOUT`` or ``PAYFLOW``
+    :batch_id: ID of the batch to resume.  A new batch is started if not
+               given.
+    :workers: Number of calls to PayPal to make at once.  Defaults to
+              ``PAYPAL_BATCH_WORKERS``.
+    :rate: Maximum number of calls to PayPal a second.  Defaults to
+           ``PAYPAL_BATCH_RATE``.
+    :chunk_size: Number of orders to handle between writing the results
+    :retry_unknown: Whether to send orders whose outcome is unknown (see
+                    above) again, rather than leaving them to be checked
+    """
+    func = _ACTIONS.get((action, integration))
+    if func is None:
+        raise ValueError("Unable to %s %s payments" % (action, integration))
+    config = conf.get_config()
+    workers = workers or config.batch_workers
+    rate = rate or config.batch_rate
+    if batch_id is None:
+        batch_id = new_batch_id()
+    limiter = RateLimiter(rate) if rate else None
+    counts = Counter(succeeded=0, failed=0, unknown=0, skipped=0)
+    seen = set()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='paypal-batch') as executor:
+        for chunk in _get_chunks(_get_order_numbers(orders), chunk_size):
+            # An order which is listed twice is only handled once
+            order_numbers = [number for number in dict.fromkeys(chunk) if number not in seen]
+            seen.update(order_numbers)
+            # Make sure the lookups see every transaction recorded so far
+            audit.flush()
+            references = _get_references(action, integration, order_numbers)
+            done = _get_handled(action, integration, order_numbers, references)
+            counts['skipped'] += len(chunk) - len(order_numbers) + len(done)
+            order_numbers = [number for number in order_numbers if number not in done]
+            if not retry_unknown:
+                in_doubt = _get_in_doubt(action, order_numbers)
+                if in_doubt:
+                    logger.warning("Batch %s - %s: the outcome for orders %s is unknown, so they need "
+                                   "checking at PayPal", batch_id, action, ', '.join(sorted(in_doubt)))
+                counts['unknown'] += len(in_doubt)
+                order_numbers = [number for number in order_numbers if number not in in_doubt]
+            if not order_numbers:
+                continue
+
+            BatchResult.objects.bulk_create([
+                BatchResult(batch_id=batch_id, action=action, integration=integration, order_number=number,
+                            reference=references.get(number), status=BatchResult.PENDING)
+                for number in order_numbers])
+            results = list(executor.map(
+                lambda number: _run_one(func, number, references.get(number), limiter),
+                order_numbers))
+            for result in results:
+                result.batch_id = batch_id
+                result.action = action
+                result.integration = integration
+                counts[result.status] += 1
+            with transaction.atomic():
+                BatchResult.objects.filter(
+                    batch_id=batch_id, action=action, order_number__in=order_numbers, status=BatchResult.PENDING,
+                ).delete()
+                BatchResult.objects.bulk_create(results)
+            logger.info("Batch %s - %s: %d succeeded, %d failed, %d unknown, %d skipped so far",
+                        batch_id, action, counts['succeeded'], counts['failed'], counts['unknown'],
+                        counts['skipped'])
+
+    return dict(counts, batch_id=batch_id)
+
+
+def write_report(batch_id, f):
+    """
+    Write the results of a batch to the file ``f`` as CSV, one row for each
+    order with its latest result.
+    """
+    writer = csv.writer(f)
+    writer.writerow(REPORT_FIELDS)
+    rows = BatchResult.objects.filter(batch_id=batch_id).order_by('order_number', 'pk').values_list(
+        *REPORT_FIELDS)
+    latest = {}
+    for row in rows.iterator():
+        latest[row[0]] = row
+    for row in latest.values():
+        writer.writerow(row)
+
+
+def _run_one(func, order_number, reference, limiter):
+    result = BatchResult(order_number=order_number, reference=reference)
+    if reference is None:
+        result.status = BatchResult.FAILED
+        result.error_message = "No PayPal payment found"
+        return result
+
+    if limiter is not None:
+        limiter.wait()
+    started = time.monotonic()
+    try:
+        result.transaction_id = func(order_number, reference)
+        result.status = BatchResult.SUCCEEDED
+    except Exception as e:
+        logger.warning("Order %s - unable to process payment %s: %s", order_number, reference, e)
+        result.status = BatchResult.UNKNOWN if _is_ambiguous(e) else BatchResult.FAILED
+        result.error_message = str(e)[:512]
+    finally:
+        close_old_connections()
+    result.response_time = (time.monotonic() - started) * 1000
+    return result
+
+
+def _is_ambiguous(error):
+    # A call which failed without a response (eg on a timeout) may still
+    # have been carried out by PayPal.  Calls which weren't made, as the
+    # circuit was open or the deadline had passed, have plainly failed.
+    if isinstance(error.__cause__, exceptions.PayPalError):
+        error = error.__cause__
+    if isinstance(error, (exceptions.CircuitOpen, exceptions.DeadlineExceeded)):
+        return False
+    return isinstance(error, (exceptions.CommunicationError, HttpError)) and error.status_code is None
+
+
+def _get_order_numbers(orders):
+    if isinstance(orders, QuerySet):
+        return orders.values_list('number', flat=True).iterator()
+    return (number.strip() for number in orders if number.strip())
+
+
+def _get_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _get_references(action, integration, order_numbers):
+    """
+    Return a dict of the PayPal reference (a token or PNREF) of the payment
+    of each order.
+    """
+    if integration == BatchResult.PAYFLOW:
+        # Refunds are made against the sale or authorization, captures and
+        # voids against the authorization
+        trxtypes = (codes.AUTHORIZATION, codes.SALE) if action == BatchResult.REFUND else (codes.AUTHORIZATION,)
+        return dict(PayflowTransaction.objects.filter(
+            comment1__in=order_numbers, trxtype__in=trxtypes, result__in=('0', '126'),
+        ).order_by('date_created').values_list('comment1', 'pnref'))
+    # The express views record the token as the reference of the payment
+    # source
+    return dict(Source.objects.filter(
+        order__number__in=order_numbers, source_type__name='PayPal',
+    ).values_list('order__number', 'reference'))
+
+
+def _get_handled(action, integration, order_numbers, references):
+    """
+    Return the set of order numbers whose payment has already been handled.
+    """
+    done = set(BatchResult.objects.filter(
+        action=action, status=BatchResult.SUCCEEDED, order_number__in=order_numbers,
+    ).values_list('order_number', flat=True))
+
+    # The payment may also have been handled outside of a batch, eg from the
+    # dashboard, or by a batch which was interrupted before writing its
+    # results
+    if integration == BatchResult.EXPRESS:
+        # The facade records the token on its captures, voids and refunds
+        tokens = {reference: number for number, reference in references.items()}
+        done.update(tokens[token] for token in ExpressTransaction.objects.filter(
+            token__in=tokens, method=_EXPRESS_METHODS[action],
+            ack__in=(ExpressTransaction.SUCCESS, ExpressTransaction.SUCCESS_WITH_WARNING),
+        ).values_list('token', flat=True))
+    elif integration == BatchResult.EXPRESS_CHECKOUT:
+        tokens = {reference: number for number, reference in references.items()}
+        txns = ExpressCheckoutTransaction.objects.filter(order_id__in=tokens)
+        if action == BatchResult.CAPTURE:
+            txns = txns.filter(capture_id__isnull=False)
+        elif action == BatchResult.REFUND:
+            txns = txns.filter(refund_id__isnull=False)
+        else:
+            txns = txns.filter(status=ExpressCheckoutTransaction.VOIDED)
+        done.update(tokens[token] for token in txns.values_list('order_id', flat=True))
+    elif integration == BatchResult.PAYFLOW:
+        done.update(PayflowTransaction.objects.filter(
+            comment1__in=order_numbers, trxtype=_PAYFLOW_TRXTYPES[action], result__in=('0', '126'),
+        ).values_list('comment1', flat=True))
+    return done
+
+
+def _get_in_doubt(action, order_numbers):
+    """
+    Return the set of order numbers whose latest result is pending or
+    unknown, so that PayPal may have carried out the action.
+    """
+    latest = dict(BatchResult.objects.filter(
+        action=action, order_number__in=order_numbers,
+    ).order_by('pk').values_list('order_number', 'status'))
+    return {number for number, status in latest.items() if status in (BatchResult.PENDING, BatchResult.UNKNOWN)}
+
+
+def _capture_express(order_number, token):
+    return express_facade.capture_authorization(token).value('TRANSACTIONID')
+
+
+def _refund_express(order_number, token):
+    txn = ExpressTransaction.objects.get(token=token, method=DO_EXPRESS_CHECKOUT)
+    return express_facade.refund_transaction(token, txn.amount, txn.currency).value('REFUNDTRANSACTIONID')
+
+
+def _void_express(order_number, token):
+    return express_facade.void_authorization(token).value('AUTHORIZATIONID')
+
+
+def _capture_express_checkout(order_number, token):
+    return express_checkout_facade.capture_order(token).capture_id
+
+
+def _refund_express_checkout(order_number, token):
+    return express_checkout_facade.refund_order(token).refund_id
+
+
+def _void_express_checkout(order_number, token):
+    return express_checkout_facade.void_authorization(token).authorization_id
+
+
+def _capture_payflow(order_number, pnref):
+    return payflow_facade.delayed_capture(order_number, pnref).pnref
+
+
+def _refund_payflow(order_number, pnref):
+    return payflow_facade.credit(order_number, pnref).pnref
+
+
+def _void_payflow(order_number, pnref):
+    return payflow_facade.void(order_number, pnref).pnref
+
+
+_EXPRESS_METHODS = {
+    BatchResult.CAPTURE: DO_CAPTURE,
+    BatchResult.REFUND: REFUND_TRANSACTION,
+    BatchResult.VOID: DO_VOID,
+}
+
+_PAYFLOW_TRXTYPES = {
+    BatchResult.CAPTURE: codes.DELAYED_CAPTURE,
+    BatchResult.REFUND: codes.CREDIT,
+    BatchResult.VOID: codes.VOID,
+}
+
+_ACTIONS = {
+    (BatchResult.CAPTURE, BatchResult.EXPRESS): _capture_express,
+    (BatchResult.REFUND, BatchResult.EXPRESS): _refund_express,
+    (BatchResult.VOID, BatchResult.EXPRESS): _void_express,
+    (BatchResult.CAPTURE, BatchResult.EXPRESS_CHECKOUT): _capture_express_checkout,
+    (BatchResult.REFUND, BatchResult.EXPRESS_CHECKOUT): _refund_express_checkout,
+    (BatchResult.VOID, BatchResult.EXPRESS_CHECKOUT): _void_express_checkout,
+    (BatchResult.CAPTURE, BatchResult.PAYFLOW): _capture_payflow,
+    (BatchResult.REFUND, BatchResult.PAYFLOW): _refund_payflow,
+    (BatchResult.VOID, BatchResult.PAYFLOW): _void_payflow,
+}
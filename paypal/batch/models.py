@@ -0,0 +1,48 @@
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class BatchResult(models.Model):
+    """
+    The outcome of an action (eg a capture) on the payment of an order, as
+    part of a batch.
+    """
+    batch_id = models.CharField(_("Batch ID"), max_length=64)
+
+    CAPTURE, REFUND, VOID = 'capture', 'refund', 'void'
+    action = models.CharField(max_length=16)
+
+    EXPRESS, EXPRESS_CHECKOUT, PAYFLOW = 'express', 'express_checkout', 'payflow'
+    integration = models.CharField(max_length=16)
+
+    order_number = models.CharField(max_length=128)
+
+    # The token (or PNREF) of the order's payment, and the ID of the
+    # transaction made by the action
+    reference = models.CharField(max_length=255, null=True, blank=True)
+    transaction_id = models.CharField(max_length=255, null=True, blank=True)
+
+    # An order is pending while the call for it is made, and its outcome is
+    # unknown if the call failed without a response, as PayPal may still
+    # have carried it out
+    SUCCEEDED, FAILED, PENDING, UNKNOWN = 'succeeded', 'failed', 'pending', 'unknown'
+    status = models.CharField(max_length=16)
+    error_message = models.CharField(max_length=512, blank=True)
+
+    response_time = models.FloatField(null=True, blank=True, help_text=_("Response time in milliseconds"))
+
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('-date_created',)
+        app_label = 'paypal'
+        indexes = [
+            models.Index(fields=['batch_id', 'order_number'], name='paypal_batch_order_idx'),
+        ]
+
+    def __str__(self):
+        return '%s %s: %s' % (self.action, self.order_number, self.status)
+
+    @property
+    def is_successful(self):
+        return self.status == self.SUCCEEDED
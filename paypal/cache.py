@@ -0,0 +1,262 @@
+"""
+In-process caches used while building requests to PayPal.
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import transaction
+from oscar.core.loading import get_model
+
+from paypal import conf
+
+_missing = object()
+
+_product_cache = None
+_product_cache_lock = threading.Lock()
+
+# Shipping charges worked out in the current context - see `shipping_charges`
+_shipping_charges = ContextVar('paypal_shipping_charges', default=None)
+
+# Rows of near-static tables - see `get_country` and `get_source_type`
+_countries = {}
+_source_types = {}
+_lookups_lock = threading.Lock()
+_lookups_generation = 0
+
+
+class LRUCache:
+    """
+    A thread-safe cache which holds up to ``maxsize`` items, dropping the least
+    recently used item when it is full, and counts its hits and misses.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._items.get(key, _missing)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def get_or_set(self, key, func):
+        """
+        Return the cached value for the key, calling ``func`` to work it out
+        on a miss.
+        """
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """
+        Return the number of ``hits`` and ``misses``, and the ``size`` and
+        ``maxsize`` of the cache.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._items), 'maxsize': self.maxsize}
+
+
+def get_product_cache():
+    """
+    Return the cache of product fields used by `get_product_fields`.
+
+    It holds ``PAYPAL_PRODUCT_CACHE_SIZE`` items, and is replaced (losing its
+    contents and counters) if the setting changes.
+    """
+    global _product_cache
+    maxsize = conf.get_config().product_cache_size
+    cache = _product_cache
+    if cache is None or cache.maxsize != maxsize:
+        with _product_cache_lock:
+            if _product_cache is None or _product_cache.maxsize != maxsize:
+                _product_cache = LRUCache(maxsize)
+            cache = _product_cache
+    return cache
+
+
+def get_product_fields(product, namespace, build):
+    """
+    Return ``build(product)``, the fields of a line item that only depend on
+    the product (eg its title and formatted description).
+
+    The result is cached for each version of the product, as given by its
+    ``date_updated`` and that of its parent.  Changes which don't update a
+    product's ``date_updated`` (eg updating it through ``QuerySet.update`` or
+    changing its product class) aren't picked up until the cached item is
+    dropped or ``get_product_cache().clear()`` is called.
+
+    :namespace: Name for the fields built by ``build``, as different gateways
+                format products differently
+    """
+    if product.pk is None or not conf.get_config().product_cache_size:
+        return build(product)
+    key = (namespace, product.pk, getattr(product, 'date_updated', None))
+    if getattr(product, 'parent_id', None):
+        key += (product.parent_id, getattr(product.parent, 'date_updated', None))
+    return get_product_cache().get_or_set(key, lambda: build(product))
+
+
+@contextmanager
+def shipping_charges():
+    """
+    Calculate the charge of each shipping method at most once within the
+    block, eg while handling a request.
+
+    Charges are only remembered when they are worked out with
+    `get_shipping_charge`, or by a method passed to `memoize_shipping_charge`.
+    """
+    if _shipping_charges.get() is not None:
+        # Share the charges of an outer block
+        yield
+        return
+    token = _shipping_charges.set({})
+    try:
+        yield
+    finally:
+        _shipping_charges.reset(token)
+
+
+class MemoizedShippingMethod:
+    """
+    A shipping method whose ``calculate`` goes through `get_shipping_charge`.
+
+    Everything else is looked up on the wrapped method, which is left as it
+    is because method instances may be shared, eg by a shipping repository.
+    """
+
+    def __init__(self, method):
+        self.__wrapped__ = method
+
+    def __getattr__(self, name):
+        if name == '__wrapped__':
+            # Not set yet, eg while being unpickled
+            raise AttributeError(name)
+        return getattr(self.__wrapped__, name)
+
+    def __repr__(self):
+        return '<MemoizedShippingMethod %r>' % self.__wrapped__
+
+    def calculate(self, basket):
+        return get_shipping_charge(self.__wrapped__, basket)
+
+
+def get_shipping_charge(method, basket, calculate=None):
+    """
+    Return ``method.calculate(basket)``, reusing the charge if it has already
+    been calculated within the current `shipping_charges` block.
+    """
+    if isinstance(method, MemoizedShippingMethod):
+        method = method.__wrapped__
+    calculate = calculate or method.calculate
+    charges = _shipping_charges.get()
+    if charges is None:
+        return calculate(basket)
+    key = _get_shipping_charge_key(method, basket)
+    if key not in charges:
+        charges[key] = calculate(basket)
+    return charges[key]
+
+
+def memoize_shipping_charge(method):
+    """
+    Return ``method`` wrapped in a `MemoizedShippingMethod`, so that code
+    which calls its ``calculate`` directly (eg Oscar's checkout) shares the
+    charges too.
+    """
+    if isinstance(method, MemoizedShippingMethod):
+        return method
+    return MemoizedShippingMethod(method)
+
+
+def _get_shipping_charge_key(method, basket):
+    # Instances of a method class share a code, so a fixed price and an offer
+    # discount (which wraps another method) are part of the key too.
+    offer = getattr(method, 'offer', None)
+    return (
+        type(method), method.code, getattr(method, 'charge_excl_tax', None),
+        getattr(method, 'charge_incl_tax', None), getattr(offer, 'pk', None),
+        basket.pk if basket.pk is not None else id(basket))
+
+
+def get_country(code):
+    """
+    Return the country with the ISO 3166-1 alpha-2 ``code``.
+
+    Raises ``Country.DoesNotExist`` if there isn't one.
+    """
+    country = _countries.get(code)
+    if country is None:
+        generation = _lookups_generation
+        country = get_model('address', 'Country').objects.get(iso_3166_1_a2=code)
+        _remember(_countries, code, country, generation)
+    return country
+
+
+def get_source_type(name):
+    """
+    Return the payment source type called ``name``, creating it if need be.
+    """
+    source_type = _source_types.get(name)
+    if source_type is None:
+        generation = _lookups_generation
+        source_type, created = get_model('payment', 'SourceType').objects.get_or_create(name=name)
+        if created:
+            # Saving it cleared the lookups
+            generation = _lookups_generation
+        _remember(_source_types, name, source_type, generation)
+    return source_type
+
+
+def clear_lookups(**kwargs):
+    """
+    Forget the countries and source types looked up so far.
+
+    This is called when a country or source type is saved or deleted in this
+    process.  Changes made by other processes aren't picked up until they
+    are restarted, or call this themselves.
+    """
+    global _lookups_generation
+    with _lookups_lock:
+        _lookups_generation += 1
+        _countries.clear()
+        _source_types.clear()
+
+
+def _remember(lookups, key, instance, generation):
+    # Rows are only cached once the transaction that read them commits, so
+    # that a row created in a transaction which is rolled back isn't cached,
+    # and only if nothing was changed since they were read.
+    def remember():
+        with _lookups_lock:
+            if generation == _lookups_generation:
+                lookups[key] = instance
+    transaction.on_commit(remember, using=instance._state.db)
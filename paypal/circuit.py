@@ -0,0 +1,198 @@
+"""
+Circuit breakers for the PayPal endpoints.
+
+When calls to an endpoint keep failing (PayPal can't be reached, times out or
+has server errors), its circuit is opened: for the next
+``PAYPAL_CIRCUIT_BREAKER_RESET_TIMEOUT`` seconds calls to it fail straight
+away with ``CircuitOpen``, rather than each tying up a worker until it fails
+too.  After that, a single call is let through to probe the endpoint.  The
+circuit is closed again if it succeeds, and opened again if it fails.
+
+Each PayPal method (or operation) of an endpoint has its own circuit.  With
+``PAYPAL_CIRCUIT_BREAKER_CACHE`` set, an open circuit is shared with other
+processes through that Django cache, so that all web servers back off.
+"""
+import hashlib
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.core.cache import caches
+
+from paypal import conf, exceptions
+
+logger = logging.getLogger('paypal.circuit')
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitBreaker:
+    """
+    The circuit of one method of an endpoint.
+    """
+
+    def __init__(self, endpoint, operation=None):
+        self.endpoint = endpoint
+        self.operation = operation
+        self.failures = 0
+        # When the circuit can be probed again (a `time.time` value), or None
+        # if it is closed
+        self.opened_until = None
+        self.probing = False
+        self._lock = threading.Lock()
+        key = '%s|%s' % (endpoint, operation)
+        self.cache_key = 'paypal-circuit-%s' % hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def __str__(self):
+        return '%s %s' % (self.endpoint, self.operation or '')
+
+    @property
+    def state(self):
+        if self.opened_until is None:
+            return CLOSED
+        if time.time() < self.opened_until:
+            return OPEN
+        return HALF_OPEN
+
+    def check(self):
+        """
+        Raise ``CircuitOpen`` if a call shouldn't be made now, and return
+        whether the call is the one probing a half-open circuit.
+        """
+        opened_until = self.opened_until
+        if opened_until is None:
+            cache = _get_cache()
+            opened_until = cache.get(self.cache_key) if cache is not None else None
+            if opened_until is None:
+                return False
+        with self._lock:
+            if self.opened_until is None or opened_until > self.opened_until:
+                self.opened_until = opened_until
+            if time.time() < self.opened_until or self.probing:
+                raise exceptions.CircuitOpen("Unable to communicate with PayPal")
+            # Let this call through to probe the endpoint
+            self.probing = True
+        return True
+
+    def interrupted(self):
+        """
+        Let another call probe the endpoint, as the probe was interrupted
+        (eg its task was cancelled) before it found out anything.
+        """
+        with self._lock:
+            self.probing = False
+
+    def succeeded(self):
+        if self.opened_until is None and not self.failures:
+            return
+        with self._lock:
+            was_open = self.opened_until is not None
+            self.failures = 0
+            self.opened_until = None
+            self.probing = False
+        if was_open:
+            logger.info("Circuit for %s closed", self)
+            cache = _get_cache()
+            if cache is not None:
+                cache.delete(self.cache_key)
+
+    def failed(self):
+        config = conf.get_config()
+        with self._lock:
+            self.failures += 1
+            if not self.probing and self.failures < config.circuit_breaker_threshold:
+                return
+            self.opened_until = time.time() + config.circuit_breaker_reset_timeout
+            self.probing = False
+        logger.warning("Circuit for %s opened for %ss after %d failed calls",
+                       self, config.circuit_breaker_reset_timeout, self.failures)
+        cache = _get_cache()
+        if cache is not None:
+            cache.set(self.cache_key, self.opened_until, config.circuit_breaker_reset_timeout)
+
+
+def get_breaker(endpoint, operation=None):
+    key = (endpoint, operation)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(key, CircuitBreaker(endpoint, operation))
+    return breaker
+
+
+@contextmanager
+def guard(endpoint, operation=None):
+    """
+    Make a call to PayPal within the block, through the circuit for the
+    endpoint and operation.
+
+    Raises ``CircuitOpen`` instead of running the block if the circuit is
+    open.  Errors raised by the block which show that the endpoint is
+    failing (see `is_failure`) count towards opening it.
+    """
+    if not conf.get_config().circuit_breaker_threshold:
+        yield
+        return
+    breaker = get_breaker(endpoint, operation)
+    probe = breaker.check()
+    try:
+        yield
+    except Exception as e:
+        if is_failure(e):
+            breaker.failed()
+        else:
+            breaker.succeeded()
+        raise
+    except BaseException:
+        # Eg ``asyncio.CancelledError`` when the client goes away
+        if probe:
+            breaker.interrupted()
+        raise
+    breaker.succeeded()
+
+
+def is_failure(error):
+    """
+    Return whether an error shows that PayPal is failing, rather than eg
+    rejecting a request: it couldn't be reached, or had a server error or
+    asked for calls to slow down.
+    """
+    if not hasattr(error, 'status_code'):
+        return False
+    status_code = error.status_code
+    return status_code is None or status_code >= 500 or status_code == 429
+
+
+def is_open_error(error):
+    """
+    Return whether an error is (or was raised because of) a ``CircuitOpen``,
+    eg the ``HttpError`` raised by the PayPal Commerce Platform client.
+    """
+    return isinstance(error, exceptions.CircuitOpen) or isinstance(error.__cause__, exceptions.CircuitOpen)
+
+
+def get_states():
+    """
+    Return the state of each circuit which has been used, by endpoint and
+    operation.
+    """
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {(breaker.endpoint, breaker.operation): breaker.state for breaker in breakers}
+
+
+def reset():
+    """
+    Close all circuits in this process.
+    """
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def _get_cache():
+    alias = conf.get_config().circuit_breaker_cache
+    return caches[alias] if alias else None
@@ -0,0 +1,204 @@
+"""
+Settings used by the PayPal integrations.
+
+The PAYPAL_* settings are read and validated once, when the app is loaded, and
+kept in a `Config` object so that gateway calls don't have to look them up
+again.  The config is rebuilt when a PayPal setting changes (eg through
+``override_settings`` in tests).
+"""
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils.module_loading import import_string
+
+# Locale codes accepted by PayPal Express
+LOCALES = ('AU', 'DE', 'FR', 'GB', 'IT', 'ES', 'JP', 'US')
+
+# Landing pages accepted by the Orders API
+LANDING_PAGES = ('LOGIN', 'BILLING', 'NO_PREFERENCE')
+
+_config = None
+_config_lock = threading.Lock()
+
+
+def check_locale(locale):
+    if locale not in LOCALES:
+        raise ImproperlyConfigured(
+            "'%s' is not a valid locale code" % locale)
+
+
+class Config:
+
+    def __init__(self):
+        self.sandbox_mode = getattr(settings, 'PAYPAL_SANDBOX_MODE', True)
+        self.buyer_pays_on_paypal = getattr(settings, 'PAYPAL_BUYER_PAYS_ON_PAYPAL', False)
+        self.brand_name = getattr(settings, 'PAYPAL_BRAND_NAME', None)
+        self.product_cache_size = getattr(settings, 'PAYPAL_PRODUCT_CACHE_SIZE', 1000)
+        self.batch_workers = getattr(settings, 'PAYPAL_BATCH_WORKERS', 4)
+        self.batch_rate = getattr(settings, 'PAYPAL_BATCH_RATE', None)
+        self.export_chunk_size = getattr(settings, 'PAYPAL_EXPORT_CHUNK_SIZE', 2000)
+
+        # Retries of calls which are safe to repeat
+        self.retry_attempts = getattr(settings, 'PAYPAL_RETRY_ATTEMPTS', 3)
+        self.retry_backoff = getattr(settings, 'PAYPAL_RETRY_BACKOFF', 0.2)
+        self.retry_max_backoff = getattr(settings, 'PAYPAL_RETRY_MAX_BACKOFF', 2)
+
+        # Circuit breakers around the PayPal endpoints, which are off if the
+        # threshold is 0
+        self.circuit_breaker_threshold = getattr(settings, 'PAYPAL_CIRCUIT_BREAKER_THRESHOLD', 5)
+        self.circuit_breaker_reset_timeout = getattr(settings, 'PAYPAL_CIRCUIT_BREAKER_RESET_TIMEOUT', 30)
+        self.circuit_breaker_cache = getattr(settings, 'PAYPAL_CIRCUIT_BREAKER_CACHE', None)
+        if self.circuit_breaker_cache and self.circuit_breaker_cache not in settings.CACHES:
+            raise ImproperlyConfigured(
+                "PAYPAL_CIRCUIT_BREAKER_CACHE '%s' is not a configured cache" % self.circuit_breaker_cache)
+
+        # Backends which calls to PayPal are recorded with - see
+        # `paypal.instrumentation`
+        self.instrumentation_backends = [
+            import_string(path)() for path in getattr(settings, 'PAYPAL_INSTRUMENTATION_BACKENDS', ())]
+
+        self._init_express()
+        self._init_express_checkout()
+        self._init_payflow()
+
+    def _init_express(self):
+        self.api_username = getattr(settings, 'PAYPAL_API_USERNAME', None)
+        self.api_password = getattr(settings, 'PAYPAL_API_PASSWORD', None)
+        self.api_signature = getattr(settings, 'PAYPAL_API_SIGNATURE', None)
+        _check_all_or_none('PAYPAL_API_USERNAME', 'PAYPAL_API_PASSWORD', 'PAYPAL_API_SIGNATURE')
+
+        # Time allowed for the instant update callback, and how much of it
+        # to keep back for rendering and sending the response
+        self.callback_timeout = getattr(settings, 'PAYPAL_CALLBACK_TIMEOUT', 3)
+        self.callback_margin = getattr(settings, 'PAYPAL_CALLBACK_MARGIN', 0.5)
+        self.callback_workers = getattr(settings, 'PAYPAL_CALLBACK_WORKERS', 10)
+
+        # Cache for the responses of the instant update callback
+        self.shipping_options_cache = getattr(settings, 'PAYPAL_SHIPPING_OPTIONS_CACHE', 'default')
+        self.shipping_options_cache_timeout = getattr(settings, 'PAYPAL_SHIPPING_OPTIONS_CACHE_TIMEOUT', 60)
+        if self.shipping_options_cache_timeout and self.shipping_options_cache not in settings.CACHES:
+            raise ImproperlyConfigured(
+                "PAYPAL_SHIPPING_OPTIONS_CACHE '%s' is not a configured cache" % self.shipping_options_cache)
+
+        # Cache for the GetExpressCheckoutDetails responses shown in the
+        # preview, which is off unless a timeout is set
+        self.txn_details_cache = getattr(settings, 'PAYPAL_TXN_DETAILS_CACHE', 'default')
+        self.txn_details_cache_timeout = getattr(settings, 'PAYPAL_TXN_DETAILS_CACHE_TIMEOUT', 0)
+        if self.txn_details_cache_timeout and self.txn_details_cache not in settings.CACHES:
+            raise ImproperlyConfigured(
+                "PAYPAL_TXN_DETAILS_CACHE '%s' is not a configured cache" % self.txn_details_cache)
+
+        self.nvp_url = getattr(settings, 'PAYPAL_NVP_URL', None)
+        if self.nvp_url is None:
+            if self.sandbox_mode:
+                self.nvp_url = 'https://api-3t.sandbox.paypal.com/nvp'
+            else:
+                self.nvp_url = 'https://api-3t.paypal.com/nvp'
+        if self.sandbox_mode:
+            self.express_redirect_url = 'https://www.sandbox.paypal.com/webscr'
+        else:
+            self.express_redirect_url = 'https://www.paypal.com/webscr'
+
+        # Default parameters for 'SetExpressCheckout' requests.  These can be
+        # overridden and customised using the paypal_params parameter of
+        # set_txn.
+        params = {
+            'CUSTOMERSERVICENUMBER': getattr(
+                settings, 'PAYPAL_CUSTOMER_SERVICES_NUMBER', None),
+            'SOLUTIONTYPE': getattr(settings, 'PAYPAL_SOLUTION_TYPE', None),
+            'LANDINGPAGE': getattr(settings, 'PAYPAL_LANDING_PAGE', None),
+            'BRANDNAME': self.brand_name,
+
+            # Display settings
+            'PAGESTYLE': getattr(settings, 'PAYPAL_PAGESTYLE', None),
+            'HDRIMG': getattr(settings, 'PAYPAL_HEADER_IMG', None),
+            'PAYFLOWCOLOR': getattr(settings, 'PAYPAL_PAYFLOW_COLOR', None),
+
+            # Think these settings maybe deprecated in latest version of PayPal's
+            # API
+            'HDRBACKCOLOR': getattr(settings, 'PAYPAL_HEADER_BACK_COLOR', None),
+            'HDRBORDERCOLOR': getattr(
+                settings, 'PAYPAL_HEADER_BORDER_COLOR', None),
+
+            'LOCALECODE': getattr(settings, 'PAYPAL_LOCALE', None),
+
+            'ALLOWNOTE': getattr(settings, 'PAYPAL_ALLOW_NOTE', True),
+            'CALLBACKTIMEOUT': self.callback_timeout
+        }
+        # Dropped again when no shipping is required
+        if getattr(settings, 'PAYPAL_CONFIRM_SHIPPING', None):
+            params['REQCONFIRMSHIPPING'] = 1
+
+        if params['LOCALECODE']:
+            check_locale(params['LOCALECODE'])
+
+        # Boolean values become integers and None values are removed
+        self.set_txn_defaults = {
+            key: int(value) if isinstance(value, bool) else value
+            for key, value in params.items() if value is not None}
+
+    def _init_express_checkout(self):
+        self.client_id = getattr(settings, 'PAYPAL_CLIENT_ID', None)
+        self.client_secret = getattr(settings, 'PAYPAL_CLIENT_SECRET', None)
+        _check_all_or_none('PAYPAL_CLIENT_ID', 'PAYPAL_CLIENT_SECRET')
+        self.rest_api_url = getattr(settings, 'PAYPAL_REST_API_URL', None)
+
+        # The same setting is used by PayPal Express, which takes eg 'Login'
+        landing_page = getattr(settings, 'PAYPAL_LANDING_PAGE', None) or 'NO_PREFERENCE'
+        if landing_page.upper() not in LANDING_PAGES:
+            raise ImproperlyConfigured("'%s' is not a valid landing page" % landing_page)
+        self.landing_page = landing_page.upper()
+
+    def _init_payflow(self):
+        self.payflow_vendor_id = getattr(settings, 'PAYPAL_PAYFLOW_VENDOR_ID', None)
+        self.payflow_password = getattr(settings, 'PAYPAL_PAYFLOW_PASSWORD', None)
+        _check_all_or_none('PAYPAL_PAYFLOW_VENDOR_ID', 'PAYPAL_PAYFLOW_PASSWORD')
+        self.payflow_user = getattr(settings, 'PAYPAL_PAYFLOW_USER', self.payflow_vendor_id)
+        self.payflow_partner = getattr(settings, 'PAYPAL_PAYFLOW_PARTNER', 'PayPal')
+        self.payflow_currency = getattr(settings, 'PAYPAL_PAYFLOW_CURRENCY', 'USD')
+
+        optional_params = getattr(settings, 'PAYPAL_PAYFLOW_OPTIONAL_PARAMS', dict())
+        self.payflow_optional_params = optional_params if isinstance(optional_params, dict) else {}
+
+        self.payflow_url = getattr(settings, 'PAYPAL_PAYFLOW_URL', None)
+        if self.payflow_url is None:
+            if getattr(settings, 'PAYPAL_PAYFLOW_PRODUCTION_MODE', False):
+                self.payflow_url = 'https://payflowpro.paypal.com'
+            else:
+                self.payflow_url = 'https://pilot-payflowpro.paypal.com'
+
+
+def _check_all_or_none(*names):
+    # Credentials are only needed for the integrations in use, but an
+    # incomplete set is a mistake.
+    missing = [name for name in names if not hasattr(settings, name)]
+    if missing and len(missing) < len(names):
+        raise ImproperlyConfigured(
+            "You must define a %s setting" % " and a ".join(missing))
+
+
+def get_config():
+    """
+    Return the config built from the current settings.
+
+    Raises ``ImproperlyConfigured`` if a setting is invalid.
+    """
+    global _config
+    config = _config
+    if config is None:
+        with _config_lock:
+            if _config is None:
+                _config = Config()
+            config = _config
+    return config
+
+
+@receiver(setting_changed)
+def _reset_config(setting, **kwargs):
+    global _config
+    if setting.startswith('PAYPAL_'):
+        with _config_lock:
+            _config = None
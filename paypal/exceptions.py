@@ -3,3 +3,26 @@ from oscar.apps.payment.exceptions import PaymentError
 
 class PayPalError(PaymentError):
     pass
+
+
+class DeadlineExceeded(PayPalError):
+    """
+    For when the time budget for talking to PayPal has been used up.
+    """
+
+
+class CommunicationError(PayPalError):
+    """
+    For when PayPal can't be reached, or responds with an HTTP error.
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitOpen(PayPalError):
+    """
+    For when calls to a PayPal endpoint are failing, so that the call isn't
+    made - see `paypal.circuit`.
+    """
@@ -0,0 +1,121 @@
+"""
+Export of the transaction history, eg for monthly reports.
+
+Transactions are read from the database in chunks and written out as they
+are read, so an export of any size takes the same memory, and can be streamed
+to the client as it is written.
+"""
+import csv
+import datetime
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from paypal import conf
+from paypal.express.models import ExpressTransaction
+from paypal.express_checkout.models import ExpressCheckoutTransaction
+from paypal.payflow.models import PayflowTransaction
+
+EXPRESS, EXPRESS_CHECKOUT, PAYFLOW = 'express', 'express_checkout', 'payflow'
+INTEGRATIONS = (EXPRESS, EXPRESS_CHECKOUT, PAYFLOW)
+
+CSV, JSONL = 'csv', 'jsonl'
+CONTENT_TYPES = {
+    CSV: 'text/csv',
+    JSONL: 'application/x-ndjson',
+}
+
+# The columns exported for each integration.  The raw requests and responses
+# are left out, as they are large and hold customer details.
+FIELDS = {
+    EXPRESS: ('id', 'date_created', 'method', 'ack', 'amount', 'currency', 'token', 'correlation_id',
+              'error_code', 'error_message', 'response_time'),
+    EXPRESS_CHECKOUT: ('id', 'date_created', 'order_id', 'status', 'intent', 'amount', 'currency', 'email',
+                       'payer_id', 'authorization_id', 'capture_id', 'refund_id'),
+    PAYFLOW: ('id', 'date_created', 'comment1', 'trxtype', 'tender', 'amount', 'pnref', 'ppref', 'result',
+              'respmsg', 'authcode', 'response_time'),
+}
+
+_MODELS = {
+    EXPRESS: ExpressTransaction,
+    EXPRESS_CHECKOUT: ExpressCheckoutTransaction,
+    PAYFLOW: PayflowTransaction,
+}
+
+# Number of rows written at a time
+_LINES_PER_WRITE = 100
+
+
+class _Echo:
+    # A file for `csv.writer` which returns each line instead of writing it
+    def write(self, value):
+        return value
+
+
+def get_transactions(integration, date_from=None, date_to=None):
+    """
+    Return the exported columns of the transactions of ``integration``
+    created between ``date_from`` and ``date_to`` (both inclusive), as a
+    queryset of tuples.
+    """
+    txns = _MODELS[integration].objects.all()
+    if date_from is not None:
+        txns = txns.filter(date_created__gte=_get_start_of_day(date_from))
+    if date_to is not None:
+        txns = txns.filter(date_created__lt=_get_start_of_day(date_to + datetime.timedelta(days=1)))
+    return txns.order_by('pk').values_list(*FIELDS[integration])
+
+
+def iter_export(integration, format=CSV, date_from=None, date_to=None, chunk_size=None):
+    """
+    Return an iterator of the export of the transactions of ``integration``
+    (see `get_transactions`) as CSV with a header row, or as JSON lines, in
+    strings of up to 100 rows.
+
+    :chunk_size: Number of rows to fetch from the database at a time.
+                 Defaults to ``PAYPAL_EXPORT_CHUNK_SIZE``.
+    """
+    if format not in CONTENT_TYPES:
+        raise ValueError("Unknown export format '%s'" % format)
+    rows = get_transactions(integration, date_from, date_to).iterator(
+        chunk_size=chunk_size or conf.get_config().export_chunk_size)
+    return _join_lines(_iter_lines(FIELDS[integration], rows, format))
+
+
+def get_filename(integration, format=CSV, date_from=None, date_to=None):
+    parts = ['paypal', integration.replace('_', '-'), 'transactions']
+    if date_from is not None:
+        parts.append('from-%s' % date_from.isoformat())
+    if date_to is not None:
+        parts.append('to-%s' % date_to.isoformat())
+    return '%s.%s' % ('-'.join(parts), format)
+
+
+def _get_start_of_day(date):
+    start = datetime.datetime.combine(date, datetime.time.min)
+    return timezone.make_aware(start) if settings.USE_TZ else start
+
+
+def _iter_lines(fields, rows, format):
+    if format == CSV:
+        writer = csv.writer(_Echo())
+        yield writer.writerow(fields)
+        for row in rows:
+            yield writer.writerow(row)
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def _join_lines(lines):
+    # Fewer, larger writes are cheaper for the server than one per row
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == _LINES_PER_WRITE:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
@@ -15,6 +15,7 @@ class ExpressDashboardApplication(OscarDashboardConfig):
         from . import views
         self.list_view = views.TransactionListView
         self.detail_view = views.TransactionDetailView
+        self.export_view = views.TransactionExportView
 
     def get_urls(self):
         urlpatterns = [
@@ -22,5 +23,7 @@ class ExpressDashboardApplication(OscarDashboardConfig):
                  name='paypal-express-list'),
             path('transactions/<int:pk>/', self.detail_view.as_view(),
                  name='paypal-express-detail'),
+            path('transactions/export/', self.export_view.as_view(),
+                 name='paypal-express-export'),
         ]
         return self.post_process_urls(urlpatterns)
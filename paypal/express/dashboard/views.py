@@ -1,7 +1,9 @@
 from django.conf import settings
 from django.views import generic
 
+from paypal import export
 from paypal.express import models
+from paypal.views import TransactionExportMixin
 
 
 class TransactionListView(generic.ListView):
@@ -10,6 +12,10 @@ class TransactionListView(generic.ListView):
     context_object_name = 'transactions'
 
 
+class TransactionExportView(TransactionExportMixin, generic.View):
+    integration = export.EXPRESS
+
+
 class TransactionDetailView(generic.DetailView):
     model = models.ExpressTransaction
     template_name = 'paypal/express/dashboard/transaction_detail.html'
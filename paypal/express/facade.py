@@ -1,13 +1,17 @@
 """
 Responsible for briding between Oscar and the PayPal gateway
 """
+import hashlib
+
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
 from django.urls import reverse
 
+from paypal import conf, exceptions
 from paypal.express.gateway import (
-    AUTHORIZATION, DO_EXPRESS_CHECKOUT, ORDER, SALE, buyer_pays_on_paypal, do_capture, do_txn, do_void,
+    AUTHORIZATION, DO_CAPTURE, DO_EXPRESS_CHECKOUT, ORDER, SALE, buyer_pays_on_paypal, do_capture, do_txn, do_void,
     get_txn, refund_txn, set_txn)
 from paypal.express.models import ExpressTransaction as Transaction
 
@@ -79,11 +83,29 @@ def get_paypal_url(basket, shipping_methods, user=None, shipping_address=None,
                    paypal_params=paypal_params)
 
 
-def fetch_transaction_details(token):
+def fetch_transaction_details(token, payer_id=None, use_cache=False):
     """
     Fetch the completed details about the PayPal transaction.
+
+    If ``PAYPAL_TXN_DETAILS_CACHE_TIMEOUT`` is set and the payer is given, the
+    details are kept for that long.  With ``use_cache``, details kept by an
+    earlier call for the same token and payer (eg to show the preview) are
+    returned rather than fetched again.
     """
-    return get_txn(token)
+    config = conf.get_config()
+    if payer_id is None or not config.txn_details_cache_timeout:
+        return get_txn(token)
+
+    cache = caches[config.txn_details_cache]
+    key = 'paypal-txn-details-%s' % hashlib.sha256(
+        ('%s:%s' % (token, payer_id)).encode('utf-8')).hexdigest()
+    if use_cache:
+        txn = cache.get(key)
+        if txn is not None:
+            return txn
+    txn = get_txn(token)
+    cache.set(key, txn, config.txn_details_cache_timeout)
+    return txn
 
 
 def confirm_transaction(payer_id, token, amount, currency):
@@ -95,10 +117,29 @@ def confirm_transaction(payer_id, token, amount, currency):
 
 
 def refund_transaction(token, amount, currency, note=None):
+    """
+    Refund a payment.
+
+    Authorized payments are refunded through their capture, and raise
+    ``PayPalError`` if they haven't been captured.
+    """
     txn = Transaction.objects.get(token=token,
                                   method=DO_EXPRESS_CHECKOUT)
     is_partial = amount < txn.amount
-    return refund_txn(txn.value('PAYMENTINFO_0_TRANSACTIONID'), is_partial, amount, currency)
+    return refund_txn(_get_refundable_txn_id(txn), is_partial, amount, currency, token=token)
+
+
+def _get_refundable_txn_id(txn):
+    # The transaction of an authorization (or order) is pending until it is
+    # captured, and it is the capture which is refunded
+    if txn.value('PAYMENTINFO_0_PENDINGREASON') not in (AUTHORIZATION.lower(), ORDER.lower()):
+        return txn.value('PAYMENTINFO_0_TRANSACTIONID')
+    captures = Transaction.objects.filter(
+        token=txn.token, method=DO_CAPTURE, ack__in=(Transaction.SUCCESS, Transaction.SUCCESS_WITH_WARNING))
+    capture = captures.order_by('-pk').first()
+    if capture is None:
+        raise exceptions.PayPalError("The payment of %s has not been captured" % txn.token)
+    return capture.value('TRANSACTIONID')
 
 
 def capture_authorization(token, note=None):
@@ -108,7 +149,7 @@ def capture_authorization(token, note=None):
     txn = Transaction.objects.get(token=token,
                                   method=DO_EXPRESS_CHECKOUT)
     return do_capture(txn.value('PAYMENTINFO_0_TRANSACTIONID'),
-                      txn.amount, txn.currency, note=note)
+                      txn.amount, txn.currency, note=note, token=token)
 
 
 def void_authorization(token, note=None):
@@ -117,4 +158,4 @@ def void_authorization(token, note=None):
     """
     txn = Transaction.objects.get(token=token,
                                   method=DO_EXPRESS_CHECKOUT)
-    return do_void(txn.value('PAYMENTINFO_0_TRANSACTIONID'), note=note)
+    return do_void(txn.value('PAYMENTINFO_0_TRANSACTIONID'), note=note, token=token)
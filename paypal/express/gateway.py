@@ -8,7 +8,7 @@ from django.utils.http import urlencode
 from django.utils.translation import gettext as _
 from localflavor.us import us_states
 
-from paypal import exceptions, gateway
+from paypal import audit, cache, conf, exceptions, gateway, instrumentation
 
 from . import exceptions as express_exceptions
 from . import models
@@ -21,6 +21,13 @@ DO_CAPTURE = 'DoCapture'
 DO_VOID = 'DoVoid'
 REFUND_TRANSACTION = 'RefundTransaction'
 
+# Methods which only read data, and so are retried if PayPal can't be reached
+RETRYABLE_METHODS = (GET_EXPRESS_CHECKOUT,)
+
+# Calls which move money, whose transactions are always saved straight away
+# as they are looked up again, eg to refund a payment
+WRITE_THROUGH_METHODS = (DO_EXPRESS_CHECKOUT, DO_CAPTURE, DO_VOID, REFUND_TRANSACTION)
+
 SALE, AUTHORIZATION, ORDER = 'Sale', 'Authorization', 'Order'
 
 # The latest version of the PayPal Express API can be found here:
@@ -29,7 +36,7 @@ API_VERSION = getattr(settings, 'PAYPAL_API_VERSION', '119')
 
 logger = logging.getLogger('paypal.express')
 
-buyer_pays_on_paypal = lambda: getattr(settings, 'PAYPAL_BUYER_PAYS_ON_PAYPAL', False)
+buyer_pays_on_paypal = lambda: conf.get_config().buyer_pays_on_paypal
 
 
 def _format_description(description):
@@ -38,43 +45,102 @@ def _format_description(description):
     return ''
 
 
+def _get_product_fields(product):
+    return (
+        product.get_title(),
+        product.upc if product.upc else '',
+        _format_description(product.description),
+        'Physical' if product.is_shipping_required else 'Digital',
+    )
+
+
 def _format_currency(amt):
     return amt.quantize(D('0.01'))
 
 
-def _fetch_response(method, extra_params):
+def _fetch_response(method, extra_params, token=None):
     """
     Fetch the response from PayPal and return a transaction object
+
+    :token: The token of the checkout the call is for, recorded on the
+            transaction of calls (eg refunds) which don't send one
     """
+    url, params = _get_request_params(method, extra_params)
+
+    # Make HTTP request
+    def post():
+        return gateway.post(url, params, timeout=gateway.get_timeout(method), operation=method)
+    with instrumentation.measure(method, url) as call:
+        if method in RETRYABLE_METHODS:
+            pairs = gateway.call_with_retries(post, method)
+        else:
+            pairs = post()
+        call.outcome = pairs.get('ACK')
+
+    # Record transaction data - we save this model whether the txn
+    # was successful or not
+    txn = _get_transaction(method, params, pairs, token)
+    audit.save(txn, write_through=method in WRITE_THROUGH_METHODS)
+    return _check_transaction(txn)
+
+
+async def _afetch_response(method, extra_params, token=None):
+    """
+    Asynchronous version of `_fetch_response`
+    """
+    url, params = _get_request_params(method, extra_params)
+
+    def post():
+        return gateway.apost(url, params, timeout=gateway.get_timeout(method), operation=method)
+    with instrumentation.measure(method, url) as call:
+        if method in RETRYABLE_METHODS:
+            pairs = await gateway.acall_with_retries(post, method)
+        else:
+            pairs = await post()
+        call.outcome = pairs.get('ACK')
+    txn = _get_transaction(method, params, pairs, token)
+    await audit.asave(txn, write_through=method in WRITE_THROUGH_METHODS)
+    return _check_transaction(txn)
+
+
+def _get_request_params(method, extra_params):
+    """
+    Return the URL and the full parameters (including credentials) for a
+    request to PayPal
+    """
+    config = conf.get_config()
+    if config.api_username is None:
+        raise ImproperlyConfigured(
+            "You must define the PAYPAL_API_USERNAME, PAYPAL_API_PASSWORD and "
+            "PAYPAL_API_SIGNATURE settings")
+
     # Build parameter string
-    params = {
+    params = gateway.Payload({
         'METHOD': method,
         'VERSION': API_VERSION,
-        'USER': settings.PAYPAL_API_USERNAME,
-        'PWD': settings.PAYPAL_API_PASSWORD,
-        'SIGNATURE': settings.PAYPAL_API_SIGNATURE,
-    }
+        'USER': config.api_username,
+        'PWD': config.api_password,
+        'SIGNATURE': config.api_signature,
+    })
     params.update(extra_params)
-
-    if getattr(settings, 'PAYPAL_SANDBOX_MODE', True):
-        url = 'https://api-3t.sandbox.paypal.com/nvp'
-    else:
-        url = 'https://api-3t.paypal.com/nvp'
+    url = config.nvp_url
 
     # Print easy-to-read version of params for debugging
-    param_str = "\n".join(["%s: %s" % x for x in sorted(params.items())])
-    logger.debug("Making %s request to %s with params:\n%s", method, url,
-                 param_str)
+    if logger.isEnabledFor(logging.DEBUG):
+        param_str = "\n".join(["%s: %s" % x for x in sorted(params.items())])
+        logger.debug("Making %s request to %s with params:\n%s", method, url,
+                     param_str)
+    return url, params
 
-    # Make HTTP request
-    pairs = gateway.post(url, params)
 
+def _get_transaction(method, params, pairs, token=None):
+    """
+    Return an (unsaved) transaction model recording the request and response
+    """
     pairs_str = "\n".join(["%s: %s" % x for x in sorted(pairs.items())
                            if not x[0].startswith('_')])
     logger.debug("Response with params:\n%s", pairs_str)
 
-    # Record transaction data - we save this model whether the txn
-    # was successful or not
     txn = models.ExpressTransaction(
         method=method,
         version=API_VERSION,
@@ -82,6 +148,7 @@ def _fetch_response(method, extra_params):
         raw_request=pairs['_raw_request'],
         raw_response=pairs['_raw_response'],
         response_time=pairs['_response_time'],
+        token=token,
     )
     if txn.is_successful:
         txn.correlation_id = pairs['CORRELATIONID']
@@ -103,17 +170,18 @@ def _fetch_response(method, extra_params):
             txn.error_code = pairs['L_ERRORCODE0']
         if 'L_LONGMESSAGE0' in pairs:
             txn.error_message = pairs['L_LONGMESSAGE0']
-    txn.save()
+    return txn
 
+
+def _check_transaction(txn):
     if not txn.is_successful:
         msg = "Error %s - %s" % (txn.error_code, txn.error_message)
         logger.error(msg)
         raise exceptions.PayPalError(msg)
-
     return txn
 
 
-def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_url=None,  # noqa: C901 too complex
+def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_url=None,
             action=SALE, user=None, user_address=None, shipping_method=None,
             shipping_address=None, no_shipping=False, paypal_params=None):
     """
@@ -123,49 +191,42 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
     There are quite a few options that can be passed to PayPal to configure
     this request - most are controlled by PAYPAL_* settings.
     """
-    # Default parameters (taken from global settings).  These can be overridden
-    # and customised using the paypal_params parameter.
-    _params = {
-        'CUSTOMERSERVICENUMBER': getattr(
-            settings, 'PAYPAL_CUSTOMER_SERVICES_NUMBER', None),
-        'SOLUTIONTYPE': getattr(settings, 'PAYPAL_SOLUTION_TYPE', None),
-        'LANDINGPAGE': getattr(settings, 'PAYPAL_LANDING_PAGE', None),
-        'BRANDNAME': getattr(settings, 'PAYPAL_BRAND_NAME', None),
-
-        # Display settings
-        'PAGESTYLE': getattr(settings, 'PAYPAL_PAGESTYLE', None),
-        'HDRIMG': getattr(settings, 'PAYPAL_HEADER_IMG', None),
-        'PAYFLOWCOLOR': getattr(settings, 'PAYPAL_PAYFLOW_COLOR', None),
-
-        # Think these settings maybe deprecated in latest version of PayPal's
-        # API
-        'HDRBACKCOLOR': getattr(settings, 'PAYPAL_HEADER_BACK_COLOR', None),
-        'HDRBORDERCOLOR': getattr(
-            settings, 'PAYPAL_HEADER_BORDER_COLOR', None),
-
-        'LOCALECODE': getattr(settings, 'PAYPAL_LOCALE', None),
-
-        'ALLOWNOTE': getattr(settings, 'PAYPAL_ALLOW_NOTE', True),
-        'CALLBACKTIMEOUT': getattr(settings, 'PAYPAL_CALLBACK_TIMEOUT', 3)
-    }
-    confirm_shipping_addr = getattr(settings, 'PAYPAL_CONFIRM_SHIPPING', None)
-    if confirm_shipping_addr and not no_shipping:
-        _params['REQCONFIRMSHIPPING'] = 1
-    if paypal_params:
-        _params.update(paypal_params)
+    params = _get_set_txn_params(
+        basket, shipping_methods, currency, return_url, cancel_url, update_url=update_url,
+        action=action, user=user, user_address=user_address, shipping_method=shipping_method,
+        shipping_address=shipping_address, no_shipping=no_shipping, paypal_params=paypal_params)
+    txn = _fetch_response(SET_EXPRESS_CHECKOUT, params)
+    return _get_redirect_url(txn.token)
 
-    locale = _params.get('LOCALECODE', None)
-    if locale:
-        valid_choices = ('AU', 'DE', 'FR', 'GB', 'IT', 'ES', 'JP', 'US')
-        if locale not in valid_choices:
-            raise ImproperlyConfigured(
-                "'%s' is not a valid locale code" % locale)
 
-    # Boolean values become integers
-    _params.update((k, int(v)) for k, v in _params.items() if isinstance(v, bool))
+async def aset_txn(*args, **kwargs):
+    """
+    Asynchronous version of `set_txn`, taking the same arguments.
+    """
+    # Building the params reads the basket lines and calculates shipping
+    # charges, which may both hit the database.
+    params = await gateway.run_sync(_get_set_txn_params, *args, **kwargs)
+    txn = await _afetch_response(SET_EXPRESS_CHECKOUT, params)
+    return _get_redirect_url(txn.token)
 
-    # Remove None values
-    params = dict((k, v) for k, v in _params.items() if v is not None)
+
+def _get_set_txn_params(basket, shipping_methods, currency, return_url, cancel_url,  # noqa: C901 too complex
+                        update_url=None, action=SALE, user=None, user_address=None, shipping_method=None,
+                        shipping_address=None, no_shipping=False, paypal_params=None):
+    """
+    Return the parameters for a 'SetExpressCheckout' request
+    """
+    params = gateway.Payload(conf.get_config().set_txn_defaults)
+    if no_shipping:
+        params.pop('REQCONFIRMSHIPPING')
+    if paypal_params:
+        for key, value in paypal_params.items():
+            if value is None:
+                params.pop(key)
+                continue
+            if key == 'LOCALECODE':
+                conf.check_locale(value)
+            params[key] = int(value) if isinstance(value, bool) else value
 
     # PayPal have an upper limit on transactions.  It's in dollars which is a
     # fiddly to work with.  Lazy solution - only check when dollars are used as
@@ -191,23 +252,19 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
     })
 
     # Add item details
-    index = 0
+    index = -1
     for index, line in enumerate(basket.all_lines()):
-        product = line.product
-        params['L_PAYMENTREQUEST_0_NAME%d' % index] = product.get_title()
-        params['L_PAYMENTREQUEST_0_NUMBER%d' % index] = (product.upc if
-                                                         product.upc else '')
-        desc = ''
-        if product.description:
-            desc = _format_description(product.description)
-        params['L_PAYMENTREQUEST_0_DESC%d' % index] = desc
-        # Note, we don't include discounts here - they are handled as separate
-        # lines - see below
-        params['L_PAYMENTREQUEST_0_AMT%d' % index] = _format_currency(
-            line.unit_price_incl_tax)
-        params['L_PAYMENTREQUEST_0_QTY%d' % index] = line.quantity
-        params['L_PAYMENTREQUEST_0_ITEMCATEGORY%d' % index] = (
-            'Physical' if product.is_shipping_required else 'Digital')
+        name, number, desc, category = cache.get_product_fields(line.product, 'express', _get_product_fields)
+        params.add_item(index, (
+            ('L_PAYMENTREQUEST_0_NAME', name),
+            ('L_PAYMENTREQUEST_0_NUMBER', number),
+            ('L_PAYMENTREQUEST_0_DESC', desc),
+            # Note, we don't include discounts here - they are handled as
+            # separate lines - see below
+            ('L_PAYMENTREQUEST_0_AMT', _format_currency(line.unit_price_incl_tax)),
+            ('L_PAYMENTREQUEST_0_QTY', line.quantity),
+            ('L_PAYMENTREQUEST_0_ITEMCATEGORY', category),
+        ))
 
     # If the order has discounts associated with it, the way PayPal suggests
     # using the API is to add a separate item for the discount with the value
@@ -216,31 +273,19 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
     # https://cms.paypal.com/us/cgi-bin/?cmd=_render-content&content_ID=developer/e_howto_api_ECCustomizing
 
     # Iterate over the 3 types of discount that can occur
-    for discount in basket.offer_discounts:
-        index += 1
-        name = _("Special Offer: %s") % discount['name']
-        params['L_PAYMENTREQUEST_0_NAME%d' % index] = name
-        params['L_PAYMENTREQUEST_0_DESC%d' % index] = _format_description(name)
-        params['L_PAYMENTREQUEST_0_AMT%d' % index] = _format_currency(
-            -discount['discount'])
-        params['L_PAYMENTREQUEST_0_QTY%d' % index] = 1
-    for discount in basket.voucher_discounts:
-        index += 1
-        name = "%s (%s)" % (discount['voucher'].name,
-                            discount['voucher'].code)
-        params['L_PAYMENTREQUEST_0_NAME%d' % index] = name
-        params['L_PAYMENTREQUEST_0_DESC%d' % index] = _format_description(name)
-        params['L_PAYMENTREQUEST_0_AMT%d' % index] = _format_currency(
-            -discount['discount'])
-        params['L_PAYMENTREQUEST_0_QTY%d' % index] = 1
-    for discount in basket.shipping_discounts:
-        index += 1
-        name = _("Shipping Offer: %s") % discount['name']
-        params['L_PAYMENTREQUEST_0_NAME%d' % index] = name
-        params['L_PAYMENTREQUEST_0_DESC%d' % index] = _format_description(name)
-        params['L_PAYMENTREQUEST_0_AMT%d' % index] = _format_currency(
-            -discount['discount'])
-        params['L_PAYMENTREQUEST_0_QTY%d' % index] = 1
+    discounts = [(_("Special Offer: %s") % discount['name'], discount)
+                 for discount in basket.offer_discounts]
+    discounts += [("%s (%s)" % (discount['voucher'].name, discount['voucher'].code), discount)
+                  for discount in basket.voucher_discounts]
+    discounts += [(_("Shipping Offer: %s") % discount['name'], discount)
+                  for discount in basket.shipping_discounts]
+    for index, (name, discount) in enumerate(discounts, start=index + 1):
+        params.add_item(index, (
+            ('L_PAYMENTREQUEST_0_NAME', name),
+            ('L_PAYMENTREQUEST_0_DESC', _format_description(name)),
+            ('L_PAYMENTREQUEST_0_AMT', _format_currency(-discount['discount'])),
+            ('L_PAYMENTREQUEST_0_QTY', 1),
+        ))
 
     # We include tax in the prices rather than separately as that's how it's
     # done on most British/Australian sites.  Will need to refactor in the
@@ -256,8 +301,7 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
     #
     # Hence, if tax is to be shown then it has to be aggregated up to the order
     # level.
-    params['PAYMENTREQUEST_0_ITEMAMT'] = _format_currency(
-        basket.total_incl_tax)
+    params['PAYMENTREQUEST_0_ITEMAMT'] = _format_currency(amount)
     params['PAYMENTREQUEST_0_TAXAMT'] = _format_currency(D('0.00'))
 
     # Instant update callback information
@@ -311,20 +355,22 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
     max_charge = D('0.00')
     for index, method in enumerate(shipping_methods):
         is_default = index == 0
-        params['L_SHIPPINGOPTIONISDEFAULT%d' % index] = 'true' if is_default else 'false'
-        charge = method.calculate(basket).incl_tax
+        charge = cache.get_shipping_charge(method, basket).incl_tax
 
         if charge > max_charge:
             max_charge = charge
         if is_default:
             params['PAYMENTREQUEST_0_SHIPPINGAMT'] = _format_currency(charge)
             params['PAYMENTREQUEST_0_AMT'] += charge
-        params['L_SHIPPINGOPTIONNAME%d' % index] = str(method.name)
-        params['L_SHIPPINGOPTIONAMOUNT%d' % index] = _format_currency(charge)
+        params.add_item(index, (
+            ('L_SHIPPINGOPTIONISDEFAULT', 'true' if is_default else 'false'),
+            ('L_SHIPPINGOPTIONNAME', str(method.name)),
+            ('L_SHIPPINGOPTIONAMOUNT', _format_currency(charge)),
+        ))
 
     # Set shipping charge explicitly if it has been passed
     if shipping_method:
-        charge = shipping_method.calculate(basket).incl_tax
+        charge = cache.get_shipping_charge(shipping_method, basket).incl_tax
         params['PAYMENTREQUEST_0_SHIPPINGAMT'] = _format_currency(charge)
         params['PAYMENTREQUEST_0_AMT'] += charge
 
@@ -340,18 +386,17 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
     # Ensure that the total is formatted correctly.
     params['PAYMENTREQUEST_0_AMT'] = _format_currency(
         params['PAYMENTREQUEST_0_AMT'])
+    return params
 
-    txn = _fetch_response(SET_EXPRESS_CHECKOUT, params)
-
-    # Construct return URL
-    if getattr(settings, 'PAYPAL_SANDBOX_MODE', True):
-        url = 'https://www.sandbox.paypal.com/webscr'
-    else:
-        url = 'https://www.paypal.com/webscr'
 
+def _get_redirect_url(token):
+    """
+    Return the URL to redirect the customer to PayPal with
+    """
+    url = conf.get_config().express_redirect_url
     params = [
         ('cmd', '_express-checkout'),
-        ('token', txn.token)
+        ('token', token)
     ]
 
     if buyer_pays_on_paypal():
@@ -368,27 +413,61 @@ def get_txn(token):
     return _fetch_response(GET_EXPRESS_CHECKOUT, {'TOKEN': token})
 
 
+async def aget_txn(token):
+    """
+    Asynchronous version of `get_txn`
+    """
+    return await _afetch_response(GET_EXPRESS_CHECKOUT, {'TOKEN': token})
+
+
 def do_txn(payer_id, token, amount, currency, action=SALE):
     """
     DoExpressCheckoutPayment
     """
-    params = {
+    return _fetch_response(DO_EXPRESS_CHECKOUT, _get_do_txn_params(payer_id, token, amount, currency, action))
+
+
+async def ado_txn(payer_id, token, amount, currency, action=SALE):
+    """
+    Asynchronous version of `do_txn`
+    """
+    return await _afetch_response(DO_EXPRESS_CHECKOUT, _get_do_txn_params(payer_id, token, amount, currency, action))
+
+
+def _get_do_txn_params(payer_id, token, amount, currency, action):
+    return {
         'PAYERID': payer_id,
         'TOKEN': token,
         'PAYMENTREQUEST_0_AMT': amount,
         'PAYMENTREQUEST_0_CURRENCYCODE': currency,
         'PAYMENTREQUEST_0_PAYMENTACTION': action,
     }
-    return _fetch_response(DO_EXPRESS_CHECKOUT, params)
 
 
 def do_capture(txn_id, amount, currency, complete_type='Complete',
-               note=None):
+               note=None, token=None):
     """
     Capture payment from a previous transaction
 
+    The ``token`` of the checkout, if given, is recorded on the transaction so
+    that the capture can be found again, eg to refund it.
+
     See https://cms.paypal.com/uk/cgi-bin/?&cmd=_render-content&content_ID=developer/e_howto_api_soap_r_DoCapture
     """
+    return _fetch_response(
+        DO_CAPTURE, _get_do_capture_params(txn_id, amount, currency, complete_type, note), token)
+
+
+async def ado_capture(txn_id, amount, currency, complete_type='Complete',
+                      note=None, token=None):
+    """
+    Asynchronous version of `do_capture`
+    """
+    return await _afetch_response(
+        DO_CAPTURE, _get_do_capture_params(txn_id, amount, currency, complete_type, note), token)
+
+
+def _get_do_capture_params(txn_id, amount, currency, complete_type, note):
     params = {
         'AUTHORIZATIONID': txn_id,
         'AMT': amount,
@@ -397,23 +476,47 @@ def do_capture(txn_id, amount, currency, complete_type='Complete',
     }
     if note:
         params['NOTE'] = note
-    return _fetch_response(DO_CAPTURE, params)
+    return params
+
+
+def do_void(txn_id, note=None, token=None):
+    return _fetch_response(DO_VOID, _get_do_void_params(txn_id, note), token)
+
+
+async def ado_void(txn_id, note=None, token=None):
+    """
+    Asynchronous version of `do_void`
+    """
+    return await _afetch_response(DO_VOID, _get_do_void_params(txn_id, note), token)
 
 
-def do_void(txn_id, note=None):
+def _get_do_void_params(txn_id, note):
     params = {
         'AUTHORIZATIONID': txn_id,
     }
     if note:
         params['NOTE'] = note
-    return _fetch_response(DO_VOID, params)
+    return params
 
 
 FULL_REFUND = 'Full'
 PARTIAL_REFUND = 'Partial'
 
 
-def refund_txn(txn_id, is_partial=False, amount=None, currency=None):
+def refund_txn(txn_id, is_partial=False, amount=None, currency=None, token=None):
+    return _fetch_response(
+        REFUND_TRANSACTION, _get_refund_txn_params(txn_id, is_partial, amount, currency), token)
+
+
+async def arefund_txn(txn_id, is_partial=False, amount=None, currency=None, token=None):
+    """
+    Asynchronous version of `refund_txn`
+    """
+    return await _afetch_response(
+        REFUND_TRANSACTION, _get_refund_txn_params(txn_id, is_partial, amount, currency), token)
+
+
+def _get_refund_txn_params(txn_id, is_partial, amount, currency):
     params = {
         'TRANSACTIONID': txn_id,
         'REFUNDTYPE': PARTIAL_REFUND if is_partial else FULL_REFUND,
@@ -421,4 +524,4 @@ def refund_txn(txn_id, is_partial=False, amount=None, currency=None):
     if is_partial:
         params['AMT'] = amount
         params['CURRENCYCODE'] = currency
-    return _fetch_response(REFUND_TRANSACTION, params)
+    return params
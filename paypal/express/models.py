@@ -29,10 +29,14 @@ class ExpressTransaction(base.ResponseModel):
     class Meta:
         ordering = ('-date_created',)
         app_label = 'paypal'
+        indexes = [
+            models.Index(fields=['token', 'method'], name='paypal_exp_token_method_idx'),
+            models.Index(fields=['date_created'], name='paypal_exp_date_created_idx'),
+        ]
 
-    def save(self, *args, **kwargs):
+    def prepare_to_save(self):
         self.raw_request = re.sub(r'PWD=\d+&', 'PWD=XXXXXX&', self.raw_request)
-        return super(ExpressTransaction, self).save(*args, **kwargs)
+        super().prepare_to_save()
 
     @property
     def is_successful(self):
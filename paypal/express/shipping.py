@@ -0,0 +1,150 @@
+"""
+Calculation of shipping charges for the instant update callback.
+
+PayPal waits ``PAYPAL_CALLBACK_TIMEOUT`` seconds for the callback to respond,
+and falls back to the flat-rate shipping options sent with SetExpressCheckout
+if it doesn't.  So that one slow shipping method (eg one that looks up a
+carrier's rates) can't make the whole callback late, the charges are
+calculated in parallel and any method that isn't done in time is left out.
+
+The charges are calculated by a pool of ``PAYPAL_CALLBACK_WORKERS`` threads
+shared by all callbacks in the process.  Each method takes a slot in the pool
+until it is done, even after its callback has given up on it, and methods
+are rejected straight away while every slot is taken, so that eg a carrier
+API which hangs can't pile up threads or queued work.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.db import close_old_connections
+
+from paypal import conf
+
+logger = logging.getLogger('paypal.express')
+
+# The shared pool and its slots - see `_get_pool`
+_pool = None
+_pool_lock = threading.Lock()
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def get_budget(started):
+    """
+    Return the number of seconds left to calculate shipping charges in a
+    callback which started at ``started`` (a `time.monotonic` value), or
+    None if there is no limit.
+    """
+    config = conf.get_config()
+    if not config.callback_timeout:
+        return None
+    return config.callback_timeout - config.callback_margin - (time.monotonic() - started)
+
+
+def calculate_charges(methods, basket, budget):
+    """
+    Calculate the charge of each method for the basket, within ``budget``
+    seconds.
+
+    Return the list of (method, charge) pairs for the methods that finished
+    in time, in the order of ``methods``.
+    """
+    _count('calls')
+    if not methods:
+        return []
+    if budget is None:
+        return [(method, method.calculate(basket).incl_tax) for method in methods]
+
+    # Load the lines now, rather than in each thread
+    list(basket.all_lines())
+
+    futures = [_submit(method, basket) for method in methods]
+    rejected = futures.count(None)
+    done, not_done = wait([future for future in futures if future is not None], timeout=max(budget, 0))
+    # Methods which haven't started yet are dropped, and those which are
+    # running finish in the background
+    for future in not_done:
+        future.cancel()
+
+    charges = []
+    for method, future in zip(methods, futures):
+        if future not in done:
+            continue
+        try:
+            charges.append((method, future.result()))
+        except Exception:
+            logger.exception("Basket #%s - unable to calculate charge for shipping method %s",
+                             basket.id, method.code)
+    if rejected:
+        _count('methods_rejected', rejected)
+        logger.warning("Basket #%s - %d of %d shipping methods not calculated as all %d workers are busy",
+                       basket.id, rejected, len(methods), conf.get_config().callback_workers)
+    if not_done:
+        _count('budget_exceeded')
+        _count('methods_dropped', len(not_done))
+        logger.warning("Basket #%s - %d of %d shipping methods not calculated within %.2fs",
+                       basket.id, len(not_done), len(methods), budget)
+    return charges
+
+
+def get_stats():
+    """
+    Return counts of the ``calls`` to `calculate_charges`, the number of
+    times the budget was exceeded and the number of methods left out as a
+    result, and the number of methods rejected as the pool was busy.
+    """
+    with _stats_lock:
+        return {key: _stats[key] for key in ('calls', 'budget_exceeded', 'methods_dropped', 'methods_rejected')}
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def _count(key, value=1):
+    with _stats_lock:
+        _stats[key] += value
+
+
+def _submit(method, basket):
+    # Return the future of the method's charge, or None if every slot of the
+    # pool is taken
+    executor, slots = _get_pool()
+    if not slots.acquire(blocking=False):
+        return None
+    try:
+        future = executor.submit(_calculate, method, basket)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda future: slots.release())
+    return future
+
+
+def _get_pool():
+    # The pool is replaced if PAYPAL_CALLBACK_WORKERS changes, leaving the
+    # old one to finish the methods it is running
+    global _pool
+    workers = conf.get_config().callback_workers
+    pool = _pool
+    if pool is None or pool[0] != workers:
+        with _pool_lock:
+            if _pool is None or _pool[0] != workers:
+                if _pool is not None:
+                    _pool[1].shutdown(wait=False)
+                _pool = (workers, ThreadPoolExecutor(max_workers=workers, thread_name_prefix='paypal-shipping'),
+                         threading.BoundedSemaphore(workers))
+            pool = _pool
+    return pool[1:]
+
+
+def _calculate(method, basket):
+    try:
+        return method.calculate(basket).incl_tax
+    finally:
+        close_old_connections()
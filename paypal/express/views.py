@@ -1,9 +1,12 @@
+import hashlib
 import logging
+import time
 from decimal import Decimal as D
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
 from django.http import HttpResponse, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse
@@ -15,11 +18,14 @@ from oscar.apps.shipping.methods import FixedPrice, NoShippingRequired
 from oscar.core.exceptions import ModuleNotFoundError
 from oscar.core.loading import get_class, get_model
 
+from paypal import cache, circuit, conf
 from paypal.exceptions import PayPalError
+from paypal.express import shipping
 from paypal.express.exceptions import (
     EmptyBasketException, InvalidBasket, MissingShippingAddressException, MissingShippingMethodException)
 from paypal.express.facade import confirm_transaction, fetch_transaction_details, get_paypal_url
 from paypal.express.gateway import buyer_pays_on_paypal
+from paypal.views import DeadlineMixin, ShippingChargeMixin
 
 # Load views dynamically
 PaymentDetailsView = get_class('checkout.views', 'PaymentDetailsView')
@@ -28,10 +34,10 @@ CheckoutSessionMixin = get_class('checkout.session', 'CheckoutSessionMixin')
 ShippingAddress = get_model('order', 'ShippingAddress')
 Country = get_model('address', 'Country')
 Basket = get_model('basket', 'Basket')
+ConditionalOffer = get_model('offer', 'ConditionalOffer')
 Repository = get_class('shipping.repository', 'Repository')
 Selector = get_class('partner.strategy', 'Selector')
 Source = get_model('payment', 'Source')
-SourceType = get_model('payment', 'SourceType')
 try:
     Applicator = get_class('offer.applicator', 'Applicator')
 except ModuleNotFoundError:
@@ -41,7 +47,7 @@ except ModuleNotFoundError:
 logger = logging.getLogger('paypal.express')
 
 
-class RedirectView(CheckoutSessionMixin, RedirectView):
+class RedirectView(DeadlineMixin, ShippingChargeMixin, CheckoutSessionMixin, RedirectView):
     """
     Initiate the transaction with Paypal and redirect the user
     to PayPal's Express Checkout to perform the transaction.
@@ -53,12 +59,17 @@ class RedirectView(CheckoutSessionMixin, RedirectView):
     # basket page but True when redirecting from checkout.
     as_payment_method = False
 
+    error_message = _("A problem occurred communicating with PayPal - please try again later")
+
     def get_redirect_url(self, **kwargs):
         try:
             basket = self.build_submission()['basket']
             url = self._get_redirect_url(basket, **kwargs)
         except PayPalError as ppe:
-            messages.error(self.request, str(ppe))
+            if circuit.is_open_error(ppe):
+                messages.error(self.request, self.error_message)
+            else:
+                messages.error(self.request, str(ppe))
             if self.as_payment_method:
                 url = reverse('checkout:payment-details')
             else:
@@ -160,7 +171,7 @@ class CancelResponseView(RedirectView):
 # Upgrading notes: when we drop support for Oscar 0.6, this class can be
 # refactored to pass variables around more explicitly (instead of assigning
 # things to self so they are accessible in a later method).
-class SuccessResponseView(PaymentDetailsView):
+class SuccessResponseView(DeadlineMixin, ShippingChargeMixin, PaymentDetailsView):
     template_name_preview = 'paypal/express/preview.html'
     preview = True
 
@@ -186,7 +197,7 @@ class SuccessResponseView(PaymentDetailsView):
             return redirect('basket:summary')
 
         try:
-            self.txn = fetch_transaction_details(self.token)
+            self.txn = fetch_transaction_details(self.token, self.payer_id)
         except PayPalError as e:
             logger.warning("Unable to fetch transaction details for token %s: %s", self.token, e)
             messages.error(self.request, self.error_message)
@@ -244,8 +255,9 @@ class SuccessResponseView(PaymentDetailsView):
         """
         Place an order.
 
-        We fetch the txn details again and then proceed with oscar's standard
-        payment details view for placing the order.
+        We fetch the txn details again (unless they were cached for the
+        preview) and then proceed with oscar's standard payment details view
+        for placing the order.
         """
         if buyer_pays_on_paypal():
             return HttpResponseBadRequest()  # we don't expect any user here if we let users buy on PayPal
@@ -259,7 +271,7 @@ class SuccessResponseView(PaymentDetailsView):
             return redirect('basket:summary')
 
         try:
-            self.txn = fetch_transaction_details(self.token)
+            self.txn = fetch_transaction_details(self.token, self.payer_id, use_cache=True)
         except PayPalError:
             # Unable to fetch txn details from PayPal - we have to bail out
             messages.error(self.request, self.error_message)
@@ -300,8 +312,7 @@ class SuccessResponseView(PaymentDetailsView):
             raise UnableToTakePayment()
 
         # Record payment source and event
-        source_type, is_created = SourceType.objects.get_or_create(
-            name='PayPal')
+        source_type = cache.get_source_type('PayPal')
         source = Source(source_type=source_type,
                         currency=confirm_txn.currency,
                         amount_allocated=confirm_txn.amount,
@@ -316,8 +327,12 @@ class SuccessResponseView(PaymentDetailsView):
         Return a created shipping address instance, created using
         the data returned by PayPal.
         """
+        ship_to_name, line1, country_code = self.txn.values(
+            'PAYMENTREQUEST_0_SHIPTONAME',
+            'PAYMENTREQUEST_0_SHIPTOSTREET',
+            'PAYMENTREQUEST_0_SHIPTOCOUNTRYCODE',
+        )
         # Determine names - PayPal uses a single field
-        ship_to_name = self.txn.value('PAYMENTREQUEST_0_SHIPTONAME')
         if ship_to_name is None:
             return None
         first_name = last_name = ''
@@ -327,16 +342,24 @@ class SuccessResponseView(PaymentDetailsView):
         elif len(parts) > 1:
             first_name = parts[0]
             last_name = " ".join(parts[1:])
+        line2, line4, state, postcode, phone_number = self.txn.values(
+            'PAYMENTREQUEST_0_SHIPTOSTREET2',
+            'PAYMENTREQUEST_0_SHIPTOCITY',
+            'PAYMENTREQUEST_0_SHIPTOSTATE',
+            'PAYMENTREQUEST_0_SHIPTOZIP',
+            'PAYMENTREQUEST_0_SHIPTOPHONENUM',
+            default="",
+        )
         return ShippingAddress(
             first_name=first_name,
             last_name=last_name,
-            line1=self.txn.value('PAYMENTREQUEST_0_SHIPTOSTREET'),
-            line2=self.txn.value('PAYMENTREQUEST_0_SHIPTOSTREET2', default=""),
-            line4=self.txn.value('PAYMENTREQUEST_0_SHIPTOCITY', default=""),
-            state=self.txn.value('PAYMENTREQUEST_0_SHIPTOSTATE', default=""),
-            postcode=self.txn.value('PAYMENTREQUEST_0_SHIPTOZIP', default=""),
-            country=Country.objects.get(iso_3166_1_a2=self.txn.value('PAYMENTREQUEST_0_SHIPTOCOUNTRYCODE')),
-            phone_number=self.txn.value('PAYMENTREQUEST_0_SHIPTOPHONENUM', default=""),
+            line1=line1,
+            line2=line2,
+            line4=line4,
+            state=state,
+            postcode=postcode,
+            country=cache.get_country(country_code),
+            phone_number=phone_number,
         )
 
     def _get_shipping_method_by_name(self, name, basket, shipping_address=None):
@@ -352,7 +375,7 @@ class SuccessResponseView(PaymentDetailsView):
         Return the shipping method used
         """
         if not basket.is_shipping_required():
-            return NoShippingRequired()
+            return cache.memoize_shipping_charge(NoShippingRequired())
 
         # Instantiate a new FixedPrice shipping method instance
         charge_incl_tax = D(self.txn.value('PAYMENTREQUEST_0_SHIPPINGAMT'))
@@ -375,12 +398,27 @@ class SuccessResponseView(PaymentDetailsView):
                     method.code = session_method.code
         else:
             method = session_method
-        return method
+        return cache.memoize_shipping_charge(method)
 
 
 class ShippingOptionsView(View):
+    """
+    Instant update callback, which PayPal calls with the buyer's shipping
+    address to get the available shipping options and their charges.
+
+    PayPal may call it several times for the same basket and address, so the
+    response is cached for ``PAYPAL_SHIPPING_OPTIONS_CACHE_TIMEOUT`` seconds.
+    The shipping charges are calculated within the time PayPal waits for the
+    callback - see `paypal.express.shipping`.
+    """
 
     def get(self, request, *args, **kwargs):
+        return self.get_response(self.request.GET, kwargs['basket_id'])
+
+    def post(self, request, *args, **kwargs):
+        return self.get_response(self.request.POST, kwargs['basket_id'])
+
+    def get_response(self, data, basket_id):
         """
         We use the shipping address given to use by PayPal to
         determine the available shipping method
@@ -390,78 +428,118 @@ class ShippingOptionsView(View):
         # pass back details of the basket contents but it would be royal pain to
         # reconstitute the basket based on those - easier to just to piggy-back
         # the basket ID in the callback URL.
-        basket = get_object_or_404(Basket, id=kwargs['basket_id'])
+        started = time.monotonic()
+        basket = get_object_or_404(Basket, id=basket_id)
         user = basket.owner
         if not user:
             user = AnonymousUser()
 
+        config = conf.get_config()
+        response_cache = caches[config.shipping_options_cache] if config.shipping_options_cache_timeout else None
+        if response_cache is not None:
+            key = self.get_cache_key(basket, data)
+            payload = response_cache.get(key)
+            if payload is not None:
+                logger.debug("Basket #%s - returning cached postage costs payload = '%s'", basket.id, payload)
+                return HttpResponse(payload)
+
+        # Price the basket and apply its offers and vouchers, as the checkout
+        # does, so that the shipping methods see the same basket as the buyer
+        basket.strategy = Selector().strategy(request=self.request, user=user)
+        Applicator().apply(basket, user, request=self.request)
+
         # Create a shipping address instance using the data passed back
-        country_code = self.request.GET.get(
+        country_code = data.get(
             'SHIPTOCOUNTRY', None)
         try:
-            country = Country.objects.get(iso_3166_1_a2=country_code)
+            country = cache.get_country(country_code)
         except Country.DoesNotExist:
             country = Country()
 
         shipping_address = ShippingAddress(
-            line1=self.request.GET.get('SHIPTOSTREET', ''),
-            line2=self.request.GET.get('SHIPTOSTREET2', ''),
-            line4=self.request.GET.get('SHIPTOCITY', ''),
-            state=self.request.GET.get('SHIPTOSTATE', ''),
-            postcode=self.request.GET.get('SHIPTOZIP', ''),
+            line1=data.get('SHIPTOSTREET', ''),
+            line2=data.get('SHIPTOSTREET2', ''),
+            line4=data.get('SHIPTOCITY', ''),
+            state=data.get('SHIPTOSTATE', ''),
+            postcode=data.get('SHIPTOZIP', ''),
             country=country
         )
         methods = Repository().get_shipping_methods(
             basket=basket, shipping_addr=shipping_address,
             request=self.request, user=user)
-        return self.render_to_response(methods, basket)
+        charges = shipping.calculate_charges(methods, basket, shipping.get_budget(started))
+        if methods and not charges:
+            return self.render_fallback_response(basket, started)
+        response = self.render_to_response([method for method, __ in charges], basket,
+                                           charges=[charge for __, charge in charges])
+        # Don't keep a response which is missing the methods that were late
+        if response_cache is not None and len(charges) == len(methods):
+            response_cache.set(key, response.content.decode(), config.shipping_options_cache_timeout)
+        return response
+
+    def get_cache_key(self, basket, data):
+        """
+        Return the cache key for the shipping options of the basket, which
+        covers its owner, contents and vouchers, the offers which are running
+        and the shipping address.
 
-    def post(self, request, *args, **kwargs):
+        The key is built without applying the offers, so that a cached
+        response is returned cheaply. Changes to an offer which keep it
+        running, eg a new discount, are picked up once the response expires.
         """
-        We use the shipping address given to use by PayPal to
-        determine the available shipping method
+        lines = list(basket.lines.order_by('pk').values_list(
+            'product_id', 'stockrecord_id', 'quantity', 'price_incl_tax'))
+        vouchers = list(basket.vouchers.order_by('pk').values_list('pk', flat=True))
+        offers = list(ConditionalOffer.active.order_by('pk').values_list('pk', flat=True))
+        address = [' '.join(data.get(name, '').split()).upper() for name in (
+            'SHIPTOSTREET', 'SHIPTOSTREET2', 'SHIPTOCITY', 'SHIPTOSTATE', 'SHIPTOZIP', 'SHIPTOCOUNTRY')]
+        # The postcode is compared without spaces, eg 'W12 4LQ' and 'W124LQ'
+        address[4] = address[4].replace(' ', '')
+        key = repr((basket.owner_id, lines, vouchers, offers, address,
+                    self.request.POST.get('CURRENCYCODE', 'GBP')))
+        return 'paypal-shipping-options-%s-%s' % (
+            basket.id, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def render_fallback_response(self, basket, started):
         """
-        # Basket ID is passed within the URL path.  We need to do this as some
-        # shipping options depend on the user and basket contents.  PayPal do
-        # pass back details of the basket contents but it would be royal pain to
-        # reconstitute the basket based on those - easier to just to piggy-back
-        # the basket ID in the callback URL.
-        basket = get_object_or_404(Basket, id=kwargs['basket_id'])
-        user = basket.owner
-        if not user:
-            user = AnonymousUser()
-
-        # Create a shipping address instance using the data passed back
-        country_code = self.request.POST.get(
-            'SHIPTOCOUNTRY', None)
-        try:
-            country = Country.objects.get(iso_3166_1_a2=country_code)
-        except Country.DoesNotExist:
-            country = Country()
+        Return a response for when none of the shipping methods could be
+        calculated (in time), once PayPal has stopped waiting for it.
+
+        PayPal only uses the flat-rate options sent with SetExpressCheckout
+        if the callback times out - an answer without any options would tell
+        the buyer that we don't ship to their address.  So the response is
+        held back until ``PAYPAL_CALLBACK_TIMEOUT`` seconds after the callback
+        started (a `time.monotonic` value).
+        """
+        timeout = conf.get_config().callback_timeout
+        if timeout:
+            delay = timeout - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        pairs = [
+            ('METHOD', 'CallbackResponse'),
+            ('CALLBACKVERSION', '61.0'),
+            ('CURRENCYCODE', self.request.POST.get('CURRENCYCODE', 'GBP')),
+        ]
+        logger.warning("Basket #%s - letting the callback time out so that PayPal uses the flat-rate "
+                       "postage costs", basket.id)
+        return HttpResponse(urlencode(pairs))
 
-        shipping_address = ShippingAddress(
-            line1=self.request.POST.get('SHIPTOSTREET', ''),
-            line2=self.request.POST.get('SHIPTOSTREET2', ''),
-            line4=self.request.POST.get('SHIPTOCITY', ''),
-            state=self.request.POST.get('SHIPTOSTATE', ''),
-            postcode=self.request.POST.get('SHIPTOZIP', ''),
-            country=country
-        )
-        methods = Repository().get_shipping_methods(
-            basket=basket, shipping_addr=shipping_address,
-            request=self.request, user=user)
-        return self.render_to_response(methods, basket)
+    def render_to_response(self, methods, basket, charges=None):
+        """
+        Return the callback response for the shipping methods.
 
-    def render_to_response(self, methods, basket):
+        :charges: The charge (incl. tax) of each method, if already calculated
+        """
+        if charges is None:
+            charges = [method.calculate(basket).incl_tax for method in methods]
         pairs = [
             ('METHOD', 'CallbackResponse'),
             ('CALLBACKVERSION', '61.0'),
             ('CURRENCYCODE', self.request.POST.get('CURRENCYCODE', 'GBP')),
         ]
         if methods:
-            for index, method in enumerate(methods):
-                charge = method.calculate(basket).incl_tax
-
+            for index, (method, charge) in enumerate(zip(methods, charges)):
                 pairs.append(('L_SHIPPINGOPTIONNAME%d' % index,
                               str(method.name)))
                 pairs.append(('L_SHIPPINGOPTIONLABEL%d' % index,
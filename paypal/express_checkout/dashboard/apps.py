@@ -19,5 +19,7 @@ class ExpressCheckoutDashboardApplication(OscarDashboardConfig):
                  name='paypal-transaction-list'),
             path('transactions/<int:pk>/', views.TransactionDetailView.as_view(),
                  name='paypal-transaction-detail'),
+            path('transactions/export/', views.TransactionExportView.as_view(),
+                 name='paypal-transaction-export'),
         ]
         return self.post_process_urls(urlpatterns)
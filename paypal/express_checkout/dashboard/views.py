@@ -1,6 +1,8 @@
 from django.views import generic
 
+from paypal import export
 from paypal.express_checkout import models
+from paypal.views import TransactionExportMixin
 
 
 class TransactionListView(generic.ListView):
@@ -9,6 +11,10 @@ class TransactionListView(generic.ListView):
     context_object_name = 'transactions'
 
 
+class TransactionExportView(TransactionExportMixin, generic.View):
+    integration = export.EXPRESS_CHECKOUT
+
+
 class TransactionDetailView(generic.DetailView):
     model = models.ExpressCheckoutTransaction
     template_name = 'paypal/express_checkout/dashboard/transaction_detail.html'
@@ -3,9 +3,11 @@ import json
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.exceptions import ImproperlyConfigured
+from django.db.transaction import atomic
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 
+from paypal import cache
 from paypal.express_checkout.gateway import PaymentProcessor, buyer_pays_on_paypal
 from paypal.express_checkout.models import ExpressCheckoutTransaction as Transaction
 
@@ -57,7 +59,7 @@ def get_paypal_url(basket, user=None, shipping_address=None, shipping_method=Non
     shipping_charge = None
     order_total = basket.total_incl_tax
     if shipping_method:
-        shipping_charge = shipping_method.calculate(basket).incl_tax
+        shipping_charge = cache.get_shipping_charge(shipping_method, basket).incl_tax
         order_total += shipping_charge
 
     intent = get_intent()
@@ -86,31 +88,46 @@ def get_paypal_url(basket, user=None, shipping_address=None, shipping_method=Non
             return link.href
 
 
-def fetch_transaction_details(token):
+def fetch_transaction_details(token, lock=False):
     """
     Fetch the details about the PayPal transaction.
+
+    With ``lock``, the transaction's row is locked (``SELECT ... FOR UPDATE``)
+    until the details are saved, so that concurrent requests for the same
+    order (eg a double-clicked 'Place order' button) don't fetch or authorize
+    it twice.
     """
+    if lock:
+        with atomic():
+            return _fetch_transaction_details(Transaction.objects.select_for_update().get(order_id=token))
+    return _fetch_transaction_details(Transaction.objects.get(order_id=token))
 
-    transaction = Transaction.objects.get(order_id=token)
 
+def _fetch_transaction_details(transaction):
+    fields = []
+
+    # The payer's details don't change once the order is approved
     if not transaction.payer_id:
-        result = PaymentProcessor().get_order(token)
+        result = PaymentProcessor().get_order(transaction.order_id)
         transaction.payer_id = result.payer.payer_id
         transaction.email = result.payer.email_address
         transaction.status = result.status
+        fields += ['payer_id', 'email', 'status']
         try:
             transaction.address_full_name = result.purchase_units[0].shipping.name.full_name
             transaction.address = json.dumps(result.purchase_units[0].shipping.address.dict())
+            fields += ['address_full_name', 'address']
         except AttributeError:
             pass
-        transaction.save()
 
     if transaction.is_authorization and not transaction.authorization_id:
         result = PaymentProcessor().authorize_order(transaction.order_id)
         transaction.authorization_id = result.purchase_units[0].payments.authorizations[0].id
         transaction.status = result.status
-        transaction.save()
+        fields += ['authorization_id', 'status']
 
+    if fields:
+        transaction.save(update_fields=set(fields))
     return transaction
 
 
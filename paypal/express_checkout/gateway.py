@@ -1,13 +1,30 @@
+import copy
+import hashlib
+import threading
+import time
+import uuid
 from decimal import Decimal as D
 
+import requests
 from django.conf import settings
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
 from django.template.defaultfilters import striptags, truncatechars
-from django.utils.translation import gettext_lazy as _
-from paypalcheckoutsdk.core import LiveEnvironment, PayPalHttpClient, SandboxEnvironment
+from paypalcheckoutsdk.core import (
+    AccessToken, AccessTokenRequest, LiveEnvironment, PayPalEnvironment, PayPalHttpClient, RefreshTokenRequest,
+    SandboxEnvironment)
 from paypalcheckoutsdk.orders import (
     OrdersAuthorizeRequest, OrdersCaptureRequest, OrdersCreateRequest, OrdersGetRequest)
 from paypalcheckoutsdk.payments import AuthorizationsCaptureRequest, AuthorizationsVoidRequest, CapturesRefundRequest
+from paypalhttp.http_error import HttpError
+
+from paypal import cache, circuit, conf, gateway, instrumentation
+from paypal.exceptions import PayPalError
+
+try:
+    import httpx
+except ImportError:  # The async API is optional
+    httpx = None
 
 INTENT_AUTHORIZE = 'AUTHORIZE'
 INTENT_CAPTURE = 'CAPTURE'
@@ -24,7 +41,7 @@ LANDING_PAGE_NO_PREFERENCE = 'NO_PREFERENCE'
 USER_ACTION_CONTINUE = 'CONTINUE'
 USER_ACTION_PAY_NOW = 'PAY_NOW'
 
-buyer_pays_on_paypal = lambda: getattr(settings, 'PAYPAL_BUYER_PAYS_ON_PAYPAL', False)
+buyer_pays_on_paypal = lambda: conf.get_config().buyer_pays_on_paypal
 
 
 def format_description(description):
@@ -35,29 +52,299 @@ def format_amount(amount):
     return str(amount.quantize(D('0.01')))
 
 
+def get_product_fields(product):
+    """
+    Return the fields of an order item that only depend on the product
+    """
+    return {
+        'name': product.get_title(),
+        'description': format_description(product.description),
+        'sku': product.upc if product.upc else '',
+        'category': 'PHYSICAL_GOODS' if product.is_shipping_required else 'DIGITAL_GOODS',
+    }
+
+
 def get_landing_page():
-    landing_page = getattr(settings, 'PAYPAL_LANDING_PAGE', LANDING_PAGE_NO_PREFERENCE)
-    if landing_page not in (LANDING_PAGE_LOGIN, LANDING_PAGE_BILLING, LANDING_PAGE_NO_PREFERENCE):
-        message = _("'%s' is not a valid landing page") % landing_page
-        raise ImproperlyConfigured(message)
-    return landing_page
+    # Validated when the config is built
+    return conf.get_config().landing_page
+
+
+# OAuth access tokens shared by all clients in this process, keyed by
+# environment.  Each value is a (access_token, token_type, expires_at) tuple.
+_access_tokens = {}
+_access_tokens_lock = threading.Lock()
+
+# Held while fetching a new token from PayPal
+_access_token_fetch_lock = threading.Lock()
+
+
+def _get_access_token_key(environment):
+    key = '%s|%s' % (environment.base_url, environment.client_id)
+    return 'paypal-access-token-%s' % hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _get_access_token_cache():
+    alias = getattr(settings, 'PAYPAL_ACCESS_TOKEN_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def get_access_token(environment):
+    """
+    Return a cached access token for the environment, or None if there isn't
+    one that is still valid.
+    """
+    key = _get_access_token_key(environment)
+    with _access_tokens_lock:
+        value = _access_tokens.get(key)
+        if value is not None and value[2] <= time.time():
+            # Another process may have fetched a new token since
+            del _access_tokens[key]
+            value = None
+    if value is None:
+        cache = _get_access_token_cache()
+        if cache is not None:
+            value = cache.get(key)
+            if value is not None and value[2] > time.time():
+                with _access_tokens_lock:
+                    _access_tokens[key] = value
+
+    if value is None:
+        return None
+    access_token, token_type, expires_at = value
+    expires_in = expires_at - time.time()
+    if expires_in <= 0:
+        return None
+    return AccessToken(access_token=access_token, expires_in=expires_in, token_type=token_type)
+
+
+def set_access_token(environment, token):
+    """
+    Cache an access token for the environment.
+
+    The token is treated as expired ``PAYPAL_ACCESS_TOKEN_REFRESH_MARGIN``
+    seconds before PayPal would expire it, so that it is never used right up
+    to the end of its lifetime.  Return the token with its shortened lifetime.
+    """
+    margin = getattr(settings, 'PAYPAL_ACCESS_TOKEN_REFRESH_MARGIN', 60)
+    expires_at = token.created_at + token.expires_in - margin
+    value = (token.access_token, token.token_type, expires_at)
+    key = _get_access_token_key(environment)
+    with _access_tokens_lock:
+        _access_tokens[key] = value
+    cache = _get_access_token_cache()
+    timeout = int(expires_at - time.time())
+    if cache is not None and timeout > 0:
+        cache.set(key, value, timeout)
+    return AccessToken(
+        access_token=token.access_token, expires_in=expires_at - token.created_at,
+        token_type=token.token_type)
+
+
+def discard_access_token(environment, access_token):
+    """
+    Stop using an access token which PayPal has rejected, unless it has been
+    replaced already.
+    """
+    key = _get_access_token_key(environment)
+    with _access_tokens_lock:
+        value = _access_tokens.get(key)
+        if value is not None and value[0] == access_token:
+            del _access_tokens[key]
+    cache = _get_access_token_cache()
+    if cache is not None:
+        value = cache.get(key)
+        if value is not None and value[0] == access_token:
+            cache.delete(key)
+
+
+def clear_access_tokens():
+    with _access_tokens_lock:
+        _access_tokens.clear()
+
+
+class HttpClient(PayPalHttpClient):
+    """
+    PayPal SDK client which sends requests through the shared HTTP session.
+
+    Unlike the SDK client, requests are made with the timeouts configured for
+    the operation and connection problems are raised as ``HttpError`` so that
+    callers only need to handle one type of exception.  Each request is sent
+    with a ``PayPal-Request-Id`` and retried if PayPal can't be reached or has
+    a server error, and goes through the circuit breaker of the operation.
+    OAuth access tokens are shared between clients rather than fetched for
+    every new client, and a request which PayPal rejects as unauthorized is
+    sent once more with a new token.
+    """
+
+    def __call__(self, request):
+        if not self._uses_shared_token(request):
+            return super().__call__(request)
+
+        if self._access_token is None or self._access_token.is_expired():
+            self._access_token = get_access_token(self.environment)
+        if self._access_token is not None and not self._access_token.is_expired():
+            return super().__call__(request)
+
+        # Only one request in the process fetches a new token, the others
+        # wait for it
+        with _access_token_fetch_lock:
+            self._access_token = get_access_token(self.environment)
+            token = self._access_token
+            # Fetches a new token from PayPal if there still isn't a valid one
+            super().__call__(request)
+            if self._access_token is not token:
+                self._access_token = set_access_token(self.environment, self._access_token)
+
+    def execute(self, request, operation=None):
+        try:
+            return self._execute(request, operation)
+        except HttpError as e:
+            if not self._is_rejected_token(e, request):
+                raise
+            # PayPal has revoked the token before it expired
+            self._discard_access_token()
+            return self._execute(request, operation)
+
+    def _execute(self, request, operation):
+        request, data = self._prepare_request(request)
+        with instrumentation.measure(operation or type(request).__name__, self.environment.base_url) as call:
+            response = gateway.call_with_retries(lambda: self._send(request, data, operation), operation, (HttpError,))
+            call.outcome = str(response.status_code)
+        return response
+
+    def _send(self, request, data, operation):
+        instrumentation.record_payload(data)
+        try:
+            timeout = gateway.get_timeout(operation)
+            with circuit.guard(self.environment.base_url, operation):
+                try:
+                    response = gateway.get_session().request(
+                        method=request.verb,
+                        url=self.environment.base_url + request.path,
+                        headers=request.headers,
+                        data=data,
+                        timeout=timeout)
+                except requests.RequestException:
+                    raise HttpError("Unable to communicate with PayPal", None, {})
+                return self.parse_response(response)
+        except PayPalError as e:
+            raise HttpError(str(e), None, {}) from e
+
+    async def aexecute(self, request, operation=None):
+        """
+        Asynchronous version of `execute`
+        """
+        try:
+            return await self._aexecute(request, operation)
+        except HttpError as e:
+            if not self._is_rejected_token(e, request):
+                raise
+            self._discard_access_token()
+            return await self._aexecute(request, operation)
+
+    async def _aexecute(self, request, operation):
+        if not self._has_valid_access_token(request):
+            # Fetch the token here, as the injectors would fetch it synchronously
+            self._access_token = get_access_token(self.environment)
+            if self._access_token is None:
+                token_request = AccessTokenRequest(self.environment, self._refresh_token)
+                result = (await self.aexecute(token_request, operation='access_token')).result
+                self._access_token = set_access_token(self.environment, AccessToken(
+                    access_token=result.access_token, expires_in=result.expires_in,
+                    token_type=result.token_type))
+
+        request, data = self._prepare_request(request)
+        with instrumentation.measure(operation or type(request).__name__, self.environment.base_url) as call:
+            response = await gateway.acall_with_retries(
+                lambda: self._asend(request, data, operation), operation, (HttpError,))
+            call.outcome = str(response.status_code)
+        return response
+
+    async def _asend(self, request, data, operation):
+        client = gateway.get_async_client()
+        instrumentation.record_payload(data)
+        try:
+            timeout = gateway.get_httpx_timeout(gateway.get_timeout(operation))
+            with circuit.guard(self.environment.base_url, operation):
+                try:
+                    response = await client.request(
+                        method=request.verb,
+                        url=self.environment.base_url + request.path,
+                        headers=request.headers,
+                        content=data,
+                        timeout=timeout)
+                except httpx.HTTPError:
+                    raise HttpError("Unable to communicate with PayPal", None, {})
+                return self.parse_response(response)
+        except PayPalError as e:
+            raise HttpError(str(e), None, {}) from e
+
+    def _has_valid_access_token(self, request):
+        if not self._uses_shared_token(request):
+            return True
+        return self._access_token is not None and not self._access_token.is_expired()
+
+    def _uses_shared_token(self, request):
+        return not ('Authorization' in getattr(request, 'headers', {})
+                    or isinstance(request, (AccessTokenRequest, RefreshTokenRequest)))
+
+    def _is_rejected_token(self, error, request):
+        # Not when fetching the token failed, as a new one wouldn't help
+        return error.status_code == 401 and self._access_token is not None and self._uses_shared_token(request)
+
+    def _discard_access_token(self):
+        discard_access_token(self.environment, self._access_token.access_token)
+        self._access_token = None
+
+    def _prepare_request(self, request):
+        request = copy.deepcopy(request)
+        if not hasattr(request, 'headers'):
+            request.headers = {}
+
+        for injector in self._injectors:
+            injector(request)
+
+        formatted_headers = self.format_headers(request.headers)
+        if 'user-agent' not in formatted_headers:
+            request.headers['user-agent'] = self.get_user_agent()
+        # PayPal returns the result of the first request for a repeated
+        # request ID rather than eg capturing an order again, which makes
+        # POST requests safe to retry
+        is_token_request = isinstance(request, (AccessTokenRequest, RefreshTokenRequest))
+        if request.verb != 'GET' and not is_token_request and 'paypal-request-id' not in formatted_headers:
+            request.headers['PayPal-Request-Id'] = str(uuid.uuid4())
+
+        data = None
+        if getattr(request, 'body', None) is not None:
+            raw_headers = request.headers
+            request.headers = formatted_headers
+            data = self.encoder.serialize_request(request)
+            request.headers = self.map_headers(raw_headers, formatted_headers)
+        return request, data
 
 
 class PaymentProcessor:
     client = None
 
     def __init__(self):
+        config = conf.get_config()
+        if config.client_id is None:
+            raise ImproperlyConfigured(
+                "You must define the PAYPAL_CLIENT_ID and PAYPAL_CLIENT_SECRET settings")
         credentials = {
-            'client_id': settings.PAYPAL_CLIENT_ID,
-            'client_secret': settings.PAYPAL_CLIENT_SECRET,
+            'client_id': config.client_id,
+            'client_secret': config.client_secret,
         }
 
-        if getattr(settings, 'PAYPAL_SANDBOX_MODE', True):
+        if config.sandbox_mode:
             environment = SandboxEnvironment(**credentials)
         else:
             environment = LiveEnvironment(**credentials)
 
-        self.client = PayPalHttpClient(environment)
+        if config.rest_api_url is not None:
+            environment = PayPalEnvironment(apiUrl=config.rest_api_url, webUrl=environment.web_url, **credentials)
+
+        self.client = HttpClient(environment)
 
     def build_order_create_request_body(
             self, basket, currency, return_url, cancel_url, order_total,
@@ -71,8 +358,9 @@ class PaymentProcessor:
             'user_action': 'PAY_NOW' if buyer_pays_on_paypal() else 'CONTINUE',
         }
 
-        if getattr(settings, 'PAYPAL_BRAND_NAME', None) is not None:
-            application_context['brand_name'] = settings.PAYPAL_BRAND_NAME
+        brand_name = conf.get_config().brand_name
+        if brand_name is not None:
+            application_context['brand_name'] = brand_name
 
         breakdown = {
             'item_total': {
@@ -113,18 +401,12 @@ class PaymentProcessor:
 
         items = []
         for line in basket.all_lines():
-            product = line.product
-            item = {
-                'name': product.get_title(),
-                'description': format_description(product.description),
-                'sku': product.upc if product.upc else '',
-                'unit_amount': {
-                    'currency_code': currency,
-                    'value': format_amount(line.unit_price_incl_tax)
-                },
-                'quantity': line.quantity,
-                'category': 'PHYSICAL_GOODS' if product.is_shipping_required else 'DIGITAL_GOODS'
+            item = dict(cache.get_product_fields(line.product, 'express_checkout', get_product_fields))
+            item['unit_amount'] = {
+                'currency_code': currency,
+                'value': format_amount(line.unit_price_incl_tax)
             }
+            item['quantity'] = line.quantity
             items.append(item)
 
         purchase_unit['items'] = items
@@ -163,9 +445,7 @@ class PaymentProcessor:
             self, basket, currency, return_url, cancel_url, order_total,
             address=None, shipping_charge=None, intent=None, preferred_response='minimal',
     ):
-        request = OrdersCreateRequest()
-        request.prefer(f'return={preferred_response}')
-        request.request_body(self.build_order_create_request_body(
+        body = self.build_order_create_request_body(
             basket=basket,
             currency=currency,
             return_url=return_url,
@@ -174,39 +454,102 @@ class PaymentProcessor:
             intent=intent,
             address=address,
             shipping_charge=shipping_charge,
-        ))
-        response = self.client.execute(request)
+        )
+        request = self._get_create_order_request(body, preferred_response)
+        response = self.client.execute(request, operation='create_order')
         return response.result
 
+    async def acreate_order(
+            self, basket, currency, return_url, cancel_url, order_total,
+            address=None, shipping_charge=None, intent=None, preferred_response='minimal',
+    ):
+        # Building the body reads the basket lines from the database
+        body = await gateway.run_sync(
+            self.build_order_create_request_body,
+            basket=basket,
+            currency=currency,
+            return_url=return_url,
+            cancel_url=cancel_url,
+            order_total=order_total,
+            intent=intent,
+            address=address,
+            shipping_charge=shipping_charge,
+        )
+        request = self._get_create_order_request(body, preferred_response)
+        response = await self.client.aexecute(request, operation='create_order')
+        return response.result
+
+    def _get_create_order_request(self, body, preferred_response):
+        request = OrdersCreateRequest()
+        request.prefer(f'return={preferred_response}')
+        request.request_body(body)
+        return request
+
     def get_order(self, token):
         request = OrdersGetRequest(token)
-        response = self.client.execute(request)
+        response = self.client.execute(request, operation='get_order')
+        return response.result
+
+    async def aget_order(self, token):
+        request = OrdersGetRequest(token)
+        response = await self.client.aexecute(request, operation='get_order')
         return response.result
 
     def get_authorize_request_body(self):
         return {}
 
     def authorize_order(self, order_id, preferred_response='minimal'):
+        request = self._get_authorize_order_request(order_id, preferred_response)
+        response = self.client.execute(request, operation='authorize_order')
+        return response.result
+
+    async def aauthorize_order(self, order_id, preferred_response='minimal'):
+        request = self._get_authorize_order_request(order_id, preferred_response)
+        response = await self.client.aexecute(request, operation='authorize_order')
+        return response.result
+
+    def _get_authorize_order_request(self, order_id, preferred_response):
         request = OrdersAuthorizeRequest(order_id)
         request.prefer(f'return={preferred_response}')
         request.request_body(self.get_authorize_request_body())
-        response = self.client.execute(request)
-        return response.result
+        return request
 
     def void_authorized_order(self, authorization_id):
         request = AuthorizationsVoidRequest(authorization_id)
-        self.client.execute(request)
+        self.client.execute(request, operation='void_authorized_order')
+
+    async def avoid_authorized_order(self, authorization_id):
+        request = AuthorizationsVoidRequest(authorization_id)
+        await self.client.aexecute(request, operation='void_authorized_order')
 
     def refund_order(self, capture_id, amount, currency, preferred_response='minimal'):
+        request = self._get_refund_order_request(capture_id, amount, currency, preferred_response)
+        response = self.client.execute(request, operation='refund_order')
+        return response.result
+
+    async def arefund_order(self, capture_id, amount, currency, preferred_response='minimal'):
+        request = self._get_refund_order_request(capture_id, amount, currency, preferred_response)
+        response = await self.client.aexecute(request, operation='refund_order')
+        return response.result
+
+    def _get_refund_order_request(self, capture_id, amount, currency, preferred_response):
         request = CapturesRefundRequest(capture_id)
         request.prefer(f'return={preferred_response}')
         request.request_body(self.build_refund_order_request_body(amount, currency))
-        response = self.client.execute(request)
-        return response.result
+        return request
 
     def capture_order(self, token, intent, preferred_response='minimal'):
+        request = self._get_capture_order_request(token, intent, preferred_response)
+        response = self.client.execute(request, operation='capture_order')
+        return response.result
+
+    async def acapture_order(self, token, intent, preferred_response='minimal'):
+        request = self._get_capture_order_request(token, intent, preferred_response)
+        response = await self.client.aexecute(request, operation='capture_order')
+        return response.result
+
+    def _get_capture_order_request(self, token, intent, preferred_response):
         capture_request = INTENT_REQUEST_MAPPING[intent]
         request = capture_request(token)
         request.prefer(f'return={preferred_response}')
-        response = self.client.execute(request)
-        return response.result
+        return request
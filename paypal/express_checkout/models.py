@@ -33,6 +33,10 @@ class ExpressCheckoutTransaction(models.Model):
     class Meta:
         ordering = ('-date_created',)
         app_label = 'paypal'
+        indexes = [
+            models.Index(fields=['order_id'], name='paypal_ec_order_id_idx'),
+            models.Index(fields=['date_created'], name='paypal_ec_date_created_idx'),
+        ]
 
     def __str__(self):
         if self.intent:
@@ -13,28 +13,29 @@ from oscar.apps.shipping.methods import NoShippingRequired
 from oscar.core.loading import get_class, get_model
 from paypalhttp.http_error import HttpError
 
+from paypal import cache, circuit
 from paypal.express.exceptions import (
     EmptyBasketException, InvalidBasket, MissingShippingAddressException, MissingShippingMethodException)
 from paypal.express_checkout.facade import capture_order, fetch_transaction_details, get_paypal_url
 from paypal.express_checkout.gateway import buyer_pays_on_paypal
+from paypal.express_checkout.models import ExpressCheckoutTransaction
+from paypal.views import DeadlineMixin, ShippingChargeMixin
 
 # Load views dynamically
 PaymentDetailsView = get_class('checkout.views', 'PaymentDetailsView')
 CheckoutSessionMixin = get_class('checkout.session', 'CheckoutSessionMixin')
 
 ShippingAddress = get_model('order', 'ShippingAddress')
-Country = get_model('address', 'Country')
 Basket = get_model('basket', 'Basket')
 Repository = get_class('shipping.repository', 'Repository')
 Selector = get_class('partner.strategy', 'Selector')
 Source = get_model('payment', 'Source')
-SourceType = get_model('payment', 'SourceType')
 Applicator = get_class('offer.applicator', 'Applicator')
 
 logger = logging.getLogger('paypal.express')
 
 
-class PaypalRedirectView(CheckoutSessionMixin, RedirectView):
+class PaypalRedirectView(DeadlineMixin, ShippingChargeMixin, CheckoutSessionMixin, RedirectView):
     """
     Initiate the transaction with Paypal and redirect the user
     to PayPal's Express Checkout to perform the transaction.
@@ -46,12 +47,17 @@ class PaypalRedirectView(CheckoutSessionMixin, RedirectView):
     # basket page but True when redirecting from checkout.
     as_payment_method = False
 
+    error_msg = _('A problem occurred communicating with PayPal - please try again later')
+
     def get_redirect_url(self, **kwargs):
         try:
             basket = self.build_submission()['basket']
             url = self._get_redirect_url(basket, **kwargs)
         except HttpError as e:
-            messages.error(self.request, e.message)
+            if circuit.is_open_error(e):
+                messages.error(self.request, self.error_msg)
+            else:
+                messages.error(self.request, e.message)
             if self.as_payment_method:
                 url = reverse('checkout:payment-details')
             else:
@@ -129,13 +135,16 @@ class CancelResponseView(RedirectView):
         return reverse('basket:summary')
 
 
-class SuccessResponseView(PaymentDetailsView):
+class SuccessResponseView(DeadlineMixin, ShippingChargeMixin, PaymentDetailsView):
 
     template_name_preview = 'paypal/express_checkout/preview.html'
     preview = True
 
     error_msg = _('A problem occurred communicating with PayPal - please try again later')
 
+    # Session key for the transactions shown in previews, by token
+    txn_session_key = 'paypal_express_checkout_txn'
+
     payer_id = None
     token = None
     txn = None
@@ -160,7 +169,7 @@ class SuccessResponseView(PaymentDetailsView):
             return redirect('basket:summary')
 
         try:
-            self.txn = fetch_transaction_details(self.token)
+            self.txn = fetch_transaction_details(self.token, lock=True)
         except HttpError as e:
             messages.error(self.request, e.message)
             logger.warning('Unable to fetch transaction details for token %s: %s', self.token, e.message)
@@ -182,9 +191,39 @@ class SuccessResponseView(PaymentDetailsView):
         logger.info(
             'Basket #%s - showing preview with payer ID %s and token %s',
             kwargs['basket'].id, self.payer_id, self.token)
+        self.store_transaction(self.txn)
 
         return super().get(request, *args, **kwargs)
 
+    def store_transaction(self, txn):
+        """
+        Remember the transaction shown in the preview in the session, by its
+        token, so that placing the order doesn't have to fetch its details
+        again.
+        """
+        txns = self._get_stored_transactions()
+        txns[txn.order_id] = txn.pk
+        self.request.session[self.txn_session_key] = txns
+
+    def load_stored_transaction(self, token):
+        """
+        Return the transaction for ``token`` remembered by
+        `store_transaction`, as it is now in the database, or None if there
+        isn't one or its details haven't all been fetched.
+        """
+        txns = self._get_stored_transactions()
+        pk = txns.pop(token, None)
+        if pk is None:
+            return None
+        self.request.session[self.txn_session_key] = txns
+        txn = ExpressCheckoutTransaction.objects.filter(pk=pk, order_id=token).first()
+        if txn is None or not txn.payer_id or (txn.is_authorization and not txn.authorization_id):
+            return None
+        return txn
+
+    def _get_stored_transactions(self):
+        return dict(self.request.session.get(self.txn_session_key) or {})
+
     def load_frozen_basket(self, basket_id):
         # Lookup the frozen basket that this txn corresponds to
         try:
@@ -221,8 +260,9 @@ class SuccessResponseView(PaymentDetailsView):
         """
         Place an order.
 
-        We fetch the txn details again and then proceed with oscar's standard
-        payment details view for placing the order.
+        We reuse the txn details fetched for the preview (or fetch them again)
+        and then proceed with oscar's standard payment details view for
+        placing the order.
         """
         if buyer_pays_on_paypal():
             return HttpResponseBadRequest()  # we don't expect any user here if we let users buy on PayPal
@@ -235,7 +275,7 @@ class SuccessResponseView(PaymentDetailsView):
             return redirect('basket:summary')
 
         try:
-            self.txn = fetch_transaction_details(self.token)
+            self.txn = self.load_stored_transaction(self.token) or fetch_transaction_details(self.token, lock=True)
         except HttpError as e:
             logger.warning('Unable to fetch transaction details for token %s: %s', self.token, e.message)
             # Unable to fetch txn details from PayPal - we have to bail out
@@ -276,7 +316,7 @@ class SuccessResponseView(PaymentDetailsView):
             raise UnableToTakePayment()
 
         # Record payment source and event
-        source_type, is_created = SourceType.objects.get_or_create(name='PayPal')
+        source_type = cache.get_source_type('PayPal')
         amount = self.txn.amount
         source = Source(
             source_type=source_type,
@@ -313,7 +353,7 @@ class SuccessResponseView(PaymentDetailsView):
             line4=address['admin_area_2'],
             state=address.get('admin_area_1', ''),
             postcode=address['postal_code'],
-            country=Country.objects.get(iso_3166_1_a2=address['country_code']),
+            country=cache.get_country(address['country_code']),
         )
 
     def get_shipping_method(self, basket, shipping_address=None, **kwargs):
@@ -321,6 +361,6 @@ class SuccessResponseView(PaymentDetailsView):
         Return the shipping method used
         """
         if not basket.is_shipping_required():
-            return NoShippingRequired()
+            return cache.memoize_shipping_charge(NoShippingRequired())
 
         return super().get_shipping_method(basket, shipping_address, **kwargs)
@@ -0,0 +1,49 @@
+import json
+
+import django
+from django.db import connection, models
+
+# The response data is stored in a JSON column wherever the database and
+# Django version have one, so the column keeps its type (and its lookups) when
+# Django is upgraded.  Migration 0009 converts columns created as text.
+if django.VERSION >= (3, 1):
+    class ResponseDataField(models.JSONField):
+        """
+        Field for storing the parsed key-value pairs of a PayPal response.
+        """
+
+elif connection.vendor == 'postgresql':
+    from django.contrib.postgres.fields import JSONField
+
+    class ResponseDataField(JSONField):
+        """
+        Field for storing the parsed key-value pairs of a PayPal response.
+
+        Django versions before 3.1 only have a JSON field for PostgreSQL,
+        which uses the same ``jsonb`` column as later versions.
+        """
+
+else:
+    class ResponseDataField(models.TextField):
+        """
+        Field for storing the parsed key-value pairs of a PayPal response.
+
+        Django versions before 3.1 have no JSON field for other databases, so
+        the pairs are stored as JSON text until Django is upgraded.
+        """
+
+        def from_db_value(self, value, expression, connection):
+            return self.to_python(value)
+
+        def to_python(self, value):
+            if value is None or not isinstance(value, str):
+                return value
+            return json.loads(value)
+
+        def get_prep_value(self, value):
+            if value is None:
+                return value
+            return json.dumps(value)
+
+        def value_to_string(self, obj):
+            return self.get_prep_value(self.value_from_object(obj))
@@ -1,31 +1,467 @@
+import asyncio
+import logging
+import random
+import threading
 import time
-from urllib.parse import parse_qsl
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import parse_qsl, quote_plus
 
 import requests
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.http import urlencode
+from requests.adapters import HTTPAdapter
 
-from paypal import exceptions
+from paypal import circuit, conf, exceptions, instrumentation
 
+try:
+    import httpx
+    from asgiref.sync import sync_to_async
+except ImportError:  # The async API is optional
+    httpx = sync_to_async = None
 
-def post(url, params, encode=True):
+# Connect and read timeouts (in seconds) used when no per-operation timeout
+# has been configured.
+DEFAULT_TIMEOUT = (5, 30)
+
+_session = None
+_session_lock = threading.Lock()
+
+# Async clients are bound to the event loop they were created in
+_async_clients = weakref.WeakKeyDictionary()
+
+# Monotonic time by which all PayPal calls made in the current context must
+# have finished - see `deadline`.
+_deadline = ContextVar('paypal_deadline', default=None)
+
+logger = logging.getLogger('paypal.gateway')
+
+# Counts of retried calls for each operation - see `get_retry_stats`
+_retry_stats = Counter()
+_retry_stats_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Return the process-wide HTTP session used for talking to PayPal.
+
+    The session keeps a pool of keep-alive connections per host so that
+    consecutive calls to the same PayPal endpoint (eg api-3t.paypal.com or
+    payflowpro.paypal.com) don't pay for a new TCP and TLS handshake each time.
+    It is created lazily and shared between threads.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+def _create_session():
+    pool_size = getattr(settings, 'PAYPAL_HTTP_POOL_SIZE', 10)
+    adapter = HTTPAdapter(
+        # Number of hosts to keep pools for - we talk to at most a handful
+        pool_connections=getattr(settings, 'PAYPAL_HTTP_POOL_HOSTS', 4),
+        # Number of connections kept alive per host
+        pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def reset_session():
+    """
+    Close the shared session and its pooled connections.
+
+    The next call to PayPal will create a fresh session.  This is useful after
+    forking worker processes and when the pool settings change.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def get_async_client():
+    """
+    Return the async HTTP client used for talking to PayPal from the running
+    event loop.
+
+    As with `get_session`, the client keeps a pool of keep-alive connections
+    and is shared by all coroutines running in the loop.
+    """
+    if httpx is None:
+        raise ImproperlyConfigured(
+            "The async API requires httpx and asgiref - install "
+            "django-oscar-paypal[async]")
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=getattr(settings, 'PAYPAL_ASYNC_MAX_CONNECTIONS', 100),
+            max_keepalive_connections=getattr(settings, 'PAYPAL_HTTP_POOL_SIZE', 10)))
+        _async_clients[loop] = client
+    return client
+
+
+async def close_async_client():
+    """
+    Close the async client of the running event loop, if there is one.
+    """
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    Run a blocking function (eg an ORM call) from async code.
+    """
+    if sync_to_async is None:
+        raise ImproperlyConfigured(
+            "The async API requires httpx and asgiref - install "
+            "django-oscar-paypal[async]")
+    return await sync_to_async(func)(*args, **kwargs)
+
+
+def get_httpx_timeout(timeout):
+    """
+    Convert a (connect, read) timeout to the format used by httpx.
+    """
+    connect, read = timeout
+    return httpx.Timeout(read, connect=connect)
+
+
+def connection_stats():
+    """
+    Return connection reuse counters for each host in the pool.
+
+    Each value is a dict with the number of ``connections`` opened, the number
+    of ``requests`` made and how many of those requests ``reused`` an existing
+    keep-alive connection.
+    """
+    stats = {}
+    if _session is None:
+        return stats
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            host_stats = stats.setdefault(
+                pool.host, {'connections': 0, 'requests': 0, 'reused': 0})
+            host_stats['connections'] += pool.num_connections
+            host_stats['requests'] += pool.num_requests
+            host_stats['reused'] += max(pool.num_requests - pool.num_connections, 0)
+    return stats
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Bound the total time spent waiting on PayPal within the block.
+
+    Every PayPal call made inside the block has its timeouts cut down to the
+    time that is left, and fails with ``DeadlineExceeded`` once the budget is
+    used up.  Nested deadlines can only shorten the outer one.  Passing
+    ``None`` leaves the current deadline (if any) untouched.
+    """
+    if seconds is None:
+        yield
+        return
+    expires_at = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        expires_at = min(expires_at, current)
+    token = _deadline.set(expires_at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def get_timeout(operation=None):
+    """
+    Return the (connect, read) timeout to use for a PayPal operation.
+
+    Timeouts are looked up in ``PAYPAL_OPERATION_TIMEOUTS`` by operation name,
+    falling back to ``PAYPAL_TIMEOUT``, and are capped by the time left before
+    the current deadline.
+
+    :operation: The name of the operation (eg 'GetExpressCheckoutDetails')
+    """
+    timeouts = getattr(settings, 'PAYPAL_OPERATION_TIMEOUTS', {})
+    timeout = timeouts.get(operation, getattr(settings, 'PAYPAL_TIMEOUT', DEFAULT_TIMEOUT))
+    if not isinstance(timeout, (tuple, list)):
+        timeout = (timeout, timeout)
+
+    expires_at = _deadline.get()
+    if expires_at is not None:
+        remaining = expires_at - time.monotonic()
+        if remaining <= 0:
+            raise exceptions.DeadlineExceeded(
+                "Deadline exceeded before calling PayPal")
+        timeout = [min(value, remaining) for value in timeout]
+    return tuple(timeout)
+
+
+def call_with_retries(func, operation=None, errors=(exceptions.CommunicationError,)):
+    """
+    Return ``func()``, calling it again if it fails with a transient error
+    (see `is_transient`).
+
+    Up to ``PAYPAL_RETRY_ATTEMPTS`` calls are made in all, with a random
+    delay of up to ``PAYPAL_RETRY_BACKOFF`` seconds before the first retry,
+    doubling (up to ``PAYPAL_RETRY_MAX_BACKOFF``) for each one after.  There
+    are no retries once the current deadline would be passed.  Only use this
+    for calls which are safe to repeat.
+
+    :operation: The name of the operation, for logging and `get_retry_stats`
+    :errors: The types of exception ``func`` raises for failed calls
+    """
+    attempt = 1
+    while True:
+        try:
+            result = func()
+        except errors as e:
+            delay = _get_retry_delay(e, attempt, operation)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+        else:
+            if attempt > 1:
+                _count_retry(operation, 'recovered')
+            return result
+
+
+async def acall_with_retries(func, operation=None, errors=(exceptions.CommunicationError,)):
+    """
+    Asynchronous version of `call_with_retries`, for a ``func`` which returns
+    an awaitable.
+    """
+    attempt = 1
+    while True:
+        try:
+            result = await func()
+        except errors as e:
+            delay = _get_retry_delay(e, attempt, operation)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+        else:
+            if attempt > 1:
+                _count_retry(operation, 'recovered')
+            return result
+
+
+def is_transient(error):
+    """
+    Return whether a failed call is worth retrying: PayPal couldn't be
+    reached, had a server error or asked for calls to slow down.
+
+    Calls which weren't made because the circuit of the endpoint is open
+    aren't retried.
+    """
+    if circuit.is_open_error(error):
+        return False
+    status_code = getattr(error, 'status_code', None)
+    return status_code is None or status_code >= 500 or status_code == 429
+
+
+def get_retry_stats():
+    """
+    Return the counts of ``retries``, of calls which succeeded after being
+    retried (``recovered``) and of calls which still ``failed``, for each
+    operation.
+    """
+    stats = {}
+    with _retry_stats_lock:
+        for (operation, key), value in _retry_stats.items():
+            stats.setdefault(operation, {'retries': 0, 'recovered': 0, 'failed': 0})[key] = value
+    return stats
+
+
+def reset_retry_stats():
+    with _retry_stats_lock:
+        _retry_stats.clear()
+
+
+def _get_retry_delay(error, attempt, operation):
+    """
+    Return the number of seconds to wait before retrying a failed call, or
+    None if it shouldn't be retried.
+    """
+    config = conf.get_config()
+    delay = None
+    if is_transient(error) and attempt < config.retry_attempts:
+        delay = random.uniform(0, min(config.retry_max_backoff, config.retry_backoff * 2 ** (attempt - 1)))
+        expires_at = _deadline.get()
+        if expires_at is not None and time.monotonic() + delay >= expires_at:
+            delay = None
+    if delay is None:
+        if attempt > 1:
+            _count_retry(operation, 'failed')
+        return None
+    _count_retry(operation, 'retries')
+    instrumentation.count_retry()
+    logger.warning("Retrying %s in %.2fs after attempt %d failed: %s", operation, delay, attempt, error)
+    return delay
+
+
+def _count_retry(operation, key):
+    with _retry_stats_lock:
+        _retry_stats[(operation, key)] += 1
+
+
+class Payload:
+    """
+    A name-value payload which is URL-encoded as it is built.
+
+    Single fields are kept in a dict so that they can still be read and
+    replaced, while repeated fields (eg the line items of a basket) are
+    encoded as soon as they are added with `add_item`.  Building a large
+    payload this way avoids a dict entry and a formatted key per field, and
+    encoding each key again when the request is made.
+    """
+
+    def __init__(self, fields=None):
+        self.fields = dict(fields) if fields else {}
+        self._items = []
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def __setitem__(self, key, value):
+        self.fields[key] = value
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key, default=None):
+        return self.fields.get(key, default)
+
+    def pop(self, key, default=None):
+        return self.fields.pop(key, default)
+
+    def update(self, other):
+        if isinstance(other, Payload):
+            self.fields.update(other.fields)
+            self._items.extend(other._items)
+        else:
+            self.fields.update(other)
+
+    def add_item(self, index, fields):
+        """
+        Add the fields of a repeated item.
+
+        :index: The index appended to each field name
+        :fields: Sequence of (name, value) pairs.  The names must not need
+                 encoding.
+        """
+        append = self._items.append
+        for name, value in fields:
+            append('%s%d=%s' % (name, index, _quote(value)))
+
+    def items(self):
+        """
+        Return all fields as (name, value) pairs, eg for logging
+        """
+        return list(self.fields.items()) + parse_qsl('&'.join(self._items))
+
+    def encode(self):
+        parts = ['%s=%s' % (quote_plus(key), _quote(value)) for key, value in self.fields.items()]
+        parts.extend(self._items)
+        return '&'.join(parts)
+
+
+def _quote(value):
+    value = str(value)
+    # Most values (amounts, quantities, tokens) are already safe
+    if value.isascii() and value.isalnum():
+        return value
+    return quote_plus(value)
+
+
+def _encode(params):
+    if isinstance(params, Payload):
+        return params.encode()
+    return urlencode(params)
+
+
+def post(url, params, encode=True, timeout=None, operation=None):
     """
     Make a POST request to the URL using the key-value pairs.  Return
     a set of key-value pairs.
 
+    The call goes through the circuit breaker of the URL and operation, so
+    raises ``CircuitOpen`` straight away if PayPal has been failing.
+
     :url: URL to post to
-    :params: Dict of parameters to include in post payload
+    :params: Dict or `Payload` of parameters to include in post payload
+    :timeout: (connect, read) timeout in seconds.  Defaults to the result
+              of `get_timeout`.
+    :operation: The name of the operation, eg the NVP method
     """
     if encode:
-        payload = urlencode(params)
+        payload = _encode(params)
     else:
         payload = params
 
-    start_time = time.time()
-    response = requests.post(
-        url, payload,
-        headers={'content-type': 'text/namevalue; charset=utf-8'})
+    if timeout is None:
+        timeout = get_timeout()
+
+    instrumentation.record_payload(payload)
+
+    with circuit.guard(url, operation):
+        start_time = time.time()
+        try:
+            response = get_session().post(
+                url, payload,
+                headers={'content-type': 'text/namevalue; charset=utf-8'},
+                timeout=timeout)
+        except requests.RequestException:
+            raise exceptions.CommunicationError("Unable to communicate with PayPal")
+        return _get_pairs(payload, response, start_time)
+
+
+async def apost(url, params, encode=True, timeout=None, operation=None):
+    """
+    Asynchronous version of `post`, which doesn't block the event loop while
+    waiting for PayPal.
+    """
+    if encode:
+        payload = _encode(params)
+    else:
+        payload = params
+
+    if timeout is None:
+        timeout = get_timeout()
+
+    instrumentation.record_payload(payload)
+
+    client = get_async_client()
+    with circuit.guard(url, operation):
+        start_time = time.time()
+        try:
+            response = await client.post(
+                url, content=payload,
+                headers={'content-type': 'text/namevalue; charset=utf-8'},
+                timeout=get_httpx_timeout(timeout))
+        except httpx.HTTPError:
+            raise exceptions.CommunicationError("Unable to communicate with PayPal")
+        return _get_pairs(payload, response, start_time)
+
+
+def _get_pairs(payload, response, start_time):
     if response.status_code != requests.codes.ok:
-        raise exceptions.PayPalError("Unable to communicate with PayPal")
+        raise exceptions.CommunicationError("Unable to communicate with PayPal", response.status_code)
 
     # Convert response into a simple key-value format
     pairs = {}
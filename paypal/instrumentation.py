@@ -0,0 +1,220 @@
+"""
+Metrics for the calls made to PayPal.
+
+Every call made by the gateways - NVP methods, Payflow transactions and
+Commerce Platform (REST) operations - is measured and passed to the backends
+listed in ``PAYPAL_INSTRUMENTATION_BACKENDS``, as a `Call` with its
+operation, endpoint, outcome, latency, payload size and number of retries.
+Backends for Prometheus and StatsD are included, and others can be written by
+subclassing `Backend`.
+"""
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from paypal import circuit, conf
+
+try:
+    import prometheus_client
+except ImportError:  # Only needed by PrometheusBackend
+    prometheus_client = None
+
+try:
+    import statsd
+except ImportError:  # Only needed by StatsdBackend
+    statsd = None
+
+logger = logging.getLogger('paypal.instrumentation')
+
+# The call being measured in the current context - see `measure`
+_current_call = ContextVar('paypal_call', default=None)
+
+_prometheus_metrics = None
+_prometheus_lock = threading.Lock()
+
+
+class Call:
+    """
+    A call to PayPal, as passed to `Backend.record`.
+
+    :operation: The NVP method, Payflow transaction type or REST operation
+    :endpoint: The URL called, without the path of REST calls
+    :outcome: The ACK of NVP calls, the RESULT of Payflow transactions and the
+              HTTP status code of REST calls.  Calls which failed without a
+              response have an outcome of 'error', or 'circuit_open' if they
+              weren't made because the circuit of the endpoint was open.
+    :latency: The time taken in seconds, including any retries
+    :payload_size: The size of the request in bytes
+    :retries: The number of times the call was retried
+    """
+
+    def __init__(self, operation, endpoint):
+        self.operation = operation
+        self.endpoint = endpoint
+        self.outcome = None
+        self.latency = None
+        self.payload_size = 0
+        self.retries = 0
+
+
+class Backend:
+    """
+    Base class for instrumentation backends.
+    """
+
+    def record(self, call):
+        raise NotImplementedError
+
+
+class PrometheusBackend(Backend):
+    """
+    Records calls in Prometheus metrics of the default registry:
+
+    * ``paypal_call_duration_seconds`` - a histogram of the latency by
+      operation, endpoint and outcome
+    * ``paypal_call_payload_bytes`` - a histogram of the request size by
+      operation and endpoint
+    * ``paypal_call_retries_total`` - a counter of retries by operation and
+      endpoint
+
+    Requires the ``prometheus_client`` package.
+    """
+
+    def __init__(self):
+        if prometheus_client is None:
+            raise ImproperlyConfigured(
+                "The Prometheus backend requires prometheus_client - install "
+                "django-oscar-paypal[prometheus]")
+        self.duration, self.payload_size, self.retries = _get_prometheus_metrics()
+
+    def record(self, call):
+        self.duration.labels(call.operation, call.endpoint, call.outcome).observe(call.latency)
+        self.payload_size.labels(call.operation, call.endpoint).observe(call.payload_size)
+        if call.retries:
+            self.retries.labels(call.operation, call.endpoint).inc(call.retries)
+
+
+class StatsdBackend(Backend):
+    """
+    Sends calls to StatsD as ``<prefix>.<operation>.latency`` and
+    ``<prefix>.<operation>.payload_bytes`` timers, and
+    ``<prefix>.<operation>.<outcome>`` and ``<prefix>.<operation>.retries``
+    counters.
+
+    The client is configured by ``PAYPAL_STATSD_HOST`` (default 'localhost'),
+    ``PAYPAL_STATSD_PORT`` (default 8125) and ``PAYPAL_STATSD_PREFIX`` (default
+    'paypal').  Requires the ``statsd`` package.
+    """
+
+    def __init__(self):
+        if statsd is None:
+            raise ImproperlyConfigured(
+                "The StatsD backend requires statsd - install django-oscar-paypal[statsd]")
+        self.client = statsd.StatsClient(
+            getattr(settings, 'PAYPAL_STATSD_HOST', 'localhost'),
+            getattr(settings, 'PAYPAL_STATSD_PORT', 8125),
+            prefix=getattr(settings, 'PAYPAL_STATSD_PREFIX', 'paypal'))
+
+    def record(self, call):
+        name = _get_statsd_name(call.operation)
+        pipe = self.client.pipeline()
+        pipe.timing('%s.latency' % name, call.latency * 1000)
+        pipe.timing('%s.payload_bytes' % name, call.payload_size)
+        pipe.incr('%s.%s' % (name, _get_statsd_name(call.outcome)))
+        if call.retries:
+            pipe.incr('%s.retries' % name, call.retries)
+        pipe.send()
+
+
+@contextmanager
+def measure(operation, endpoint):
+    """
+    Measure a call to PayPal made within the block, and pass it to the
+    backends.
+
+    The block sets the ``outcome`` of the `Call` it is given.  If it raises
+    an exception instead, the outcome is the status code of the HTTP error,
+    if there was a response, or 'error'.
+    """
+    backends = conf.get_config().instrumentation_backends
+    call = Call(operation, endpoint)
+    if not backends:
+        yield call
+        return
+    token = _current_call.set(call)
+    started = time.monotonic()
+    try:
+        yield call
+    except Exception as e:
+        if call.outcome is None:
+            call.outcome = _get_error_outcome(e)
+        raise
+    finally:
+        call.latency = time.monotonic() - started
+        _current_call.reset(token)
+        _record(backends, call)
+
+
+def record_payload(payload):
+    """
+    Record the size of the request (a str or bytes) of the call being
+    measured.
+    """
+    call = _current_call.get()
+    if call is not None and payload is not None:
+        call.payload_size = len(payload if isinstance(payload, bytes) else payload.encode('utf-8'))
+
+
+def count_retry():
+    """
+    Count a retry of the call being measured.
+    """
+    call = _current_call.get()
+    if call is not None:
+        call.retries += 1
+
+
+def _record(backends, call):
+    for backend in backends:
+        try:
+            backend.record(call)
+        except Exception:
+            # Metrics mustn't get in the way of taking payments
+            logger.exception("Unable to record PayPal call %s with %s", call.operation, type(backend).__name__)
+
+
+def _get_error_outcome(error):
+    if circuit.is_open_error(error):
+        return 'circuit_open'
+    status_code = getattr(error, 'status_code', None)
+    return str(status_code) if status_code is not None else 'error'
+
+
+def _get_statsd_name(value):
+    return re.sub(r'[^\w-]+', '_', str(value)).strip('_').lower()
+
+
+def _get_prometheus_metrics():
+    # Metrics can only be registered once, so they are shared by all
+    # backends (which are created again when the settings change)
+    global _prometheus_metrics
+    if _prometheus_metrics is None:
+        with _prometheus_lock:
+            if _prometheus_metrics is None:
+                _prometheus_metrics = (
+                    prometheus_client.Histogram(
+                        'paypal_call_duration_seconds', "Latency of calls to PayPal",
+                        ('operation', 'endpoint', 'outcome')),
+                    prometheus_client.Histogram(
+                        'paypal_call_payload_bytes', "Size of requests to PayPal",
+                        ('operation', 'endpoint'), buckets=(256, 1024, 4096, 16384, 65536, float('inf'))),
+                    prometheus_client.Counter(
+                        'paypal_call_retries', "Retries of calls to PayPal", ('operation', 'endpoint')),
+                )
+    return _prometheus_metrics
@@ -0,0 +1,69 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from oscar.core.loading import get_model
+
+from paypal.batch import engine
+from paypal.batch.models import BatchResult
+
+Order = get_model('order', 'Order')
+
+
+class Command(BaseCommand):
+    help = "Capture, refund or void the PayPal payments of a batch of orders"
+
+    # Set by commands for a single action
+    action = None
+
+    def add_arguments(self, parser):
+        if self.action is None:
+            parser.add_argument('action', choices=[BatchResult.CAPTURE, BatchResult.REFUND, BatchResult.VOID])
+        parser.add_argument('integration', choices=[
+            BatchResult.EXPRESS, BatchResult.EXPRESS_CHECKOUT, BatchResult.PAYFLOW])
+        orders = parser.add_mutually_exclusive_group(required=True)
+        orders.add_argument('--file', help="File with an order number on each line ('-' for stdin)")
+        orders.add_argument('--status', help="Handle the orders with this status")
+        parser.add_argument('--batch-id', help="ID of a batch to resume")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Number of calls to PayPal to make at once")
+        parser.add_argument('--rate', type=float, default=None,
+                            help="Maximum number of calls to PayPal a second")
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Number of orders to handle between checkpoints")
+        parser.add_argument('--retry-unknown', action='store_true',
+                            help="Send the orders whose outcome is unknown again, once they have been checked "
+                                 "at PayPal")
+        parser.add_argument('--report', help="Write a CSV report of the result for each order to this "
+                                             "file ('-' for stdout)")
+
+    def handle(self, *args, **options):
+        action = self.action or options['action']
+        if options['file'] == '-':
+            summary = self.run(action, sys.stdin, options)
+        elif options['file']:
+            try:
+                with open(options['file']) as f:
+                    summary = self.run(action, f, options)
+            except OSError as e:
+                raise CommandError(e)
+        else:
+            summary = self.run(action, Order.objects.filter(status=options['status']).order_by('pk'), options)
+
+        if options['report'] == '-':
+            engine.write_report(summary['batch_id'], self.stdout)
+        elif options['report']:
+            with open(options['report'], 'w', newline='') as f:
+                engine.write_report(summary['batch_id'], f)
+
+        self.stdout.write("Batch %(batch_id)s: %(succeeded)d succeeded, %(failed)d failed, "
+                          "%(unknown)d unknown, %(skipped)d skipped" % summary)
+        if summary['failed']:
+            self.stdout.write("Run again with --batch-id %s to retry the failed orders" % summary['batch_id'])
+        if summary['unknown']:
+            self.stdout.write("Check the orders whose outcome is unknown at PayPal, then run again with "
+                              "--batch-id %s --retry-unknown to retry them" % summary['batch_id'])
+
+    def run(self, action, orders, options):
+        return engine.run(
+            action, orders, options['integration'], batch_id=options['batch_id'], workers=options['workers'],
+            rate=options['rate'], chunk_size=options['chunk_size'], retry_unknown=options['retry_unknown'])
@@ -0,0 +1,8 @@
+from paypal.batch.models import BatchResult
+
+from .paypal_batch import Command as BatchCommand
+
+
+class Command(BatchCommand):
+    help = "Capture the authorized PayPal payments of a batch of orders"
+    action = BatchResult.CAPTURE
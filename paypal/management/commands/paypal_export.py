@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from paypal import export
+
+
+def _date(value):
+    date = parse_date(value)
+    if date is None:
+        raise ValueError(value)
+    return date
+
+
+class Command(BaseCommand):
+    help = "Export the PayPal transactions of an integration as CSV or JSON lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('integration', choices=export.INTEGRATIONS)
+        parser.add_argument('--format', choices=list(export.CONTENT_TYPES), default=export.CSV)
+        parser.add_argument('--from', dest='date_from', type=_date,
+                            help="Export the transactions created on or after this date (YYYY-MM-DD)")
+        parser.add_argument('--to', dest='date_to', type=_date,
+                            help="Export the transactions created on or before this date (YYYY-MM-DD)")
+        parser.add_argument('--output', default='-', help="File to write the export to ('-' for stdout)")
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help="Number of transactions to read from the database at a time")
+
+    def handle(self, *args, **options):
+        lines = export.iter_export(
+            options['integration'], options['format'], options['date_from'], options['date_to'],
+            chunk_size=options['chunk_size'])
+        if options['output'] == '-':
+            self.write(lines, self.stdout)
+            return
+        try:
+            with open(options['output'], 'w', newline='') as f:
+                self.write(lines, f)
+        except OSError as e:
+            raise CommandError(e)
+
+    def write(self, lines, f):
+        for line in lines:
+            f.write(line)
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from paypal.simulator import Simulator, make_server
+
+
+class Command(BaseCommand):
+    help = "Run a local simulator of the PayPal APIs for load testing"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, default=0,
+                            help="Time in milliseconds to wait before responding")
+        parser.add_argument('--jitter', type=float, default=0,
+                            help="Maximum random time in milliseconds added to the latency")
+        parser.add_argument('--error-rate', type=float, default=0,
+                            help="Fraction of calls which fail with an API error")
+        parser.add_argument('--http-error-rate', type=float, default=0,
+                            help="Fraction of calls which fail with a 503 response")
+        parser.add_argument('--seed', type=int, default=None,
+                            help="Seed for the random number generator")
+
+    def handle(self, *args, **options):
+        simulator = Simulator(
+            latency=options['latency'],
+            jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            http_error_rate=options['http_error_rate'],
+            seed=options['seed'],
+        )
+        server = make_server(options['host'], options['port'], simulator, verbose=options['verbosity'] > 1)
+        host, port = server.server_address[:2]
+        self.stdout.write("PayPal simulator running at http://%s:%d/" % (host, port))
+        self.stdout.write("Use these settings to send calls to it:\n")
+        self.stdout.write("    PAYPAL_NVP_URL = 'http://%s:%d/nvp'" % (host, port))
+        self.stdout.write("    PAYPAL_PAYFLOW_URL = 'http://%s:%d/payflow'" % (host, port))
+        self.stdout.write("    PAYPAL_REST_API_URL = 'http://%s:%d'\n" % (host, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+import paypal.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paypal', '0004_increase_max_char_length_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expresstransaction',
+            name='response_data',
+            field=paypal.fields.ResponseDataField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='payflowtransaction',
+            name='response_data',
+            field=paypal.fields.ResponseDataField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+from urllib.parse import parse_qsl
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def backfill_response_data(apps, schema_editor):
+    """
+    Store the parsed response of existing transactions, a batch at a time.
+    """
+    for model_name in ('ExpressTransaction', 'PayflowTransaction'):
+        model = apps.get_model('paypal', model_name)
+        queryset = model.objects.filter(response_data__isnull=True).only('pk', 'raw_response').order_by('pk')
+        last_pk = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk)[:BATCH_SIZE])
+            if not batch:
+                break
+            for txn in batch:
+                txn.response_data = dict(parse_qsl(txn.raw_response))
+            model.objects.bulk_update(batch, ['response_data'])
+            last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+    # Commit each batch separately rather than holding one transaction open
+    # for the whole table
+    atomic = False
+
+    dependencies = [
+        ('paypal', '0005_transaction_response_data'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_response_data, migrations.RunPython.noop),
+    ]
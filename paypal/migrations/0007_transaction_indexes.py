@@ -0,0 +1,46 @@
+from django.db import migrations, models
+
+from paypal.db import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # Indexes are built concurrently on PostgreSQL, which can't be done inside
+    # a transaction
+    atomic = False
+
+    dependencies = [
+        ('paypal', '0006_backfill_response_data'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='expresstransaction',
+            index=models.Index(fields=['token', 'method'], name='paypal_exp_token_method_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='expresstransaction',
+            index=models.Index(fields=['date_created'], name='paypal_exp_date_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='expresscheckouttransaction',
+            index=models.Index(fields=['order_id'], name='paypal_ec_order_id_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='expresscheckouttransaction',
+            index=models.Index(fields=['date_created'], name='paypal_ec_date_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='payflowtransaction',
+            index=models.Index(fields=['comment1', 'trxtype'], name='paypal_pf_comment1_trxtype_idx'),
+        ),
+        # Covered by the index above
+        migrations.AlterField(
+            model_name='payflowtransaction',
+            name='comment1',
+            field=models.CharField(max_length=128, verbose_name='Comment 1'),
+        ),
+        AddIndexConcurrently(
+            model_name='payflowtransaction',
+            index=models.Index(fields=['date_created'], name='paypal_pf_date_created_idx'),
+        ),
+    ]
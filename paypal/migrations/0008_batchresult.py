@@ -0,0 +1,36 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paypal', '0007_transaction_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch_id', models.CharField(max_length=64, verbose_name='Batch ID')),
+                ('action', models.CharField(max_length=16)),
+                ('integration', models.CharField(max_length=16)),
+                ('order_number', models.CharField(max_length=128)),
+                ('reference', models.CharField(blank=True, max_length=255, null=True)),
+                ('transaction_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('status', models.CharField(max_length=16)),
+                ('error_message', models.CharField(blank=True, max_length=512)),
+                ('response_time', models.FloatField(blank=True, help_text='Response time in milliseconds', null=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ('-date_created',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='batchresult',
+            index=models.Index(fields=['batch_id', 'order_number'], name='paypal_batch_order_idx'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+from django.db import migrations
+
+# How to look up the type of a column and change it, for the databases whose
+# JSON column isn't text.  SQLite and Oracle store JSON as text already.
+COLUMN_TYPE_SQL = {
+    'postgresql': (
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s"),
+    'mysql': (
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s"),
+}
+ALTER_COLUMN_SQL = {
+    'postgresql': 'ALTER TABLE {table} ALTER COLUMN {column} TYPE {type} USING {column}::{type}',
+    'mysql': 'ALTER TABLE {table} MODIFY {column} {type} NULL',
+}
+TEXT_TYPES = ('text', 'longtext')
+
+
+def get_conversion_sql(vendor, table, column, column_type, db_type):
+    """
+    Return the SQL which changes a text column to the JSON column type of the
+    field, or None if it doesn't need changing.
+    """
+    if vendor not in ALTER_COLUMN_SQL or column_type.lower() not in TEXT_TYPES:
+        return None
+    if column_type.lower() == db_type.lower():
+        return None
+    return ALTER_COLUMN_SQL[vendor].format(table=table, column=column, type=db_type)
+
+
+def convert_response_data(apps, schema_editor):
+    """
+    Change ``response_data`` columns created as text (by Django versions
+    before 3.1) to a JSON column.
+    """
+    connection = schema_editor.connection
+    if connection.vendor not in COLUMN_TYPE_SQL:
+        return
+    quote_name = schema_editor.quote_name
+    for model_name in ('ExpressTransaction', 'PayflowTransaction'):
+        model = apps.get_model('paypal', model_name)
+        field = model._meta.get_field('response_data')
+        with connection.cursor() as cursor:
+            cursor.execute(COLUMN_TYPE_SQL[connection.vendor], [model._meta.db_table, field.column])
+            row = cursor.fetchone()
+        if row is None:
+            continue
+        sql = get_conversion_sql(connection.vendor, quote_name(model._meta.db_table), quote_name(field.column),
+                                 row[0], field.db_type(connection))
+        if sql:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paypal', '0008_batchresult'),
+    ]
+
+    operations = [
+        migrations.RunPython(convert_response_data, migrations.RunPython.noop),
+    ]
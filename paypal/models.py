@@ -1,3 +1,4 @@
+from paypal.batch.models import *  # noqa F403
 from paypal.express.models import *  # noqa F403
 from paypal.express_checkout.models import *  # noqa F403
 from paypal.payflow.models import *  # noqa F403
@@ -15,6 +15,7 @@ class PayFlowDashboardApplication(OscarDashboardConfig):
         from . import views
         self.list_view = views.TransactionListView
         self.detail_view = views.TransactionDetailView
+        self.export_view = views.TransactionExportView
 
     def get_urls(self):
         urlpatterns = [
@@ -22,5 +23,7 @@ class PayFlowDashboardApplication(OscarDashboardConfig):
                  name='paypal-payflow-list'),
             path('transactions/<int:pk>/', self.detail_view.as_view(),
                  name='paypal-payflow-detail'),
+            path('transactions/export/', self.export_view.as_view(),
+                 name='paypal-payflow-export'),
         ]
         return self.post_process_urls(urlpatterns)
@@ -5,7 +5,9 @@ from django.shortcuts import redirect
 from django.utils.translation import gettext as _
 from django.views import generic
 
+from paypal import audit, export
 from paypal.payflow import facade, models
+from paypal.views import TransactionExportMixin
 
 
 class TransactionListView(generic.ListView):
@@ -14,6 +16,10 @@ class TransactionListView(generic.ListView):
     context_object_name = 'transactions'
 
 
+class TransactionExportView(TransactionExportMixin, generic.View):
+    integration = export.PAYFLOW
+
+
 class TransactionDetailView(generic.DetailView):
     model = models.PayflowTransaction
     template_name = 'paypal/payflow/dashboard/transaction_detail.html'
@@ -37,7 +43,9 @@ class TransactionDetailView(generic.DetailView):
         }
         action = request.POST.get('action', None)
         if action in dispatch_map:
-            return dispatch_map[action](orig_txn)
+            # Save the new transaction straight away so we can redirect to it
+            with audit.write_through():
+                return dispatch_map[action](orig_txn)
         return http.HttpBadRequest("Unrecognised action")
 
     def capture(self, orig_txn):
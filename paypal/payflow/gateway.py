@@ -4,14 +4,17 @@ non-Oscar project.  All Oscar-related functionality should be in the facade.
 """
 import logging
 
-from django.conf import settings
 from django.core import exceptions
 
-from paypal import gateway
+from paypal import audit, conf, gateway, instrumentation
 from paypal.payflow import codes, models
 
 logger = logging.getLogger('paypal.payflow')
 
+# Transaction types which are safe to repeat, and so are retried if PayPal
+# can't be reached.  Only one delayed capture is allowed for an authorization.
+RETRYABLE_TRXTYPES = (codes.DELAYED_CAPTURE,)
+
 
 def authorize(order_number, card_number, cvv, expiry_date, amt, **kwargs):
     """
@@ -23,8 +26,16 @@ def authorize(order_number, card_number, cvv, expiry_date, amt, **kwargs):
     * The hold lasts for around a week.
     * The hold cannot be cancelled through the PayPal API.
     """
-    return _submit_payment_details(codes.AUTHORIZATION, order_number, card_number, cvv, expiry_date,
-                                   amt, **kwargs)
+    return _transaction(_get_payment_details_params(codes.AUTHORIZATION, order_number, card_number, cvv,
+                                                    expiry_date, amt, **kwargs))
+
+
+async def aauthorize(order_number, card_number, cvv, expiry_date, amt, **kwargs):
+    """
+    Asynchronous version of `authorize`
+    """
+    return await _atransaction(_get_payment_details_params(codes.AUTHORIZATION, order_number, card_number, cvv,
+                                                           expiry_date, amt, **kwargs))
 
 
 def sale(order_number, card_number, cvv, expiry_date, amt, **kwargs):
@@ -34,13 +45,21 @@ def sale(order_number, card_number, cvv, expiry_date, amt, **kwargs):
     This authorises money within the customer's bank and marks it for settlement
     immediately.
     """
-    return _submit_payment_details(codes.SALE, order_number, card_number, cvv, expiry_date,
-                                   amt, **kwargs)
+    return _transaction(_get_payment_details_params(codes.SALE, order_number, card_number, cvv,
+                                                    expiry_date, amt, **kwargs))
 
 
-def _submit_payment_details(trxtype, order_number, card_number, cvv, expiry_date, amt, **kwargs):
+async def asale(order_number, card_number, cvv, expiry_date, amt, **kwargs):
     """
-    Submit payment details to PayPal.
+    Asynchronous version of `sale`
+    """
+    return await _atransaction(_get_payment_details_params(codes.SALE, order_number, card_number, cvv,
+                                                           expiry_date, amt, **kwargs))
+
+
+def _get_payment_details_params(trxtype, order_number, card_number, cvv, expiry_date, amt, **kwargs):
+    """
+    Return the parameters for submitting payment details to PayPal.
     """
     params = {
         'TRXTYPE': trxtype,
@@ -69,14 +88,11 @@ def _submit_payment_details(trxtype, order_number, card_number, cvv, expiry_date
     # dict(shipto_first_name='SHIPTOFIRSTNAME', ...)
     #   OR
     # dict(bncode='BUTTONSOURCE', ...)
-    OPTIONAL_PARAMS = getattr(settings, 'PAYPAL_PAYFLOW_OPTIONAL_PARAMS', dict())
-    if isinstance(OPTIONAL_PARAMS, dict):
-        # add optional parameters here
-        for key, name in OPTIONAL_PARAMS.items():
-            value = kwargs.get(key)
-            if value:
-                params.update({'{}'.format(name): value})
-    return _transaction(params)
+    for key, name in conf.get_config().payflow_optional_params.items():
+        value = kwargs.get(key)
+        if value:
+            params.update({'{}'.format(name): value})
+    return params
 
 
 def delayed_capture(order_number, pnref, amt=None):
@@ -85,6 +101,17 @@ def delayed_capture(order_number, pnref, amt=None):
 
     This captures money that was previously authorised.
     """
+    return _transaction(_get_delayed_capture_params(order_number, pnref, amt))
+
+
+async def adelayed_capture(order_number, pnref, amt=None):
+    """
+    Asynchronous version of `delayed_capture`
+    """
+    return await _atransaction(_get_delayed_capture_params(order_number, pnref, amt))
+
+
+def _get_delayed_capture_params(order_number, pnref, amt):
     params = {
         'COMMENT1': order_number,
         'TRXTYPE': codes.DELAYED_CAPTURE,
@@ -92,7 +119,7 @@ def delayed_capture(order_number, pnref, amt=None):
     }
     if amt:
         params['AMT'] = amt
-    return _transaction(params)
+    return params
 
 
 def reference_transaction(order_number, pnref, amt):
@@ -101,7 +128,18 @@ def reference_transaction(order_number, pnref, amt):
 
     * The PNREF of the original txn is valid for 12 months
     """
-    params = {
+    return _transaction(_get_reference_transaction_params(order_number, pnref, amt))
+
+
+async def areference_transaction(order_number, pnref, amt):
+    """
+    Asynchronous version of `reference_transaction`
+    """
+    return await _atransaction(_get_reference_transaction_params(order_number, pnref, amt))
+
+
+def _get_reference_transaction_params(order_number, pnref, amt):
+    return {
         'COMMENT1': order_number,
         # Use SALE as we are effectively authorising and settling a new
         # transaction
@@ -110,13 +148,23 @@ def reference_transaction(order_number, pnref, amt):
         'ORIGID': pnref,
         'AMT': amt,
     }
-    return _transaction(params)
 
 
 def credit(order_number, pnref, amt=None):
     """
     Refund money back to a bankcard.
     """
+    return _transaction(_get_credit_params(order_number, pnref, amt))
+
+
+async def acredit(order_number, pnref, amt=None):
+    """
+    Asynchronous version of `credit`
+    """
+    return await _atransaction(_get_credit_params(order_number, pnref, amt))
+
+
+def _get_credit_params(order_number, pnref, amt):
     params = {
         'COMMENT1': order_number,
         'TRXTYPE': codes.CREDIT,
@@ -124,19 +172,29 @@ def credit(order_number, pnref, amt=None):
     }
     if amt:
         params['AMT'] = amt
-    return _transaction(params)
+    return params
 
 
 def void(order_number, pnref):
     """
     Prevent a transaction from being settled
     """
-    params = {
+    return _transaction(_get_void_params(order_number, pnref))
+
+
+async def avoid(order_number, pnref):
+    """
+    Asynchronous version of `void`
+    """
+    return await _atransaction(_get_void_params(order_number, pnref))
+
+
+def _get_void_params(order_number, pnref):
+    return {
         'COMMENT1': order_number,
         'TRXTYPE': codes.VOID,
         'ORIGID': pnref
     }
-    return _transaction(params)
 
 
 def _transaction(extra_params):
@@ -146,6 +204,53 @@ def _transaction(extra_params):
     :extra_params: Additional parameters to include in the payload other than
     the user credentials.
     """
+    url, params = _get_request_params(extra_params)
+    trxtype = params['TRXTYPE']
+    operation = codes.trxtype_map[trxtype]
+    payload = '&'.join(['{}={}'.format(n, v) for n, v in params.items()])
+
+    def post():
+        return gateway.post(url, payload, encode=False, timeout=gateway.get_timeout(operation), operation=operation)
+    with instrumentation.measure(operation, url) as call:
+        if trxtype in RETRYABLE_TRXTYPES:
+            pairs = gateway.call_with_retries(post, operation)
+        else:
+            pairs = post()
+        call.outcome = pairs.get('RESULT')
+    txn = _get_transaction(params, pairs)
+    # All Payflow transactions move money, and are looked up again (eg to
+    # capture an authorization), so are saved straight away
+    audit.save(txn, write_through=True)
+    return txn
+
+
+async def _atransaction(extra_params):
+    """
+    Asynchronous version of `_transaction`
+    """
+    url, params = _get_request_params(extra_params)
+    trxtype = params['TRXTYPE']
+    operation = codes.trxtype_map[trxtype]
+    payload = '&'.join(['{}={}'.format(n, v) for n, v in params.items()])
+
+    def post():
+        return gateway.apost(url, payload, encode=False, timeout=gateway.get_timeout(operation), operation=operation)
+    with instrumentation.measure(operation, url) as call:
+        if trxtype in RETRYABLE_TRXTYPES:
+            pairs = await gateway.acall_with_retries(post, operation)
+        else:
+            pairs = await post()
+        call.outcome = pairs.get('RESULT')
+    txn = _get_transaction(params, pairs)
+    await audit.asave(txn, write_through=True)
+    return txn
+
+
+def _get_request_params(extra_params):
+    """
+    Validate the parameters and return the URL and the full parameters
+    (including credentials) for a transaction.
+    """
     if 'TRXTYPE' not in extra_params:
         raise RuntimeError("All transactions must specify a 'TRXTYPE' parameter")
 
@@ -165,50 +270,43 @@ def _transaction(extra_params):
                     key, trxtype))
 
     # At a minimum, we require a vendor ID and a password.
-    for setting in ('PAYPAL_PAYFLOW_VENDOR_ID',
-                    'PAYPAL_PAYFLOW_PASSWORD'):
-        if not hasattr(settings, setting):
-            raise exceptions.ImproperlyConfigured(
-                "You must define a %s setting" % setting
-            )
+    config = conf.get_config()
+    if config.payflow_vendor_id is None:
+        raise exceptions.ImproperlyConfigured(
+            "You must define a PAYPAL_PAYFLOW_VENDOR_ID setting")
 
     # Set credentials
     params = {
-        'VENDOR': settings.PAYPAL_PAYFLOW_VENDOR_ID,
-        'PWD': settings.PAYPAL_PAYFLOW_PASSWORD,
-        'USER': getattr(settings, 'PAYPAL_PAYFLOW_USER',
-                        settings.PAYPAL_PAYFLOW_VENDOR_ID),
-        'PARTNER': getattr(settings, 'PAYPAL_PAYFLOW_PARTNER',
-                           'PayPal')
+        'VENDOR': config.payflow_vendor_id,
+        'PWD': config.payflow_password,
+        'USER': config.payflow_user,
+        'PARTNER': config.payflow_partner,
     }
     params.update(extra_params)
 
     # Ensure that any amounts have a currency and are formatted correctly
     if 'AMT' in params:
         if 'CURRENCY' not in params:
-            params['CURRENCY'] = getattr(settings,
-                                         'PAYPAL_PAYFLOW_CURRENCY', 'USD')
+            params['CURRENCY'] = config.payflow_currency
         params['AMT'] = "%.2f" % params['AMT']
 
-    if getattr(settings, 'PAYPAL_PAYFLOW_PRODUCTION_MODE', False):
-        url = 'https://payflowpro.paypal.com'
-    else:
-        url = 'https://pilot-payflowpro.paypal.com'
+    url = config.payflow_url
 
     logger.info("Performing %s transaction (trxtype=%s)",
                 codes.trxtype_map[trxtype], trxtype)
-    pairs = gateway.post(
-        url,
-        '&'.join(['{}={}'.format(n, v) for n, v in params.items()]),
-        encode=False
-    )
+    return url, params
+
 
+def _get_transaction(params, pairs):
+    """
+    Return an (unsaved) transaction model recording the request and response
+    """
     # Beware - this log information will contain the Payflow credentials
     # only use it in development, not production.
     logger.debug("Raw request: %s", pairs['_raw_request'])
     logger.debug("Raw response: %s", pairs['_raw_response'])
 
-    return models.PayflowTransaction.objects.create(
+    return models.PayflowTransaction(
         comment1=params['COMMENT1'],
         trxtype=params['TRXTYPE'],
         tender=params.get('TENDER', None),
@@ -10,8 +10,9 @@ from paypal.payflow import codes
 
 class PayflowTransaction(base.ResponseModel):
     # This is the linking parameter between the merchant and PayPal.  It is
-    # normally set to the order number
-    comment1 = models.CharField(_("Comment 1"), max_length=128, db_index=True)
+    # normally set to the order number.  It is indexed by the (comment1,
+    # trxtype) index in Meta.indexes.
+    comment1 = models.CharField(_("Comment 1"), max_length=128)
 
     trxtype = models.CharField(_("Transaction type"), max_length=12)
     tender = models.CharField(_("Bankcard or PayPal"), max_length=12, null=True)
@@ -39,12 +40,16 @@ class PayflowTransaction(base.ResponseModel):
     class Meta:
         ordering = ('-date_created',)
         app_label = 'paypal'
+        indexes = [
+            models.Index(fields=['comment1', 'trxtype'], name='paypal_pf_comment1_trxtype_idx'),
+            models.Index(fields=['date_created'], name='paypal_pf_date_created_idx'),
+        ]
 
-    def save(self, *args, **kwargs):
+    def prepare_to_save(self):
         self.raw_request = re.sub(r'PWD=.+?&', 'PWD=XXXXXX&', self.raw_request)
         self.raw_request = re.sub(r'ACCT=\d+(\d{4})&', 'ACCT=XXXXXXXXXXXX\1&', self.raw_request)
         self.raw_request = re.sub(r'CVV2=\d+&', 'CVV2=XXX&', self.raw_request)
-        return super(PayflowTransaction, self).save(*args, **kwargs)
+        super().prepare_to_save()
 
     def get_trxtype_display(self):
         return gettext(codes.trxtype_map.get(self.trxtype, self.trxtype))
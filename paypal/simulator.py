@@ -0,0 +1,562 @@
+"""
+A local simulator of the PayPal APIs used by this package, for load testing
+checkout without hitting the PayPal sandbox.
+
+It implements the NVP methods used by PayPal Express, the Payflow Pro
+transaction types and the REST order, capture, refund and void endpoints used
+by Express Checkout.  Point the package at it with the ``PAYPAL_NVP_URL``,
+``PAYPAL_PAYFLOW_URL`` and ``PAYPAL_REST_API_URL`` settings.
+
+The simulator is a WSGI application, so it can be served by any WSGI server::
+
+    gunicorn --threads 50 'paypal.simulator:application'
+
+or with the ``paypal_simulator`` management command.  This module doesn't
+depend on Django settings.
+"""
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal as D
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from paypal.payflow import codes
+
+NVP_PATH = '/nvp'
+PAYFLOW_PATH = '/payflow'
+
+REST_ORDER = re.compile(r'^/v2/checkout/orders/(?P<id>[^/]+)$')
+REST_ORDER_ACTION = re.compile(r'^/v2/checkout/orders/(?P<id>[^/]+)/(?P<action>authorize|capture)$')
+REST_AUTHORIZATION_ACTION = re.compile(r'^/v2/payments/authorizations/(?P<id>[^/]+)/(?P<action>capture|void)$')
+REST_CAPTURE_REFUND = re.compile(r'^/v2/payments/captures/(?P<id>[^/]+)/refund$')
+
+HTTP_STATUS = {
+    200: '200 OK',
+    201: '201 Created',
+    204: '204 No Content',
+    404: '404 Not Found',
+    422: '422 Unprocessable Entity',
+    500: '500 Internal Server Error',
+    503: '503 Service Unavailable',
+}
+
+BUYER = {
+    'EMAIL': 'buyer@example.com',
+    'PAYERID': 'SIMULATED7ZTRB',
+    'FIRSTNAME': 'Sam',
+    'LASTNAME': 'Buyer',
+    'COUNTRYCODE': 'GB',
+}
+SHIPPING_ADDRESS = {
+    'PAYMENTREQUEST_0_SHIPTONAME': 'Sam Buyer',
+    'PAYMENTREQUEST_0_SHIPTOSTREET': '1 Main Terrace',
+    'PAYMENTREQUEST_0_SHIPTOCITY': 'Wolverhampton',
+    'PAYMENTREQUEST_0_SHIPTOSTATE': 'West Midlands',
+    'PAYMENTREQUEST_0_SHIPTOZIP': 'W12 4LQ',
+    'PAYMENTREQUEST_0_SHIPTOCOUNTRYCODE': 'GB',
+}
+
+
+class Records:
+    """
+    Thread-safe store of the tokens and transactions the simulator has issued.
+
+    Only the most recent ``max_size`` records are kept so that long load tests
+    don't use up memory.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key, record):
+        with self._lock:
+            self._records[key] = record
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            return self._records.get(key)
+
+
+class Simulator:
+    """
+    WSGI application simulating PayPal.
+
+    :latency: Time in milliseconds to wait before responding.
+    :jitter: Maximum random time in milliseconds added to the latency.
+    :error_rate: Fraction of calls which fail with an API error (eg an
+                 ``ACK=Failure`` NVP response or a non-zero Payflow result).
+    :http_error_rate: Fraction of calls which fail with a 503 response.
+    :seed: Seed for the random number generator, to make runs repeatable.
+    :max_records: Number of tokens and transactions to remember.
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, http_error_rate=0, seed=None, max_records=100000):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.http_error_rate = http_error_rate
+        self.random = random.Random(seed)
+        self.records = Records(max_records)
+        self._ids = itertools.count(1)
+        self._random_lock = threading.Lock()
+
+        self.nvp_methods = {
+            'SetExpressCheckout': self.set_express_checkout,
+            'GetExpressCheckoutDetails': self.get_express_checkout_details,
+            'DoExpressCheckoutPayment': self.do_express_checkout_payment,
+            'DoCapture': self.do_capture,
+            'DoVoid': self.do_void,
+            'RefundTransaction': self.refund_transaction,
+        }
+
+    @classmethod
+    def from_environ(cls, environ):
+        """
+        Create a simulator configured by ``PAYPAL_SIMULATOR_*`` environment
+        variables.
+        """
+        seed = environ.get('PAYPAL_SIMULATOR_SEED')
+        return cls(
+            latency=float(environ.get('PAYPAL_SIMULATOR_LATENCY', 0)),
+            jitter=float(environ.get('PAYPAL_SIMULATOR_JITTER', 0)),
+            error_rate=float(environ.get('PAYPAL_SIMULATOR_ERROR_RATE', 0)),
+            http_error_rate=float(environ.get('PAYPAL_SIMULATOR_HTTP_ERROR_RATE', 0)),
+            seed=int(seed) if seed is not None else None,
+        )
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = environ.get('PATH_INFO', '/')
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length).decode('utf-8') if length else ''
+
+        delay, fail_http, fail_api = self._roll()
+        if delay:
+            time.sleep(delay)
+
+        if fail_http:
+            status, content_type, payload = 503, 'text/plain', 'Service Unavailable'
+        elif path == NVP_PATH and method == 'POST':
+            status, content_type, payload = 200, 'text/plain', self.nvp(dict(parse_qsl(body)), fail_api)
+        elif path == PAYFLOW_PATH and method == 'POST':
+            status, content_type, payload = 200, 'text/plain', self.payflow(dict(parse_qsl(body)), fail_api)
+        elif path.startswith('/v1/') or path.startswith('/v2/'):
+            status, data = self.rest(method, path, body, fail_api)
+            content_type, payload = 'application/json', json.dumps(data) if data is not None else ''
+        else:
+            status, content_type, payload = 404, 'text/plain', 'Not Found'
+
+        data = payload.encode('utf-8')
+        start_response(HTTP_STATUS[status], [
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(data))),
+        ])
+        return [data]
+
+    def _roll(self):
+        with self._random_lock:
+            delay = (self.latency + self.random.uniform(0, self.jitter)) / 1000.0
+            fail_http = self.random.random() < self.http_error_rate
+            fail_api = self.random.random() < self.error_rate
+        return delay, fail_http, fail_api
+
+    def _next_id(self, prefix='', length=17):
+        return '%s%0*X' % (prefix, length, next(self._ids))
+
+    # NVP
+
+    def nvp(self, params, fail=False):
+        method = params.get('METHOD')
+        pairs = {
+            'TIMESTAMP': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'CORRELATIONID': self._next_id(length=13).lower(),
+            'VERSION': params.get('VERSION', ''),
+            'BUILD': '0000000',
+        }
+        if method not in self.nvp_methods:
+            pairs.update(self._nvp_error('81002', 'Unspecified Method', 'Method Specified is not Supported'))
+        elif fail:
+            pairs.update(self._nvp_error(
+                '10001', 'Internal Error', 'Timeout processing request (simulated error)'))
+        else:
+            pairs.update(self.nvp_methods[method](params))
+        return urlencode(pairs)
+
+    def _nvp_error(self, code, short_message, long_message):
+        return {
+            'ACK': 'Failure',
+            'L_ERRORCODE0': code,
+            'L_SHORTMESSAGE0': short_message,
+            'L_LONGMESSAGE0': long_message,
+            'L_SEVERITYCODE0': 'Error',
+        }
+
+    def set_express_checkout(self, params):
+        token = self._next_id('EC-')
+        checkout = {
+            'amount': params.get('PAYMENTREQUEST_0_AMT', '0.00'),
+            'currency': params.get('PAYMENTREQUEST_0_CURRENCYCODE', 'USD'),
+            'shipping_amount': params.get('PAYMENTREQUEST_0_SHIPPINGAMT', '0.00'),
+            'shipping_option': params.get('L_SHIPPINGOPTIONNAME0'),
+            'no_shipping': params.get('NOSHIPPING') == '1',
+            'address': {key: params[key] for key in SHIPPING_ADDRESS if key in params} or SHIPPING_ADDRESS,
+        }
+        self.records.add(token, checkout)
+        return {'ACK': 'Success', 'TOKEN': token}
+
+    def get_express_checkout_details(self, params):
+        token = params.get('TOKEN', '')
+        checkout = self.records.get(token)
+        if checkout is None:
+            return self._nvp_error('10410', 'Invalid token', 'Invalid token.')
+        pairs = {
+            'ACK': 'Success',
+            'TOKEN': token,
+            'CHECKOUTSTATUS': 'PaymentActionNotInitiated',
+            'PAYERSTATUS': 'verified',
+            'CURRENCYCODE': checkout['currency'],
+            'AMT': checkout['amount'],
+            'SHIPPINGAMT': checkout['shipping_amount'],
+            'PAYMENTREQUEST_0_CURRENCYCODE': checkout['currency'],
+            'PAYMENTREQUEST_0_AMT': checkout['amount'],
+            'PAYMENTREQUEST_0_SHIPPINGAMT': checkout['shipping_amount'],
+        }
+        pairs.update(BUYER)
+        if not checkout['no_shipping']:
+            pairs.update(checkout['address'])
+        if checkout['shipping_option']:
+            pairs['SHIPPINGOPTIONNAME'] = checkout['shipping_option']
+        return pairs
+
+    def do_express_checkout_payment(self, params):
+        token = params.get('TOKEN', '')
+        if self.records.get(token) is None:
+            return self._nvp_error('10410', 'Invalid token', 'Invalid token.')
+        transaction_id = self._next_id()
+        amount = params.get('PAYMENTREQUEST_0_AMT', '0.00')
+        currency = params.get('PAYMENTREQUEST_0_CURRENCYCODE', 'USD')
+        action = params.get('PAYMENTREQUEST_0_PAYMENTACTION', 'Sale')
+        self.records.add(transaction_id, {'amount': amount, 'currency': currency, 'action': action})
+        pairs = {
+            'ACK': 'Success',
+            'TOKEN': token,
+            'PAYMENTINFO_0_TRANSACTIONID': transaction_id,
+            'PAYMENTINFO_0_TRANSACTIONTYPE': 'expresscheckout',
+            'PAYMENTINFO_0_PAYMENTTYPE': 'instant',
+            'PAYMENTINFO_0_AMT': amount,
+            'PAYMENTINFO_0_CURRENCYCODE': currency,
+            'PAYMENTINFO_0_ACK': 'Success',
+        }
+        if action == 'Sale':
+            pairs['PAYMENTINFO_0_PAYMENTSTATUS'] = 'Completed'
+            pairs['PAYMENTINFO_0_PENDINGREASON'] = 'None'
+        else:
+            pairs['PAYMENTINFO_0_PAYMENTSTATUS'] = 'Pending'
+            pairs['PAYMENTINFO_0_PENDINGREASON'] = action.lower()
+        return pairs
+
+    def do_capture(self, params):
+        authorization_id = params.get('AUTHORIZATIONID', '')
+        if self.records.get(authorization_id) is None:
+            return self._nvp_error('10609', 'Transaction id is invalid', 'Transaction id is invalid.')
+        transaction_id = self._next_id()
+        self.records.add(transaction_id, {'amount': params.get('AMT'), 'currency': params.get('CURRENCYCODE')})
+        return {
+            'ACK': 'Success',
+            'AUTHORIZATIONID': authorization_id,
+            'TRANSACTIONID': transaction_id,
+            'AMT': params.get('AMT', ''),
+            'CURRENCYCODE': params.get('CURRENCYCODE', ''),
+            'PAYMENTSTATUS': 'Completed',
+        }
+
+    def do_void(self, params):
+        authorization_id = params.get('AUTHORIZATIONID', '')
+        if self.records.get(authorization_id) is None:
+            return self._nvp_error('10609', 'Transaction id is invalid', 'Transaction id is invalid.')
+        return {'ACK': 'Success', 'AUTHORIZATIONID': authorization_id}
+
+    def refund_transaction(self, params):
+        transaction = self.records.get(params.get('TRANSACTIONID', ''))
+        if transaction is None:
+            return self._nvp_error('10004', 'Transaction refused because of an invalid argument',
+                                   'The transaction id is not valid')
+        amount = params.get('AMT') or transaction['amount']
+        return {
+            'ACK': 'Success',
+            'REFUNDTRANSACTIONID': self._next_id(),
+            'GROSSREFUNDAMT': amount,
+            'NETREFUNDAMT': amount,
+            'TOTALREFUNDEDAMOUNT': amount,
+            'CURRENCYCODE': params.get('CURRENCYCODE') or transaction['currency'],
+            'REFUNDSTATUS': 'Instant',
+        }
+
+    # Payflow Pro
+
+    def payflow(self, params, fail=False):
+        trxtype = params.get('TRXTYPE')
+        if trxtype not in codes.trxtype_map:
+            return urlencode({'RESULT': '3', 'RESPMSG': 'Invalid transaction type'})
+        if fail:
+            return urlencode({'RESULT': '12', 'PNREF': self._next_id('S', 11), 'RESPMSG': 'Declined'})
+
+        if trxtype in (codes.DELAYED_CAPTURE, codes.CREDIT, codes.VOID) or params.get('ORIGID'):
+            original = self.records.get(params.get('ORIGID', ''))
+            if original is None:
+                return urlencode({'RESULT': '19', 'PNREF': self._next_id('S', 11),
+                                  'RESPMSG': 'Original transaction ID not found'})
+
+        pnref = self._next_id('S', 11)
+        self.records.add(pnref, {'trxtype': trxtype, 'amount': params.get('AMT')})
+        pairs = {
+            'RESULT': '0',
+            'PNREF': pnref,
+            'RESPMSG': 'Approved',
+        }
+        if trxtype in (codes.SALE, codes.AUTHORIZATION):
+            pairs['AUTHCODE'] = '%06d' % self.random.randint(0, 999999)
+            pairs['AVSADDR'] = 'Y'
+            pairs['AVSZIP'] = 'Y'
+            if params.get('CVV2'):
+                pairs['CVV2MATCH'] = 'Y'
+        if params.get('TENDER') == codes.PAYPAL:
+            pairs['PPREF'] = self._next_id()
+        return urlencode(pairs)
+
+    # REST
+
+    def rest(self, method, path, body, fail=False):
+        """
+        Return the status code and JSON data for a REST API call.
+        """
+        if path == '/v1/oauth2/token' and method == 'POST':
+            return 200, {
+                'scope': 'https://uri.paypal.com/services/payments/payment',
+                'access_token': self._next_id('A21AA', 40),
+                'token_type': 'Bearer',
+                'app_id': 'APP-SIMULATOR',
+                'expires_in': 32400,
+            }
+        if fail:
+            return 500, self._rest_error('INTERNAL_SERVER_ERROR', 'An internal server error occurred (simulated).')
+
+        data = json.loads(body) if body else {}
+        if path == '/v2/checkout/orders' and method == 'POST':
+            return self.create_order(data)
+        match = REST_ORDER.match(path)
+        if match and method == 'GET':
+            return self.get_order(match.group('id'))
+        match = REST_ORDER_ACTION.match(path)
+        if match and method == 'POST':
+            if match.group('action') == 'authorize':
+                return self.authorize_order(match.group('id'))
+            return self.capture_order(match.group('id'))
+        match = REST_AUTHORIZATION_ACTION.match(path)
+        if match and method == 'POST':
+            if match.group('action') == 'void':
+                return self.void_authorization(match.group('id'))
+            return self.capture_authorization(match.group('id'))
+        match = REST_CAPTURE_REFUND.match(path)
+        if match and method == 'POST':
+            return self.refund_capture(match.group('id'), data)
+        return 404, self._rest_error('NOT_FOUND', 'The specified resource does not exist.')
+
+    def _rest_error(self, name, message):
+        return {'name': name, 'message': message, 'debug_id': self._next_id(length=13).lower()}
+
+    def _not_found(self):
+        return 404, self._rest_error('RESOURCE_NOT_FOUND', 'The specified resource does not exist.')
+
+    def create_order(self, data):
+        order_id = self._next_id()
+        purchase_unit = (data.get('purchase_units') or [{}])[0]
+        order = {
+            'id': order_id,
+            'intent': data.get('intent', 'CAPTURE'),
+            'amount': purchase_unit.get('amount', {'currency_code': 'USD', 'value': '0.00'}),
+            'shipping': purchase_unit.get('shipping'),
+        }
+        self.records.add(order_id, order)
+        return 201, {
+            'id': order_id,
+            'status': 'CREATED',
+            'links': [
+                {'href': 'https://www.sandbox.paypal.com/checkoutnow?token=%s' % order_id,
+                 'rel': 'approve', 'method': 'GET'},
+            ],
+        }
+
+    def get_order(self, order_id):
+        order = self.records.get(order_id)
+        if order is None:
+            return self._not_found()
+        shipping = order['shipping'] or {
+            'name': {'full_name': SHIPPING_ADDRESS['PAYMENTREQUEST_0_SHIPTONAME']},
+            'address': {
+                'address_line_1': SHIPPING_ADDRESS['PAYMENTREQUEST_0_SHIPTOSTREET'],
+                'admin_area_2': SHIPPING_ADDRESS['PAYMENTREQUEST_0_SHIPTOCITY'],
+                'admin_area_1': SHIPPING_ADDRESS['PAYMENTREQUEST_0_SHIPTOSTATE'],
+                'postal_code': SHIPPING_ADDRESS['PAYMENTREQUEST_0_SHIPTOZIP'],
+                'country_code': SHIPPING_ADDRESS['PAYMENTREQUEST_0_SHIPTOCOUNTRYCODE'],
+            },
+        }
+        return 200, {
+            'id': order_id,
+            'intent': order['intent'],
+            'status': 'APPROVED',
+            'payer': {
+                'name': {'given_name': BUYER['FIRSTNAME'], 'surname': BUYER['LASTNAME']},
+                'email_address': BUYER['EMAIL'],
+                'payer_id': BUYER['PAYERID'],
+                'address': {'country_code': BUYER['COUNTRYCODE']},
+            },
+            'purchase_units': [{
+                'reference_id': 'default',
+                'amount': order['amount'],
+                'shipping': shipping,
+            }],
+        }
+
+    def authorize_order(self, order_id):
+        order = self.records.get(order_id)
+        if order is None:
+            return self._not_found()
+        authorization_id = self._next_id()
+        self.records.add(authorization_id, {'amount': order['amount']})
+        return 201, {
+            'id': order_id,
+            'status': 'COMPLETED',
+            'purchase_units': [{
+                'reference_id': 'default',
+                'payments': {'authorizations': [
+                    {'id': authorization_id, 'status': 'CREATED', 'amount': order['amount']},
+                ]},
+            }],
+        }
+
+    def capture_order(self, order_id):
+        order = self.records.get(order_id)
+        if order is None:
+            return self._not_found()
+        capture_id = self._next_id()
+        self.records.add(capture_id, {'amount': order['amount']})
+        return 201, {
+            'id': order_id,
+            'status': 'COMPLETED',
+            'purchase_units': [{
+                'reference_id': 'default',
+                'payments': {'captures': [
+                    {'id': capture_id, 'status': 'COMPLETED', 'amount': order['amount']},
+                ]},
+            }],
+        }
+
+    def capture_authorization(self, authorization_id):
+        authorization = self.records.get(authorization_id)
+        if authorization is None:
+            return self._not_found()
+        capture_id = self._next_id()
+        self.records.add(capture_id, {'amount': authorization['amount']})
+        return 201, {'id': capture_id, 'status': 'COMPLETED'}
+
+    def void_authorization(self, authorization_id):
+        if self.records.get(authorization_id) is None:
+            return self._not_found()
+        return 204, None
+
+    def refund_capture(self, capture_id, data):
+        capture = self.records.get(capture_id)
+        if capture is None:
+            return self._not_found()
+        amount = data.get('amount', capture['amount'])
+        if D(amount.get('value', '0')) > D(capture['amount'].get('value', '0')):
+            return 422, self._rest_error(
+                'UNPROCESSABLE_ENTITY', 'The refund amount must be less than or equal to the capture amount.')
+        return 201, {'id': self._next_id(), 'status': 'COMPLETED'}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Request handler passing requests to a WSGI application.
+
+    Unlike ``wsgiref``, it keeps connections alive between requests as PayPal
+    does, so that connection pooling in the client behaves as in production.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_wsgi()
+
+    def do_POST(self):
+        self.handle_wsgi()
+
+    def handle_wsgi(self):
+        parts = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'PATH_INFO': parts.path,
+            'QUERY_STRING': parts.query,
+            'CONTENT_TYPE': self.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(length),
+            'SERVER_NAME': self.server.server_address[0],
+            'SERVER_PORT': str(self.server.server_address[1]),
+            'SERVER_PROTOCOL': self.request_version,
+            'wsgi.input': BytesIO(self.rfile.read(length)),
+            'wsgi.url_scheme': 'http',
+            'wsgi.version': (1, 0),
+            'wsgi.errors': self.server.errors,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for key, value in self.headers.items():
+            environ['HTTP_%s' % key.upper().replace('-', '_')] = value
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+
+        body = b''.join(self.server.application(environ, start_response))
+        code, reason = response['status'].split(' ', 1)
+        self.send_response(int(code), reason)
+        for name, value in response['headers']:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(host, port, application, verbose=False):
+    """
+    Return a threaded HTTP server for the application.  Use port 0 to pick a
+    free port.
+    """
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.application = application
+    server.verbose = verbose
+    server.errors = sys.stderr
+    return server
+
+
+application = Simulator.from_environ(os.environ)
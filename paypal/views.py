@@ -0,0 +1,77 @@
+from django import http
+from django.conf import settings
+from django.utils.dateparse import parse_date
+
+from paypal import cache, export, gateway
+
+
+class DeadlineMixin:
+    """
+    Bound the time a view can spend waiting on PayPal.
+
+    All PayPal calls made while handling the request share the budget set by
+    the ``PAYPAL_REQUEST_DEADLINE`` setting (in seconds).
+    """
+
+    def get_paypal_deadline(self):
+        return getattr(settings, 'PAYPAL_REQUEST_DEADLINE', None)
+
+    def dispatch(self, request, *args, **kwargs):
+        with gateway.deadline(self.get_paypal_deadline()):
+            return super().dispatch(request, *args, **kwargs)
+
+
+class ShippingChargeMixin:
+    """
+    Calculate the charge of each shipping method once per request.
+
+    The charges are shared by the PayPal gateway and facade and by Oscar's
+    checkout, which all need the charge of the selected shipping method.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with cache.shipping_charges():
+            return super().dispatch(request, *args, **kwargs)
+
+    def get_shipping_method(self, basket, shipping_address=None, **kwargs):
+        method = super().get_shipping_method(basket, shipping_address, **kwargs)
+        if method is not None:
+            method = cache.memoize_shipping_charge(method)
+        return method
+
+
+class TransactionExportMixin:
+    """
+    Stream the transactions of an integration as a file download.
+
+    The ``format`` query parameter picks CSV (the default) or JSON lines, and
+    ``date_from`` and ``date_to`` (as YYYY-MM-DD) limit the transactions to
+    those created between the two dates.
+    """
+    integration = None
+
+    def get(self, request, *args, **kwargs):
+        format = request.GET.get('format', export.CSV)
+        if format not in export.CONTENT_TYPES:
+            return http.HttpResponseBadRequest("Unknown export format")
+        try:
+            date_from = self.get_date('date_from')
+            date_to = self.get_date('date_to')
+        except ValueError:
+            return http.HttpResponseBadRequest("Dates must be given as YYYY-MM-DD")
+
+        response = http.StreamingHttpResponse(
+            export.iter_export(self.integration, format, date_from, date_to),
+            content_type=export.CONTENT_TYPES[format])
+        response['Content-Disposition'] = 'attachment; filename="%s"' % export.get_filename(
+            self.integration, format, date_from, date_to)
+        return response
+
+    def get_date(self, name):
+        value = self.request.GET.get(name)
+        if not value:
+            return None
+        date = parse_date(value)
+        if date is None:
+            raise ValueError("Invalid date '%s'" % value)
+        return date
@@ -16,6 +16,7 @@ setup(
     platforms=['linux'],
     packages=find_packages(exclude=['sandbox*', 'tests*']),
     include_package_data=True,
+    python_requires='>=3.8',
     install_requires=[
         'django>=2.2,<4.2',
         'paypal-checkout-serversdk>=1.0.1',
@@ -23,7 +24,10 @@ setup(
         'django-localflavor'
     ],
     extras_require={
-        'oscar': ['django-oscar>=2.0,<4.0']
+        'oscar': ['django-oscar>=2.0,<4.0'],
+        'async': ['httpx>=0.23', 'asgiref>=3.3'],
+        'prometheus': ['prometheus-client>=0.8'],
+        'statsd': ['statsd>=3.2'],
     },
     # See http://pypi.python.org/pypi?%3Aaction=list_classifiers
     classifiers=[
@@ -35,8 +39,6 @@ setup(
         'Operating System :: Unix',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
-        'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         'Programming Language :: Python :: 3.9',
         'Topic :: Other/Nonlisted Topic'],
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
+import time
 from decimal import Decimal as D
 
-from oscar.apps.shipping.methods import Free
+from oscar.apps.shipping.methods import FixedPrice, Free
 
 
 class SecondClassRecorded(Free):
@@ -10,3 +11,16 @@ class SecondClassRecorded(Free):
 
     charge_excl_tax = D('0.00')
     charge_incl_tax = D('0.00')
+
+
+class SlowCourier(FixedPrice):
+    """
+    A method which takes a while to calculate, eg by looking up a carrier's
+    rates
+    """
+    code = 'slow_courier'
+    name = 'Slow courier'
+
+    def calculate(self, basket):
+        time.sleep(0.5)
+        return super().calculate(basket)
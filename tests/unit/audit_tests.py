@@ -0,0 +1,130 @@
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.test import TestCase, override_settings
+
+from paypal import audit
+from paypal.express import gateway as express_gateway
+from paypal.express.models import ExpressTransaction
+from paypal.payflow.models import PayflowTransaction
+
+
+def create_txn(**kwargs):
+    params = {
+        'method': 'GetExpressCheckoutDetails',
+        'version': '119',
+        'ack': 'Success',
+        'token': 'EC-8P797793UC466090M',
+        'raw_request': 'PWD=1432777837&METHOD=GetExpressCheckoutDetails',
+        'raw_response': 'ACK=Success&TOKEN=EC%2d8P797793UC466090M',
+        'response_time': 0,
+    }
+    params.update(kwargs)
+    return ExpressTransaction(**params)
+
+
+@override_settings(PAYPAL_AUDIT_WRITE_BEHIND=True)
+@mock.patch('paypal.audit._ensure_writer')
+class TestWriteBehind(TestCase):
+
+    def tearDown(self):
+        audit.flush()
+        super().tearDown()
+
+    def test_txn_is_saved_on_flush(self, ensure_writer):
+        txn = create_txn()
+        audit.save(txn)
+        self.assertTrue(ensure_writer.called)
+        self.assertIsNone(txn.pk)
+        self.assertFalse(ExpressTransaction.objects.exists())
+
+        audit.flush()
+        saved_txn = ExpressTransaction.objects.get()
+        self.assertEqual('EC-8P797793UC466090M', saved_txn.token)
+        self.assertEqual('Success', saved_txn.response_data['ACK'])
+
+    def test_txns_are_prepared_before_they_are_buffered(self, ensure_writer):
+        txn = create_txn()
+        audit.save(txn)
+        self.assertNotIn('1432777837', txn.raw_request)
+
+    def test_txns_of_different_models_are_saved_in_batches(self, ensure_writer):
+        for _ in range(3):
+            audit.save(create_txn())
+        audit.save(PayflowTransaction(comment1='1234', trxtype='S', pnref='V25A2BB645A7', respmsg='Approved',
+                                      raw_request='', raw_response='', response_time=0))
+        with self.assertNumQueries(2):
+            audit.flush()
+        self.assertEqual(3, ExpressTransaction.objects.count())
+        self.assertEqual(1, PayflowTransaction.objects.count())
+
+    def test_full_buffer_wakes_writer(self, ensure_writer):
+        with override_settings(PAYPAL_AUDIT_BATCH_SIZE=2), mock.patch('paypal.audit._wakeup') as wakeup:
+            audit.save(create_txn())
+            self.assertFalse(wakeup.set.called)
+            audit.save(create_txn())
+            self.assertTrue(wakeup.set.called)
+
+    def test_write_through(self, ensure_writer):
+        with audit.write_through():
+            txn = create_txn()
+            audit.save(txn)
+        self.assertIsNotNone(txn.pk)
+
+    def test_money_moving_txns_are_written_through(self, ensure_writer):
+        txn = create_txn(method='DoCapture')
+        audit.save(txn, write_through=True)
+        self.assertIsNotNone(txn.pk)
+
+    def test_express_captures_are_saved_straight_away(self, ensure_writer):
+        pairs = {'ACK': 'Success', 'CORRELATIONID': '4d1e8d9b4e4a1', '_raw_request': '',
+                 '_raw_response': 'ACK=Success', '_response_time': 0}
+        with mock.patch('paypal.gateway.post', return_value=pairs):
+            express_gateway.do_void('8FC75367UA2217536')
+        self.assertTrue(ExpressTransaction.objects.filter(method='DoVoid').exists())
+
+    def test_failed_batch_is_kept_for_next_flush(self, ensure_writer):
+        audit.save(create_txn())
+        with mock.patch.object(ExpressTransaction.objects, 'bulk_create', side_effect=Exception("Down")), \
+                mock.patch.object(ExpressTransaction, 'save', side_effect=Exception("Down")):
+            with self.assertLogs('paypal.audit', 'ERROR'):
+                audit.flush()
+        self.assertFalse(ExpressTransaction.objects.exists())
+        audit.flush()
+        self.assertEqual(1, ExpressTransaction.objects.count())
+
+    def test_failed_batch_is_saved_one_at_a_time(self, ensure_writer):
+        audit.save(create_txn())
+        audit.save(create_txn())
+        with mock.patch.object(ExpressTransaction.objects, 'bulk_create', side_effect=Exception("Bad record")):
+            with self.assertLogs('paypal.audit', 'ERROR'):
+                audit.flush()
+        self.assertEqual(2, ExpressTransaction.objects.count())
+
+    @override_settings(PAYPAL_AUDIT_MAX_ATTEMPTS=2)
+    def test_txn_is_dropped_after_max_attempts(self, ensure_writer):
+        audit.save(create_txn())
+        with mock.patch.object(ExpressTransaction.objects, 'bulk_create', side_effect=Exception("Down")), \
+                mock.patch.object(ExpressTransaction, 'save', side_effect=Exception("Bad record")):
+            with self.assertLogs('paypal.audit', 'ERROR'):
+                audit.flush()
+            self.assertEqual(1, len(audit._buffer))
+            with self.assertLogs('paypal.audit', 'ERROR') as logs:
+                audit.flush()
+        self.assertEqual([], audit._buffer)
+        self.assertIn('dropping it', logs.output[-1])
+        self.assertIn('ACK=Success', logs.output[-1])
+
+    def test_async_save(self, ensure_writer):
+        txn = create_txn()
+        async_to_sync(audit.asave)(txn)
+        self.assertIsNone(txn.pk)
+
+
+class TestWriteBehindDisabled(TestCase):
+
+    def test_txn_is_saved_immediately(self):
+        txn = create_txn()
+        audit.save(txn)
+        self.assertIsNotNone(txn.pk)
+        self.assertNotIn('1432777837', ExpressTransaction.objects.get().raw_request)
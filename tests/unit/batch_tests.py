@@ -0,0 +1,205 @@
+import csv
+import io
+import tempfile
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase
+from oscar.core.loading import get_model
+from oscar.test.factories import SourceFactory, SourceTypeFactory, create_order
+
+from paypal import exceptions
+from paypal.batch import engine
+from paypal.batch.models import BatchResult
+from paypal.express.gateway import REFUND_TRANSACTION
+from paypal.express.models import ExpressTransaction
+from paypal.express_checkout.models import ExpressCheckoutTransaction
+from paypal.payflow import codes
+from paypal.payflow.models import PayflowTransaction
+
+Order = get_model('order', 'Order')
+
+
+class BatchMixin:
+
+    def setUp(self):
+        source_type = SourceTypeFactory(name='PayPal')
+        self.orders = []
+        for number in ('100001', '100002'):
+            order = create_order(number=number)
+            SourceFactory(order=order, source_type=source_type, reference='EC-%s' % number)
+            self.orders.append(order)
+        self.action = mock.Mock(side_effect=lambda order_number, token: 'TXN-%s' % order_number)
+        patcher = mock.patch.dict(engine._ACTIONS, {
+            (BatchResult.CAPTURE, BatchResult.EXPRESS): self.action})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestCapture(BatchMixin, TestCase):
+
+    def test_captures_a_queryset_of_orders(self):
+        summary = engine.capture(Order.objects.all(), BatchResult.EXPRESS, batch_id='test')
+        self.assertEqual({'batch_id': 'test', 'succeeded': 2, 'failed': 0, 'unknown': 0, 'skipped': 0}, summary)
+        self.action.assert_any_call('100001', 'EC-100001')
+        result = BatchResult.objects.get(order_number='100002')
+        self.assertTrue(result.is_successful)
+        self.assertEqual('TXN-100002', result.transaction_id)
+        self.assertEqual(BatchResult.EXPRESS, result.integration)
+
+    def test_records_failures(self):
+        self.action.side_effect = Exception("Authorization has expired")
+        summary = engine.capture(['100001', '999999'], BatchResult.EXPRESS, workers=2, chunk_size=1)
+        self.assertEqual(2, summary['failed'])
+        self.assertEqual("Authorization has expired",
+                         BatchResult.objects.get(order_number='100001').error_message)
+        self.assertEqual("No PayPal payment found",
+                         BatchResult.objects.get(order_number='999999').error_message)
+        # Orders without a payment aren't sent to PayPal
+        self.assertEqual(1, self.action.call_count)
+
+    def test_resumed_batch_skips_captured_orders(self):
+        self.action.side_effect = ['TXN-1', Exception("Try again")]
+        first = engine.capture(['100001', '100002'], BatchResult.EXPRESS, workers=1)
+        self.assertEqual(1, first['failed'])
+
+        self.action.side_effect = lambda order_number, token: 'TXN-2'
+        second = engine.capture(['100001', '100002'], BatchResult.EXPRESS, batch_id=first['batch_id'])
+        self.assertEqual(
+            {'batch_id': first['batch_id'], 'succeeded': 1, 'failed': 0, 'unknown': 0, 'skipped': 1}, second)
+        self.action.assert_called_with('100002', 'EC-100002')
+
+    def test_calls_without_a_response_are_not_sent_again(self):
+        self.action.side_effect = exceptions.CommunicationError("Unable to communicate with PayPal")
+        first = engine.capture(['100001'], BatchResult.EXPRESS)
+        self.assertEqual(1, first['unknown'])
+        self.assertEqual(0, first['failed'])
+        self.assertEqual(BatchResult.UNKNOWN, BatchResult.objects.get().status)
+
+        # PayPal may have captured the payment, so it is left to be checked
+        second = engine.capture(['100001'], BatchResult.EXPRESS, batch_id=first['batch_id'])
+        self.assertEqual(1, second['unknown'])
+        self.assertEqual(1, self.action.call_count)
+
+        self.action.side_effect = lambda order_number, token: 'TXN-1'
+        third = engine.capture(['100001'], BatchResult.EXPRESS, batch_id=first['batch_id'], retry_unknown=True)
+        self.assertEqual(1, third['succeeded'])
+        self.assertEqual(2, self.action.call_count)
+
+    def test_orders_of_an_interrupted_chunk_are_not_sent_again(self):
+        BatchResult.objects.create(
+            batch_id='test', action=BatchResult.CAPTURE, integration=BatchResult.EXPRESS, order_number='100001',
+            reference='EC-100001', status=BatchResult.PENDING)
+        summary = engine.capture(['100001', '100002'], BatchResult.EXPRESS, batch_id='test')
+        self.assertEqual({'batch_id': 'test', 'succeeded': 1, 'failed': 0, 'unknown': 1, 'skipped': 0}, summary)
+        self.action.assert_called_once_with('100002', 'EC-100002')
+
+    def test_orders_are_pending_until_their_results_are_written(self):
+        self.action.side_effect = KeyboardInterrupt
+        with self.assertRaises(KeyboardInterrupt):
+            engine.capture(['100001'], BatchResult.EXPRESS, batch_id='test')
+        self.assertEqual(BatchResult.PENDING, BatchResult.objects.get().status)
+
+        self.action.side_effect = lambda order_number, token: 'TXN-1'
+        engine.capture(['100001'], BatchResult.EXPRESS, batch_id='test', retry_unknown=True)
+        self.assertEqual([BatchResult.SUCCEEDED], list(BatchResult.objects.values_list('status', flat=True)))
+
+    def test_calls_which_were_not_made_have_failed(self):
+        self.action.side_effect = exceptions.CircuitOpen("PayPal is unavailable")
+        summary = engine.capture(['100001'], BatchResult.EXPRESS)
+        self.assertEqual(1, summary['failed'])
+        self.assertEqual(0, summary['unknown'])
+
+    def test_rejects_unknown_action(self):
+        with self.assertRaises(ValueError):
+            engine.run('reauthorize', ['100001'], BatchResult.EXPRESS)
+
+
+class TestRefund(BatchMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(engine._ACTIONS, {
+            (BatchResult.REFUND, BatchResult.EXPRESS): self.action,
+            (BatchResult.REFUND, BatchResult.EXPRESS_CHECKOUT): self.action,
+            (BatchResult.VOID, BatchResult.PAYFLOW): self.action})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_orders_are_only_refunded_once(self):
+        first = engine.refund(['100001', '100001'], BatchResult.EXPRESS)
+        self.assertEqual(1, first['succeeded'])
+        self.assertEqual(1, first['skipped'])
+
+        # Not even by another batch
+        second = engine.refund(['100001', '100002'], BatchResult.EXPRESS)
+        self.assertEqual(
+            {'batch_id': second['batch_id'], 'succeeded': 1, 'failed': 0, 'unknown': 0, 'skipped': 1}, second)
+        self.assertEqual(2, self.action.call_count)
+
+    def test_refunds_made_outside_a_batch_are_skipped(self):
+        ExpressCheckoutTransaction.objects.create(
+            order_id='EC-100001', refund_id='REFUND', status=ExpressCheckoutTransaction.COMPLETED,
+            intent=ExpressCheckoutTransaction.CAPTURE)
+        summary = engine.refund(['100001', '100002'], BatchResult.EXPRESS_CHECKOUT)
+        self.assertEqual(1, summary['skipped'])
+        self.action.assert_called_once_with('100002', 'EC-100002')
+
+    def test_express_refunds_made_outside_a_batch_are_skipped(self):
+        ExpressTransaction.objects.create(
+            token='EC-100001', method=REFUND_TRANSACTION, ack=ExpressTransaction.SUCCESS, response_time=0)
+        summary = engine.refund(['100001', '100002'], BatchResult.EXPRESS)
+        self.assertEqual(1, summary['skipped'])
+        self.action.assert_called_once_with('100002', 'EC-100002')
+
+    def test_payflow_voids_use_the_authorization(self):
+        PayflowTransaction.objects.create(
+            comment1='100001', trxtype=codes.AUTHORIZATION, pnref='PNREF1', result='0', response_time=0)
+        engine.void(['100001'], BatchResult.PAYFLOW)
+        self.action.assert_called_once_with('100001', 'PNREF1')
+
+    def test_writes_report(self):
+        self.action.side_effect = ['REFUND1', Exception("Refund refused")]
+        summary = engine.refund(['100001', '100002'], BatchResult.EXPRESS, workers=1)
+        report = io.StringIO()
+        engine.write_report(summary['batch_id'], report)
+        rows = list(csv.DictReader(io.StringIO(report.getvalue())))
+        self.assertEqual(['100001', '100002'], [row['order_number'] for row in rows])
+        self.assertEqual('REFUND1', rows[0]['transaction_id'])
+        self.assertEqual('Refund refused', rows[1]['error_message'])
+
+
+class TestCaptureCommand(BatchMixin, TestCase):
+
+    def test_captures_orders_in_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+            f.write('100001\n\n100002\n')
+            f.flush()
+            out = io.StringIO()
+            call_command('paypal_capture', 'express', '--file', f.name, '--batch-id', 'nightly', stdout=out)
+        self.assertIn('Batch nightly: 2 succeeded, 0 failed', out.getvalue())
+        self.assertEqual(2, BatchResult.objects.filter(batch_id='nightly').count())
+
+
+class TestRateLimiter(TestCase):
+
+    @mock.patch('paypal.batch.engine.time')
+    def test_spaces_out_calls(self, time):
+        time.monotonic.return_value = 10.0
+        limiter = engine.RateLimiter(4)
+        for __ in range(3):
+            limiter.wait()
+        self.assertEqual([mock.call(0.25), mock.call(0.5)], time.sleep.call_args_list)
+
+
+class TestBatchCommand(BatchMixin, TestCase):
+
+    def test_writes_report(self):
+        Order.objects.update(status='Pending')
+        with mock.patch.dict(engine._ACTIONS, {(BatchResult.VOID, BatchResult.EXPRESS): self.action}):
+            with tempfile.NamedTemporaryFile('r', suffix='.csv') as report:
+                call_command('paypal_batch', 'void', 'express', '--status', 'Pending', '--report', report.name,
+                             stdout=io.StringIO())
+                rows = list(csv.DictReader(report))
+        self.assertEqual(2, len(rows))
+        self.assertEqual({'void'}, {row['action'] for row in rows})
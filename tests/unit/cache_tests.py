@@ -0,0 +1,195 @@
+from decimal import Decimal as D
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from oscar.apps.shipping.methods import FixedPrice, Free
+from oscar.core.loading import get_model
+from oscar.test import factories
+from oscar.test.factories import create_basket, create_product
+
+from paypal import cache
+from paypal.views import ShippingChargeMixin
+
+Country = get_model('address', 'Country')
+SourceType = get_model('payment', 'SourceType')
+
+
+class TestLRUCache(TestCase):
+
+    def setUp(self):
+        self.cache = cache.LRUCache(2)
+
+    def test_counts_hits_and_misses(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1)
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertEqual({'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 2}, self.cache.stats())
+
+    def test_drops_least_recently_used_item(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(2, len(self.cache))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(1, self.cache.get('a'))
+
+    def test_get_or_set_only_calls_func_on_a_miss(self):
+        func = mock.Mock(return_value=1)
+        self.assertEqual(1, self.cache.get_or_set('a', func))
+        self.assertEqual(1, self.cache.get_or_set('a', func))
+        self.assertEqual(1, func.call_count)
+
+
+class TestProductFields(TestCase):
+
+    def setUp(self):
+        cache.get_product_cache().clear()
+        self.product = create_product(title='Fish')
+        self.build = mock.Mock(side_effect=lambda product: product.title)
+
+    def test_are_cached(self):
+        self.assertEqual('Fish', cache.get_product_fields(self.product, 'test', self.build))
+        self.assertEqual('Fish', cache.get_product_fields(self.product, 'test', self.build))
+        self.assertEqual(1, self.build.call_count)
+        self.assertEqual(1, cache.get_product_cache().stats()['hits'])
+
+    def test_are_rebuilt_when_the_product_is_updated(self):
+        cache.get_product_fields(self.product, 'test', self.build)
+        self.product.title = 'Chips'
+        self.product.save()
+        self.assertEqual('Chips', cache.get_product_fields(self.product, 'test', self.build))
+
+    def test_are_cached_for_each_namespace(self):
+        cache.get_product_fields(self.product, 'test', self.build)
+        cache.get_product_fields(self.product, 'other', self.build)
+        self.assertEqual(2, self.build.call_count)
+
+    @override_settings(PAYPAL_PRODUCT_CACHE_SIZE=0)
+    def test_can_be_disabled(self):
+        cache.get_product_fields(self.product, 'test', self.build)
+        cache.get_product_fields(self.product, 'test', self.build)
+        self.assertEqual(2, self.build.call_count)
+
+    def test_cache_follows_size_setting(self):
+        with override_settings(PAYPAL_PRODUCT_CACHE_SIZE=5):
+            self.assertEqual(5, cache.get_product_cache().maxsize)
+
+
+class TestShippingCharges(TestCase):
+
+    def setUp(self):
+        self.basket = create_basket(empty=True)
+        self.method = Free()
+        self.method.calculate = mock.Mock(wraps=self.method.calculate)
+
+    def test_are_calculated_each_time_outside_a_block(self):
+        cache.get_shipping_charge(self.method, self.basket)
+        cache.get_shipping_charge(self.method, self.basket)
+        self.assertEqual(2, self.method.calculate.call_count)
+
+    def test_are_calculated_once_within_a_block(self):
+        with cache.shipping_charges():
+            charge = cache.get_shipping_charge(self.method, self.basket)
+            # Another instance of the same method
+            self.assertIs(charge, cache.get_shipping_charge(Free(), self.basket))
+        self.assertEqual(1, self.method.calculate.call_count)
+
+    def test_are_kept_for_each_fixed_price(self):
+        with cache.shipping_charges():
+            first = cache.get_shipping_charge(FixedPrice(D('1.00'), D('1.00')), self.basket)
+            second = cache.get_shipping_charge(FixedPrice(D('2.00'), D('2.00')), self.basket)
+        self.assertEqual(D('1.00'), first.incl_tax)
+        self.assertEqual(D('2.00'), second.incl_tax)
+
+    def test_memoized_methods_share_charges(self):
+        method = cache.memoize_shipping_charge(self.method)
+        with cache.shipping_charges():
+            method.calculate(self.basket)
+            cache.get_shipping_charge(Free(), self.basket)
+            cache.get_shipping_charge(method, self.basket)
+            method.calculate(self.basket)
+        self.assertEqual(1, self.method.calculate.call_count)
+
+    def test_memoizing_leaves_the_method_as_it_is(self):
+        # Eg a method shared by a shipping repository
+        calculate = self.method.calculate
+        method = cache.memoize_shipping_charge(self.method)
+        self.assertIs(calculate, self.method.calculate)
+        self.assertEqual(self.method.code, method.code)
+        self.assertIs(method, cache.memoize_shipping_charge(method))
+        with cache.shipping_charges():
+            self.method.calculate(self.basket)
+            method.calculate(self.basket)
+        self.assertEqual(2, calculate.call_count)
+
+
+class TestShippingChargeMixin(TestCase):
+
+    def test_shares_charges_within_a_request(self):
+        basket = create_basket(empty=True)
+        method = Free()
+        calculate = mock.Mock(wraps=method.calculate)
+        method.calculate = calculate
+
+        class BaseView:
+            def get_shipping_method(self, basket, shipping_address=None, **kwargs):
+                return method
+
+            def dispatch(self, request, *args, **kwargs):
+                # Eg Oscar's checkout and then the PayPal gateway
+                self.get_shipping_method(basket).calculate(basket)
+                cache.get_shipping_charge(self.get_shipping_method(basket), basket)
+
+        class View(ShippingChargeMixin, BaseView):
+            pass
+
+        View().dispatch(None)
+        self.assertEqual(1, calculate.call_count)
+
+
+@mock.patch('paypal.cache.transaction.on_commit', new=lambda func, using=None: func())
+class TestLookups(TestCase):
+
+    def setUp(self):
+        cache.clear_lookups()
+        self.addCleanup(cache.clear_lookups)
+        self.country = factories.CountryFactory(iso_3166_1_a2='GB', name='UNITED KINGDOM')
+
+    def test_countries_are_cached(self):
+        self.assertEqual(self.country, cache.get_country('GB'))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.country, cache.get_country('GB'))
+
+    def test_missing_countries_are_not_cached(self):
+        for __ in range(2):
+            with self.assertNumQueries(1):
+                with self.assertRaises(Country.DoesNotExist):
+                    cache.get_country('XX')
+
+    def test_countries_are_reloaded_when_one_is_saved(self):
+        cache.get_country('GB')
+        self.country.printable_name = 'United Kingdom of Great Britain'
+        self.country.save()
+        self.assertEqual('United Kingdom of Great Britain', cache.get_country('GB').printable_name)
+
+    def test_source_types_are_created_and_cached(self):
+        source_type = cache.get_source_type('PayPal')
+        self.assertEqual('PayPal', source_type.name)
+        with self.assertNumQueries(0):
+            self.assertEqual(source_type, cache.get_source_type('PayPal'))
+
+    def test_source_types_are_reloaded_when_one_is_deleted(self):
+        source_type = cache.get_source_type('PayPal')
+        source_type.delete()
+        self.assertEqual(1, SourceType.objects.filter(pk=cache.get_source_type('PayPal').pk).count())
+
+
+class TestLookupsInTransactions(TestCase):
+
+    def test_are_only_cached_once_committed(self):
+        cache.clear_lookups()
+        # The test's transaction is rolled back, so the row mustn't be kept
+        cache.get_source_type('PayPal')
+        with self.assertNumQueries(1):
+            cache.get_source_type('PayPal')
@@ -0,0 +1,137 @@
+import asyncio
+from unittest import mock
+
+import requests
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from paypal import circuit, exceptions, gateway
+
+URL = 'https://api-3t.sandbox.paypal.com/nvp'
+
+
+@override_settings(PAYPAL_CIRCUIT_BREAKER_THRESHOLD=2, PAYPAL_CIRCUIT_BREAKER_RESET_TIMEOUT=30)
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        circuit.reset()
+        self.addCleanup(circuit.reset)
+
+    def post(self, side_effect, operation='SetExpressCheckout'):
+        with mock.patch('requests.Session.post', side_effect=side_effect) as session_post:
+            try:
+                gateway.post(URL, {}, operation=operation)
+            except exceptions.PayPalError as e:
+                return e, session_post.call_count
+        return None, session_post.call_count
+
+    def fail(self, operation='SetExpressCheckout'):
+        return self.post(requests.ConnectionError(), operation)
+
+    def succeed(self, operation='SetExpressCheckout'):
+        return self.post(lambda *args, **kwargs: mock.Mock(status_code=200, text='ACK=Success'), operation)
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail()
+        self.fail()
+        error, calls = self.fail()
+        self.assertIsInstance(error, exceptions.CircuitOpen)
+        self.assertEqual(0, calls)
+        self.assertEqual({(URL, 'SetExpressCheckout'): circuit.OPEN}, circuit.get_states())
+
+    def test_success_resets_the_count(self):
+        self.fail()
+        self.succeed()
+        self.fail()
+        error, calls = self.succeed()
+        self.assertIsNone(error)
+        self.assertEqual(1, calls)
+
+    def test_client_errors_are_not_counted(self):
+        for __ in range(3):
+            error, calls = self.post(lambda *args, **kwargs: mock.Mock(status_code=400, text=''))
+            self.assertEqual(1, calls)
+
+    def test_circuits_are_kept_for_each_operation(self):
+        self.fail()
+        self.fail()
+        error, calls = self.succeed('GetExpressCheckoutDetails')
+        self.assertIsNone(error)
+
+    def test_half_open_circuit_is_closed_by_a_successful_probe(self):
+        self.fail()
+        self.fail()
+        with mock.patch('paypal.circuit.time.time', return_value=circuit.time.time() + 31):
+            error, calls = self.succeed()
+            self.assertIsNone(error)
+            self.assertEqual({(URL, 'SetExpressCheckout'): circuit.CLOSED}, circuit.get_states())
+
+    def test_half_open_circuit_is_opened_again_by_a_failed_probe(self):
+        self.fail()
+        self.fail()
+        with mock.patch('paypal.circuit.time.time', return_value=circuit.time.time() + 31):
+            error, calls = self.fail()
+            self.assertEqual(1, calls)
+            error, calls = self.succeed()
+        self.assertIsInstance(error, exceptions.CircuitOpen)
+
+    def test_only_one_probe_is_let_through(self):
+        breaker = circuit.get_breaker(URL, 'SetExpressCheckout')
+        breaker.failed()
+        breaker.failed()
+        with mock.patch('paypal.circuit.time.time', return_value=circuit.time.time() + 31):
+            breaker.check()
+            with self.assertRaises(exceptions.CircuitOpen):
+                breaker.check()
+
+    def test_cancelled_probe_lets_another_through(self):
+        self.fail()
+        self.fail()
+
+        async def probe():
+            with mock.patch('paypal.gateway.get_async_client') as get_client:
+                get_client.return_value.post = mock.AsyncMock(side_effect=asyncio.CancelledError)
+                await gateway.apost(URL, {}, operation='SetExpressCheckout')
+
+        with mock.patch('paypal.circuit.time.time', return_value=circuit.time.time() + 31):
+            with self.assertRaises(asyncio.CancelledError):
+                asyncio.run(probe())
+            error, calls = self.succeed()
+        self.assertIsNone(error)
+        self.assertEqual(1, calls)
+
+    @override_settings(PAYPAL_CIRCUIT_BREAKER_THRESHOLD=0)
+    def test_can_be_disabled(self):
+        for __ in range(3):
+            error, calls = self.fail()
+            self.assertEqual(1, calls)
+
+    def test_open_circuit_is_not_retried(self):
+        self.fail()
+        self.fail()
+        func = mock.Mock(side_effect=lambda: gateway.post(URL, {}, operation='SetExpressCheckout'))
+        with self.assertRaises(exceptions.CircuitOpen):
+            gateway.call_with_retries(func, 'SetExpressCheckout', (exceptions.PayPalError,))
+        self.assertEqual(1, func.call_count)
+
+
+@override_settings(PAYPAL_CIRCUIT_BREAKER_THRESHOLD=1, PAYPAL_CIRCUIT_BREAKER_CACHE='default')
+class TestSharedCircuitBreaker(TestCase):
+
+    def setUp(self):
+        circuit.reset()
+        cache.clear()
+        self.addCleanup(circuit.reset)
+
+    def test_open_circuit_is_shared_through_cache(self):
+        circuit.get_breaker(URL, 'SetExpressCheckout').failed()
+        # Eg another process
+        circuit.reset()
+        with self.assertRaises(exceptions.CircuitOpen):
+            circuit.get_breaker(URL, 'SetExpressCheckout').check()
+
+    def test_closed_circuit_is_removed_from_cache(self):
+        breaker = circuit.get_breaker(URL, 'SetExpressCheckout')
+        breaker.failed()
+        breaker.succeeded()
+        self.assertIsNone(cache.get(breaker.cache_key))
@@ -0,0 +1,56 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+
+from paypal import conf
+
+
+class TestConfig(TestCase):
+
+    def test_is_built_once(self):
+        self.assertIs(conf.get_config(), conf.get_config())
+
+    def test_is_rebuilt_when_a_setting_changes(self):
+        config = conf.get_config()
+        with override_settings(PAYPAL_SANDBOX_MODE=False):
+            self.assertIsNot(config, conf.get_config())
+            self.assertEqual('https://api-3t.paypal.com/nvp', conf.get_config().nvp_url)
+        self.assertEqual('https://api-3t.sandbox.paypal.com/nvp', conf.get_config().nvp_url)
+
+    def test_unrelated_settings_dont_rebuild_it(self):
+        config = conf.get_config()
+        with override_settings(USE_TZ=False):
+            self.assertIs(config, conf.get_config())
+
+    def test_is_checked_when_the_app_is_ready(self):
+        with override_settings(PAYPAL_LOCALE='XX'):
+            with self.assertRaises(ImproperlyConfigured):
+                apps.get_app_config('paypal').ready()
+
+    def test_rejects_invalid_landing_page(self):
+        with override_settings(PAYPAL_LANDING_PAGE='SOMEWHERE'):
+            with self.assertRaises(ImproperlyConfigured):
+                conf.get_config()
+
+    def test_accepts_express_landing_page(self):
+        with override_settings(PAYPAL_LANDING_PAGE='Login'):
+            config = conf.get_config()
+        self.assertEqual('LOGIN', config.landing_page)
+        self.assertEqual('Login', config.set_txn_defaults['LANDINGPAGE'])
+
+    def test_rejects_incomplete_credentials(self):
+        with override_settings():
+            del settings.PAYPAL_PAYFLOW_PASSWORD
+            with self.assertRaises(ImproperlyConfigured):
+                conf.Config()
+
+    def test_allows_missing_credentials(self):
+        with override_settings():
+            del settings.PAYPAL_CLIENT_ID
+            del settings.PAYPAL_CLIENT_SECRET
+            self.assertIsNone(conf.Config().client_id)
+
+    def test_payflow_user_defaults_to_vendor(self):
+        with override_settings(PAYPAL_PAYFLOW_VENDOR_ID='vendor'):
+            self.assertEqual('vendor', conf.get_config().payflow_user)
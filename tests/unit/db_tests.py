@@ -0,0 +1,38 @@
+from unittest import mock
+
+from django.apps import apps
+from django.db import connection, models
+from django.db.migrations.state import ProjectState
+from django.test import SimpleTestCase
+
+from paypal.db import AddIndexConcurrently
+
+
+class TestAddIndexConcurrently(SimpleTestCase):
+
+    def setUp(self):
+        self.operation = AddIndexConcurrently(
+            model_name='payflowtransaction',
+            index=models.Index(fields=['comment1', 'trxtype'], name='test_comment1_trxtype_idx'))
+        self.from_state = ProjectState.from_apps(apps)
+        self.to_state = self.from_state.clone()
+        self.operation.state_forwards('paypal', self.to_state)
+
+    def collect_sql(self, forwards=True):
+        schema_editor = connection.SchemaEditorClass(connection, collect_sql=True)
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            if forwards:
+                self.operation.database_forwards('paypal', schema_editor, self.from_state, self.to_state)
+            else:
+                self.operation.database_backwards('paypal', schema_editor, self.to_state, self.from_state)
+        return schema_editor.collected_sql
+
+    def test_creates_index_concurrently_on_postgresql(self):
+        sql = self.collect_sql()
+        self.assertEqual(1, len(sql))
+        self.assertTrue(sql[0].startswith('CREATE INDEX CONCURRENTLY "test_comment1_trxtype_idx"'))
+
+    def test_drops_index_concurrently_on_postgresql(self):
+        sql = self.collect_sql(forwards=False)
+        self.assertEqual(1, len(sql))
+        self.assertTrue(sql[0].startswith('DROP INDEX CONCURRENTLY'))
@@ -0,0 +1,83 @@
+import csv
+import datetime
+import json
+from decimal import Decimal as D
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase
+
+from paypal import export
+from paypal.express.dashboard.views import TransactionExportView
+from paypal.express.models import ExpressTransaction
+
+
+def create_txns(count):
+    ExpressTransaction.objects.bulk_create(
+        ExpressTransaction(method='DoExpressCheckoutPayment', version='119', ack='Success', amount=D('10.00'),
+                           currency='GBP', token='EC-%d' % i, raw_request='', raw_response='', response_time=100)
+        for i in range(count))
+
+
+class TestExport(TestCase):
+
+    def test_csv_has_a_header_and_row_for_each_transaction(self):
+        create_txns(2)
+        rows = list(csv.reader(''.join(export.iter_export(export.EXPRESS)).splitlines()))
+        self.assertEqual(list(export.FIELDS[export.EXPRESS]), rows[0])
+        self.assertEqual(['EC-0', 'EC-1'], [row[6] for row in rows[1:]])
+
+    def test_json_lines(self):
+        create_txns(1)
+        line, = ''.join(export.iter_export(export.EXPRESS, export.JSONL)).splitlines()
+        row = json.loads(line)
+        self.assertEqual('EC-0', row['token'])
+        self.assertEqual('10.00', row['amount'])
+
+    def test_rows_are_written_in_batches(self):
+        create_txns(150)
+        chunks = list(export.iter_export(export.EXPRESS, export.JSONL, chunk_size=50))
+        self.assertEqual([100, 50], [len(chunk.splitlines()) for chunk in chunks])
+
+    def test_can_be_limited_to_dates(self):
+        create_txns(3)
+        for day, pk in zip((1, 2, 3), ExpressTransaction.objects.order_by('pk').values_list('pk', flat=True)):
+            ExpressTransaction.objects.filter(pk=pk).update(date_created=datetime.datetime(2026, 9, day, 23, 30))
+        txns = export.get_transactions(
+            export.EXPRESS, date_from=datetime.date(2026, 9, 2), date_to=datetime.date(2026, 9, 3))
+        self.assertEqual(['EC-1', 'EC-2'], [row[6] for row in txns])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            export.iter_export(export.EXPRESS, 'xml')
+
+
+class TestExportView(TestCase):
+
+    def get(self, **params):
+        request = RequestFactory().get('/', params)
+        return TransactionExportView.as_view()(request)
+
+    def test_streams_export(self):
+        create_txns(1)
+        response = self.get(format='jsonl', date_from='2000-01-01')
+        self.assertTrue(response.streaming)
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+        self.assertEqual('attachment; filename="paypal-express-transactions-from-2000-01-01.jsonl"',
+                         response['Content-Disposition'])
+        self.assertEqual(1, len(b''.join(response.streaming_content).splitlines()))
+
+    def test_rejects_unknown_format(self):
+        self.assertEqual(400, self.get(format='xml').status_code)
+
+    def test_rejects_invalid_dates(self):
+        self.assertEqual(400, self.get(date_to='last month').status_code)
+
+
+class TestExportCommand(TestCase):
+
+    def test_writes_export_to_stdout(self):
+        create_txns(2)
+        out = StringIO()
+        call_command('paypal_export', 'express', '--chunk-size', '1', stdout=out)
+        self.assertEqual(3, len(out.getvalue().splitlines()))
@@ -1,10 +1,14 @@
 from decimal import Decimal as D
 from unittest.mock import Mock, patch
+from urllib.parse import parse_qsl
 
-from django.test import TestCase
+import httpx
+from asgiref.sync import async_to_sync
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
 from oscar.apps.shipping.methods import FixedPrice, Free
 
-from paypal import exceptions
+from paypal import conf, exceptions
 from paypal.express import gateway
 from paypal.express.exceptions import InvalidBasket
 from paypal.express.models import ExpressTransaction as Transaction
@@ -45,7 +49,7 @@ class ErrorResponseTests(MockedResponseTestCase):
             '&L_LONGMESSAGE0=Security%20header%20is%20not%20valid&L_SEVERITYCODE0=Error')
         response = self.create_mock_response(response_body)
 
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = response
             with self.assertRaises(exceptions.PayPalError):
                 gateway.set_txn(self.basket, self.methods, 'GBP', 'http://localhost:8000/success',
@@ -54,7 +58,7 @@ class ErrorResponseTests(MockedResponseTestCase):
     def test_non_200_response_raises_exception(self):
         response = self.create_mock_response(body='', status_code=500)
 
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = response
             with self.assertRaises(exceptions.PayPalError):
                 gateway.set_txn(self.basket, self.methods, 'GBP', 'http://localhost:8000/success',
@@ -70,7 +74,7 @@ class SuccessResponseTests(MockedResponseTestCase):
             '&ACK=Success&VERSION=60%2e0&BUILD=2649250')
         response = self.create_mock_response(response_body)
 
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = response
             self.url = gateway.set_txn(self.basket, self.methods, 'GBP',
                                        'http://localhost:8000/success',
@@ -110,3 +114,87 @@ class TestOrderTotal(TestCase):
             with self.assertRaises(InvalidBasket):
                 gateway.set_txn(basket, shipping_methods, 'GBP',
                                 'http://example.com', 'http://example.com')
+
+
+class TestSetTxnParams(TestCase):
+
+    def get_params(self, basket=None, **kwargs):
+        return gateway._get_set_txn_params(
+            basket or create_mock_basket(), [Free()], 'GBP', 'http://example.com', 'http://example.com', **kwargs)
+
+    def test_default_params_follow_settings(self):
+        with override_settings(PAYPAL_BRAND_NAME='Fish shop', PAYPAL_ALLOW_NOTE=False):
+            params = self.get_params()
+            self.assertEqual('Fish shop', params['BRANDNAME'])
+            self.assertEqual(0, params['ALLOWNOTE'])
+        self.assertNotIn('BRANDNAME', self.get_params())
+
+    def test_paypal_params_override_defaults(self):
+        params = self.get_params(paypal_params={'ALLOWNOTE': False, 'CALLBACKTIMEOUT': None})
+        self.assertEqual(0, params['ALLOWNOTE'])
+        self.assertNotIn('CALLBACKTIMEOUT', params)
+        self.assertEqual(3, conf.get_config().set_txn_defaults['CALLBACKTIMEOUT'])
+
+    def test_invalid_locale_is_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.get_params(paypal_params={'LOCALECODE': 'XX'})
+        with override_settings(PAYPAL_LOCALE='XX'):
+            with self.assertRaises(ImproperlyConfigured):
+                self.get_params()
+
+    def test_confirm_shipping_is_dropped_when_no_shipping_is_required(self):
+        with override_settings(PAYPAL_CONFIRM_SHIPPING=True):
+            self.assertEqual(1, self.get_params()['REQCONFIRMSHIPPING'])
+            self.assertNotIn('REQCONFIRMSHIPPING', self.get_params(no_shipping=True))
+
+    def test_line_items_are_encoded(self):
+        basket = create_mock_basket()
+        line = Mock(quantity=2, unit_price_incl_tax=D('5.00'))
+        line.product.get_title.return_value = 'Fish & chips'
+        line.product.upc = '1234'
+        line.product.description = '<p>Battered</p>'
+        line.product.is_shipping_required = True
+        basket.all_lines.return_value = [line]
+        basket.voucher_discounts = [{'voucher': Mock(code='TENOFF'), 'discount': D('1.00')}]
+        basket.voucher_discounts[0]['voucher'].name = 'Ten off'
+
+        params = dict(parse_qsl(self.get_params(basket).encode()))
+
+        self.assertEqual('Fish & chips', params['L_PAYMENTREQUEST_0_NAME0'])
+        self.assertEqual('1234', params['L_PAYMENTREQUEST_0_NUMBER0'])
+        self.assertEqual('Battered', params['L_PAYMENTREQUEST_0_DESC0'])
+        self.assertEqual('5.00', params['L_PAYMENTREQUEST_0_AMT0'])
+        self.assertEqual('2', params['L_PAYMENTREQUEST_0_QTY0'])
+        self.assertEqual('Physical', params['L_PAYMENTREQUEST_0_ITEMCATEGORY0'])
+        self.assertEqual('Ten off (TENOFF)', params['L_PAYMENTREQUEST_0_NAME1'])
+        self.assertEqual('-1.00', params['L_PAYMENTREQUEST_0_AMT1'])
+        self.assertEqual('true', params['L_SHIPPINGOPTIONISDEFAULT0'])
+
+
+class AsyncResponseTests(MockedResponseTestCase):
+
+    def patch_client(self, body, status_code=200):
+        transport = httpx.MockTransport(lambda request: httpx.Response(status_code, text=body))
+        return patch('paypal.gateway.get_async_client', return_value=httpx.AsyncClient(transport=transport))
+
+    def test_set_txn_returns_url(self):
+        response_body = (
+            'TOKEN=EC%2d6469953681606921P&TIMESTAMP=2012%2d03%2d26T17%3a19%3a38Z&CORRELATIONID=50a8d895e928f'
+            '&ACK=Success&VERSION=60%2e0&BUILD=2649250')
+        with self.patch_client(response_body):
+            url = async_to_sync(gateway.aset_txn)(self.basket, self.methods, 'GBP',
+                                                  'http://localhost:8000/success',
+                                                  'http://localhost:8000/error')
+        self.assertTrue('EC-6469953681606921P' in url)
+        txn = Transaction.objects.get()
+        self.assertEqual('EC-6469953681606921P', txn.token)
+
+    def test_error_response_raises_exception(self):
+        response_body = (
+            'TIMESTAMP=2012%2d03%2d26T16%3a33%3a09Z&CORRELATIONID=3bea2076bb9c3&ACK=Failure&VERSION=0%2e000000'
+            '&BUILD=2649250&L_ERRORCODE0=10002&L_SHORTMESSAGE0=Security%20error'
+            '&L_LONGMESSAGE0=Security%20header%20is%20not%20valid&L_SEVERITYCODE0=Error')
+        with self.patch_client(response_body):
+            with self.assertRaises(exceptions.PayPalError):
+                async_to_sync(gateway.aget_txn)('EC-6469953681606921P')
+        self.assertEqual('10002', Transaction.objects.get().error_code)
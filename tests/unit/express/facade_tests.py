@@ -4,6 +4,9 @@ from unittest.mock import Mock, patch
 from urllib.parse import parse_qs
 
 import pytest
+from django.core.cache import cache
+from django.test import TestCase as DjangoTestCase
+from django.test import override_settings
 from oscar.apps.shipping.methods import Free
 from purl import URL
 
@@ -20,7 +23,7 @@ class MockedResponseTests(TestCase):
         response = Mock()
         response.text = self.response_body
         response.status_code = 200
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = response
             self.perform_action()
             self.mocked_post = post
@@ -171,3 +174,35 @@ class SuccessfulGetExpressCheckoutTests(MockedResponseTests):
         ]
         for k, v in values:
             self.assertEqual(v, ctx[k])
+
+
+@override_settings(PAYPAL_TXN_DETAILS_CACHE_TIMEOUT=60)
+class CachedTransactionDetailsTests(DjangoTestCase):
+
+    def setUp(self):
+        cache.clear()
+        patcher = patch('paypal.express.facade.get_txn', side_effect=lambda token: Transaction(token=token))
+        self.get_txn = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_preview_details_are_reused(self):
+        fetch_transaction_details('EC-1', 'PAYER')
+        txn = fetch_transaction_details('EC-1', 'PAYER', use_cache=True)
+        self.assertEqual('EC-1', txn.token)
+        self.assertEqual(1, self.get_txn.call_count)
+
+    def test_details_are_fetched_for_another_payer(self):
+        fetch_transaction_details('EC-1', 'PAYER')
+        fetch_transaction_details('EC-1', 'OTHER', use_cache=True)
+        self.assertEqual(2, self.get_txn.call_count)
+
+    def test_details_are_fetched_without_use_cache(self):
+        fetch_transaction_details('EC-1', 'PAYER')
+        fetch_transaction_details('EC-1', 'PAYER')
+        self.assertEqual(2, self.get_txn.call_count)
+
+    @override_settings(PAYPAL_TXN_DETAILS_CACHE_TIMEOUT=0)
+    def test_cache_is_off_by_default(self):
+        fetch_transaction_details('EC-1', 'PAYER')
+        fetch_transaction_details('EC-1', 'PAYER', use_cache=True)
+        self.assertEqual(2, self.get_txn.call_count)
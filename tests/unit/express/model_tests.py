@@ -1,6 +1,10 @@
-from unittest import TestCase
+import importlib
+from unittest import TestCase, mock
+from urllib.parse import parse_qsl
 
 import pytest
+from django.apps import apps
+from django.test import override_settings
 
 from paypal.express.models import ExpressTransaction as Transaction
 
@@ -21,9 +25,80 @@ class TransactionTests(TestCase):
                                          response_time=0)
         self.assertEqual('PaymentActionNotInitiated', txn.value('CHECKOUTSTATUS'))
 
+    def test_response_is_parsed_once(self):
+        txn = Transaction(raw_response='ACK=Success&AMT=6%2e99', response_time=0)
+        with mock.patch('paypal.base.parse_qsl', wraps=parse_qsl) as parse:
+            txn.value('ACK')
+            txn.value('AMT')
+            txn.response()
+        self.assertEqual(1, parse.call_count)
+
+    def test_context_is_updated_when_response_changes(self):
+        txn = Transaction(raw_response='ACK=Success', response_time=0)
+        self.assertEqual('Success', txn.value('ACK'))
+        txn.raw_response = 'ACK=Failure'
+        self.assertEqual('Failure', txn.value('ACK'))
+
+    def test_values(self):
+        txn = Transaction(raw_response='ACK=Success&AMT=6%2e99', response_time=0)
+        self.assertEqual(('6.99', 'Success', None), txn.values('AMT', 'ACK', 'EMAIL'))
+        self.assertEqual(('',), txn.values('EMAIL', default=''))
+
     def test_warnings_are_successful(self):
         txn = Transaction.objects.create(raw_request='',
                                          raw_response='',
                                          ack='SuccessWithWarning',
                                          response_time=0)
         self.assertTrue(txn.is_successful)
+
+
+@pytest.mark.django_db
+class ResponseDataTests(TestCase):
+
+    def create_txn(self):
+        return Transaction.objects.create(raw_request='',
+                                          raw_response='ACK=Success&PAYMENTINFO_0_TRANSACTIONID=4HT31577J0564891X',
+                                          response_time=0)
+
+    def test_parsed_response_is_saved(self):
+        txn = self.create_txn()
+        txn = Transaction.objects.get(pk=txn.pk)
+        self.assertEqual('4HT31577J0564891X', txn.response_data['PAYMENTINFO_0_TRANSACTIONID'])
+
+    def test_loaded_txn_uses_saved_response_data(self):
+        txn = self.create_txn()
+        txn = Transaction.objects.get(pk=txn.pk)
+        with mock.patch('paypal.base.parse_qsl') as parse:
+            self.assertEqual('Success', txn.value('ACK'))
+        self.assertFalse(parse.called)
+
+    @override_settings(PAYPAL_STORE_RESPONSE_DATA=False)
+    def test_saving_response_data_can_be_disabled(self):
+        txn = self.create_txn()
+        txn = Transaction.objects.get(pk=txn.pk)
+        self.assertIsNone(txn.response_data)
+        self.assertEqual('Success', txn.value('ACK'))
+
+    def test_backfill_migration(self):
+        txn = self.create_txn()
+        Transaction.objects.filter(pk=txn.pk).update(response_data=None)
+        migration = importlib.import_module('paypal.migrations.0006_backfill_response_data')
+        migration.backfill_response_data(apps, None)
+        txn = Transaction.objects.get(pk=txn.pk)
+        self.assertEqual('Success', txn.response_data['ACK'])
+
+    def test_conversion_migration_changes_text_columns(self):
+        migration = importlib.import_module('paypal.migrations.0009_convert_response_data')
+        self.assertEqual(
+            'ALTER TABLE "t" ALTER COLUMN "response_data" TYPE jsonb USING "response_data"::jsonb',
+            migration.get_conversion_sql('postgresql', '"t"', '"response_data"', 'text', 'jsonb'))
+        self.assertEqual(
+            'ALTER TABLE `t` MODIFY `response_data` json NULL',
+            migration.get_conversion_sql('mysql', '`t`', '`response_data`', 'longtext', 'json'))
+
+    def test_conversion_migration_leaves_other_columns(self):
+        migration = importlib.import_module('paypal.migrations.0009_convert_response_data')
+        self.assertIsNone(migration.get_conversion_sql('postgresql', 't', 'response_data', 'jsonb', 'jsonb'))
+        # Django < 3.1 on MySQL still stores the pairs as text
+        self.assertIsNone(migration.get_conversion_sql('mysql', 't', 'response_data', 'longtext', 'longtext'))
+        self.assertIsNone(migration.get_conversion_sql('sqlite', 't', 'response_data', 'text', 'text'))
@@ -0,0 +1,68 @@
+import time
+from decimal import Decimal as D
+from unittest.mock import Mock
+
+from django.test import TestCase, override_settings
+from oscar.apps.shipping.methods import FixedPrice, Free
+
+from paypal.express import shipping
+from tests.shipping.methods import SlowCourier
+
+
+class BrokenMethod(Free):
+    code = 'broken'
+
+    def calculate(self, basket):
+        raise ValueError("No rates")
+
+
+class TestCalculateCharges(TestCase):
+
+    def setUp(self):
+        shipping.reset_stats()
+        self.basket = Mock()
+        self.basket.all_lines.return_value = []
+
+    def test_returns_charges_in_order(self):
+        methods = [FixedPrice(D('5.00'), D('6.00')), Free()]
+        charges = shipping.calculate_charges(methods, self.basket, 1)
+        self.assertEqual([(methods[0], D('6.00')), (methods[1], D('0.00'))], charges)
+
+    def test_drops_late_methods(self):
+        methods = [SlowCourier(D('5.00'), D('6.00')), Free()]
+        charges = shipping.calculate_charges(methods, self.basket, 0.1)
+        self.assertEqual([(methods[1], D('0.00'))], charges)
+        self.assertEqual({'calls': 1, 'budget_exceeded': 1, 'methods_dropped': 1, 'methods_rejected': 0},
+                         shipping.get_stats())
+
+    @override_settings(PAYPAL_CALLBACK_WORKERS=1)
+    def test_methods_are_rejected_while_the_pool_is_busy(self):
+        shipping.calculate_charges([SlowCourier(D('5.00'))], self.basket, 0.1)
+        method = Free()
+        self.assertEqual([], shipping.calculate_charges([method], self.basket, 0.1))
+        self.assertEqual(1, shipping.get_stats()['methods_rejected'])
+
+        # The slot is given back once the late method is done
+        time.sleep(0.5)
+        self.assertEqual([(method, D('0.00'))], shipping.calculate_charges([method], self.basket, 0.1))
+
+    def test_drops_methods_which_fail(self):
+        methods = [BrokenMethod(), Free()]
+        charges = shipping.calculate_charges(methods, self.basket, 1)
+        self.assertEqual([(methods[1], D('0.00'))], charges)
+
+    def test_waits_for_all_methods_without_a_budget(self):
+        methods = [SlowCourier(D('5.00'), D('6.00'))]
+        self.assertEqual([(methods[0], D('6.00'))], shipping.calculate_charges(methods, self.basket, None))
+
+
+class TestGetBudget(TestCase):
+
+    @override_settings(PAYPAL_CALLBACK_TIMEOUT=3, PAYPAL_CALLBACK_MARGIN=0.5)
+    def test_leaves_a_margin(self):
+        budget = shipping.get_budget(time.monotonic() - 1)
+        self.assertAlmostEqual(1.5, budget, places=1)
+
+    @override_settings(PAYPAL_CALLBACK_TIMEOUT=None)
+    def test_is_unlimited_without_a_callback_timeout(self):
+        self.assertIsNone(shipping.get_budget(time.monotonic()))
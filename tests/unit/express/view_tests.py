@@ -1,17 +1,28 @@
 # -*- coding: utf-8 -*-
+import time
 from decimal import Decimal as D
 from unittest.mock import Mock, patch
+from urllib.parse import parse_qs
 
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages import get_messages
+from django.core.cache import caches
 from django.test import TestCase, override_settings
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
 from django.urls import reverse
 from django.utils.encoding import force_text
 from oscar.apps.basket.models import Basket
 from oscar.apps.order.models import Order
-from oscar.core.loading import get_classes
-from oscar.test.factories import create_product
+from oscar.apps.shipping.methods import Free
+from oscar.core.loading import get_class, get_classes
+from oscar.test.factories import VoucherFactory, create_offer, create_product
 from purl import URL
 
+from paypal import cache, circuit, conf
+from paypal.express.views import SuccessResponseView
+from tests.shipping.methods import SlowCourier
+
+Selector = get_class('partner.strategy', 'Selector')
 Partner, StockRecord = get_classes('partner.models', ('Partner',
                                                       'StockRecord'))
 
@@ -29,7 +40,7 @@ class MockedPayPalTests(TestCase):
 
     def setUp(self):
         self.client = Client()
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             self.patch_http_post(post)
             self.perform_action()
 
@@ -125,6 +136,30 @@ class RedirectWhenBuyerPaysOnPayPalTests(RedirectToPayPalBase):
         self.assertTrue(self.url.has_query_params(params))
 
 
+@override_settings(PAYPAL_REQUEST_DEADLINE=0)
+class RedirectPastDeadlineTests(RedirectToPayPalBase):
+
+    def test_redirects_to_basket(self):
+        self.assertEqual(reverse('basket:summary'), self.url.path())
+
+
+@override_settings(PAYPAL_CIRCUIT_BREAKER_THRESHOLD=1)
+class RedirectWithOpenCircuitTests(MockedPayPalTests):
+
+    def perform_action(self):
+        circuit.reset()
+        self.addCleanup(circuit.reset)
+        circuit.get_breaker(conf.get_config().nvp_url, 'SetExpressCheckout').failed()
+        self.add_product_to_basket()
+        self.response = self.client.get(reverse('paypal-redirect'))
+
+    def test_fails_fast(self):
+        from paypal.express.views import RedirectView
+        self.assertEqual(reverse('basket:summary'), self.response.url)
+        self.assertIn(RedirectView.error_message,
+                      [str(message) for message in get_messages(self.response.wsgi_request)])
+
+
 class FailedTxnTests(MockedPayPalTests):
     response_body = 'TOKEN=EC%2d8P797793UC466090M&CHECKOUTSTATUS=PaymentActionNotInitiated' \
                     '&TIMESTAMP=2012%2d04%2d16T11%3a51%3a57Z&CORRELATIONID=ab8a263eb440&ACK=Failed' \
@@ -389,3 +424,106 @@ class SubmitOrderErrorsTests(MockedPayPalTests):
         self.assertEqual(error, "A problem occurred while processing payment for this "
                                 "order - no payment has been taken.  Please "
                                 "contact customer services if this problem persists")
+
+
+class SuccessShippingMethodTests(TestCase):
+
+    def setUp(self):
+        self.view = SuccessResponseView()
+        self.view.request = RequestFactory().get('/')
+        self.view.request.user = AnonymousUser()
+        self.basket = Mock(is_shipping_required=Mock(return_value=True))
+
+    def get_shipping_method(self, pairs, methods=()):
+        self.view.txn = Mock(value=pairs.get)
+        with patch('paypal.views.ShippingChargeMixin.get_shipping_method', create=True, return_value=None):
+            with patch('paypal.express.views.Repository') as repository:
+                repository.return_value.get_shipping_methods.return_value = methods
+                return self.view.get_shipping_method(self.basket)
+
+    def test_fixed_price_charge_is_memoized(self):
+        method = self.get_shipping_method({'PAYMENTREQUEST_0_SHIPPINGAMT': '4.50'})
+        self.assertIsInstance(method, cache.MemoizedShippingMethod)
+        self.assertEqual(D('4.50'), method.calculate(self.basket).incl_tax)
+
+    def test_method_chosen_on_paypal_is_memoized_without_changing_it(self):
+        chosen = Free()
+        method = self.get_shipping_method(
+            {'PAYMENTREQUEST_0_SHIPPINGAMT': '0.00', 'SHIPPINGOPTIONNAME': chosen.name}, [chosen])
+        self.assertIsInstance(method, cache.MemoizedShippingMethod)
+        self.assertIs(chosen, method.__wrapped__)
+        self.assertNotIn('calculate', vars(chosen))
+
+
+class ShippingOptionsTests(TestCase):
+    fixtures = ['countries.json']
+
+    def setUp(self):
+        caches['default'].clear()
+        self.basket = Basket.objects.create()
+        self.basket.strategy = Selector().strategy()
+        self.basket.add_product(create_product(price=D('10.00'), num_in_stock=10))
+        self.url = reverse('paypal-shipping-options', kwargs={'basket_id': self.basket.id})
+        self.data = {'SHIPTOCOUNTRY': 'GB', 'SHIPTOSTREET': '1 Main Terrace', 'SHIPTOCITY': 'Wolverhampton',
+                     'SHIPTOZIP': 'W12 4LQ', 'CURRENCYCODE': 'GBP'}
+
+    def post(self, data, methods=None):
+        with patch('paypal.express.views.Repository') as repository:
+            repository.return_value.get_shipping_methods.return_value = methods or [Free()]
+            response = self.client.post(self.url, data)
+        self.assertEqual(200, response.status_code)
+        return response, repository.return_value.get_shipping_methods.called
+
+    def test_repeat_callbacks_are_served_from_the_cache(self):
+        response, calculated = self.post(self.data)
+        self.assertTrue(calculated)
+        cached_response, calculated = self.post(dict(self.data, SHIPTOZIP='w124lq', SHIPTOCITY=' wolverhampton'))
+        self.assertFalse(calculated)
+        self.assertEqual(response.content, cached_response.content)
+
+    def test_a_different_address_is_recalculated(self):
+        self.post(self.data)
+        __, calculated = self.post(dict(self.data, SHIPTOZIP='W12 4LR'))
+        self.assertTrue(calculated)
+
+    def test_a_changed_basket_is_recalculated(self):
+        self.post(self.data)
+        self.basket.add_product(create_product(price=D('5.00'), num_in_stock=10))
+        __, calculated = self.post(self.data)
+        self.assertTrue(calculated)
+
+    def test_adding_a_voucher_is_recalculated(self):
+        self.post(self.data)
+        self.basket.vouchers.add(VoucherFactory())
+        __, calculated = self.post(self.data)
+        self.assertTrue(calculated)
+
+    def test_a_new_offer_is_recalculated(self):
+        self.post(self.data)
+        create_offer()
+        __, calculated = self.post(self.data)
+        self.assertTrue(calculated)
+
+    @override_settings(PAYPAL_SHIPPING_OPTIONS_CACHE_TIMEOUT=0)
+    def test_cache_can_be_turned_off(self):
+        self.post(self.data)
+        __, calculated = self.post(self.data)
+        self.assertTrue(calculated)
+
+    @override_settings(PAYPAL_CALLBACK_TIMEOUT=1, PAYPAL_CALLBACK_MARGIN=0.8)
+    def test_late_methods_are_left_out(self):
+        response, __ = self.post(self.data, methods=[SlowCourier(D('5.00')), Free()])
+        self.assertEqual(['Free shipping'], parse_qs(force_text(response.content))['L_SHIPPINGOPTIONNAME0'])
+        self.assertNotIn('L_SHIPPINGOPTIONNAME1', force_text(response.content))
+        # The incomplete response isn't cached
+        __, calculated = self.post(self.data)
+        self.assertTrue(calculated)
+
+    @override_settings(PAYPAL_CALLBACK_TIMEOUT=1, PAYPAL_CALLBACK_MARGIN=0.8)
+    def test_falls_back_when_no_method_is_in_time(self):
+        started = time.monotonic()
+        response, __ = self.post(self.data, methods=[SlowCourier(D('5.00'))])
+        # PayPal only uses the flat-rate options if the callback times out
+        self.assertGreaterEqual(time.monotonic() - started, 1)
+        self.assertEqual('METHOD=CallbackResponse&CALLBACKVERSION=61.0&CURRENCYCODE=GBP',
+                         force_text(response.content))
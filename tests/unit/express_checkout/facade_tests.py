@@ -4,10 +4,10 @@ from unittest.mock import patch
 from django.test import TestCase
 from paypalhttp.http_response import construct_object
 
-from paypal.express_checkout.facade import refund_order, void_authorization
+from paypal.express_checkout.facade import fetch_transaction_details, refund_order, void_authorization
 from paypal.express_checkout.models import ExpressCheckoutTransaction
 
-from .mocked_data import REFUND_ORDER_DATA_MINIMAL
+from .mocked_data import GET_ORDER_RESULT_DATA, REFUND_ORDER_DATA_MINIMAL
 
 
 class FacadeTests(TestCase):
@@ -49,3 +49,26 @@ class FacadeTests(TestCase):
             assert self.txn.status == ExpressCheckoutTransaction.VOIDED
 
             mocked_void_order.assert_called_once_with('3PW0120338716941H')
+
+    def test_fetch_transaction_details_saves_once(self):
+        with patch('paypal.express_checkout.facade.PaymentProcessor.get_order') as mocked_get_order:
+            mocked_get_order.return_value = construct_object('Result', GET_ORDER_RESULT_DATA)
+
+            with patch.object(ExpressCheckoutTransaction, 'save', autospec=True) as mocked_save:
+                txn = fetch_transaction_details('4MW805572N795704B', lock=True)
+
+            assert txn.payer_id == '0000000000001'
+            assert mocked_save.call_count == 1
+            assert mocked_save.call_args[1]['update_fields'] == {
+                'payer_id', 'email', 'status', 'address_full_name', 'address'}
+
+    def test_fetch_transaction_details_skips_approved_order(self):
+        self.txn.payer_id = '0000000000001'
+        self.txn.status = ExpressCheckoutTransaction.APPROVED
+        self.txn.save()
+
+        with patch('paypal.express_checkout.facade.PaymentProcessor.get_order') as mocked_get_order:
+            with self.assertNumQueries(1):
+                fetch_transaction_details('4MW805572N795704B')
+
+            mocked_get_order.assert_not_called()
@@ -0,0 +1,255 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+import httpx
+import requests
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from paypalcheckoutsdk.orders import OrdersCaptureRequest, OrdersGetRequest
+from paypalhttp.http_error import HttpError
+
+from paypal import circuit, gateway
+from paypal.express_checkout.gateway import (
+    PaymentProcessor, _access_tokens, _access_tokens_lock, _get_access_token_key,
+    clear_access_tokens, get_access_token)
+
+from .mocked_data import GET_ORDER_RESULT_DATA
+
+
+class HttpClientTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = PaymentProcessor().client
+        # Skip fetching an access token
+        self.request = OrdersGetRequest('4MW805572N795704B')
+        self.request.headers['Authorization'] = 'Bearer token'
+
+    @override_settings(PAYPAL_OPERATION_TIMEOUTS={'get_order': (1, 3)})
+    def test_uses_shared_session_with_operation_timeout(self):
+        with patch('requests.Session.request') as request:
+            request.return_value = Mock(status_code=200, text='', headers={})
+            self.client.execute(self.request, operation='get_order')
+        self.assertEqual((1, 3), request.call_args[1]['timeout'])
+
+    def test_timeout_raises_http_error(self):
+        with patch('requests.Session.request') as request:
+            request.side_effect = requests.Timeout()
+            with self.assertRaises(HttpError):
+                self.client.execute(self.request, operation='get_order')
+
+    def test_expired_deadline_raises_http_error(self):
+        with gateway.deadline(0):
+            with self.assertRaises(HttpError):
+                self.client.execute(self.request, operation='get_order')
+
+    @override_settings(PAYPAL_RETRY_BACKOFF=0)
+    def test_server_error_is_retried(self):
+        with patch('requests.Session.request') as request:
+            request.side_effect = [
+                Mock(status_code=503, text='', headers={}),
+                Mock(status_code=200, text='', headers={}),
+            ]
+            self.client.execute(self.request, operation='get_order')
+        self.assertEqual(2, request.call_count)
+
+    def test_client_error_is_not_retried(self):
+        with patch('requests.Session.request') as request:
+            request.return_value = Mock(status_code=422, text='', headers={})
+            with self.assertRaises(HttpError):
+                self.client.execute(self.request, operation='get_order')
+        self.assertEqual(1, request.call_count)
+
+    @override_settings(PAYPAL_RETRY_BACKOFF=0)
+    def test_retried_post_reuses_request_id(self):
+        request = OrdersCaptureRequest('4MW805572N795704B')
+        request.headers['Authorization'] = 'Bearer token'
+        with patch('requests.Session.request') as session_request:
+            session_request.side_effect = [requests.ConnectionError(), Mock(status_code=201, text='', headers={})]
+            self.client.execute(request, operation='capture_order')
+        request_ids = {call[1]['headers']['PayPal-Request-Id'] for call in session_request.call_args_list}
+        self.assertEqual(1, len(request_ids))
+        self.assertNotIn('PayPal-Request-Id', request.headers)
+
+    @override_settings(PAYPAL_CIRCUIT_BREAKER_THRESHOLD=1, PAYPAL_RETRY_BACKOFF=0)
+    def test_open_circuit_fails_fast(self):
+        circuit.reset()
+        self.addCleanup(circuit.reset)
+        with patch('requests.Session.request') as request:
+            request.side_effect = requests.ConnectionError()
+            with self.assertRaises(HttpError):
+                self.client.execute(self.request, operation='get_order')
+            with self.assertRaises(HttpError) as cm:
+                self.client.execute(self.request, operation='get_order')
+        self.assertEqual(1, request.call_count)
+        self.assertTrue(circuit.is_open_error(cm.exception))
+
+
+class AccessTokenCacheTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        clear_access_tokens()
+        self.token_requests = 0
+
+    def tearDown(self):
+        clear_access_tokens()
+        super().tearDown()
+
+    def mock_request(self, method, url, **kwargs):
+        if url.endswith('/v1/oauth2/token'):
+            self.token_requests += 1
+            data = {'access_token': 'token-%d' % self.token_requests, 'token_type': 'Bearer', 'expires_in': 32400}
+        else:
+            data = GET_ORDER_RESULT_DATA
+        return Mock(status_code=200, text=json.dumps(data), headers={'Content-Type': 'application/json'})
+
+    def get_order(self):
+        with patch('requests.Session.request') as request:
+            request.side_effect = self.mock_request
+            PaymentProcessor().get_order('4MW805572N795704B')
+        return request.call_args[1]['headers']['Authorization']
+
+    def test_token_is_shared_between_processors(self):
+        self.get_order()
+        authorization = self.get_order()
+        assert self.token_requests == 1
+        assert authorization == 'Bearer token-1'
+
+    def test_token_is_fetched_once_by_concurrent_requests(self):
+        def mock_request(method, url, **kwargs):
+            if url.endswith('/v1/oauth2/token'):
+                time.sleep(0.1)
+            return self.mock_request(method, url, **kwargs)
+
+        with patch('requests.Session.request', side_effect=mock_request):
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                list(executor.map(lambda i: PaymentProcessor().get_order('4MW805572N795704B'), range(4)))
+        assert self.token_requests == 1
+
+    @override_settings(PAYPAL_ACCESS_TOKEN_REFRESH_MARGIN=32400)
+    def test_token_is_refreshed_early(self):
+        self.get_order()
+        self.get_order()
+        assert self.token_requests == 2
+
+    @override_settings(
+        PAYPAL_ACCESS_TOKEN_CACHE='default',
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_token_is_shared_through_django_cache(self):
+        self.get_order()
+        # Imitate another worker process, which only sees the Django cache
+        clear_access_tokens()
+        authorization = self.get_order()
+        assert self.token_requests == 1
+        assert authorization == 'Bearer token-1'
+
+    @override_settings(
+        PAYPAL_ACCESS_TOKEN_CACHE='default',
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_expired_local_token_falls_back_to_django_cache(self):
+        environment = PaymentProcessor().client.environment
+        key = _get_access_token_key(environment)
+        with _access_tokens_lock:
+            _access_tokens[key] = ('stale', 'Bearer', time.time() - 1)
+        # Eg fetched by another worker process
+        self.addCleanup(caches['default'].clear)
+        caches['default'].set(key, ('fresh', 'Bearer', time.time() + 3600))
+        assert get_access_token(environment).access_token == 'fresh'
+
+    @override_settings(
+        PAYPAL_ACCESS_TOKEN_CACHE='default',
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_revoked_token_is_replaced(self):
+        self.addCleanup(caches['default'].clear)
+        self.get_order()
+
+        def mock_request(method, url, **kwargs):
+            if kwargs['headers'].get('Authorization') == 'Bearer token-1':
+                return Mock(status_code=401, text=json.dumps({'error': 'invalid_token'}),
+                            headers={'Content-Type': 'application/json'})
+            return self.mock_request(method, url, **kwargs)
+
+        with patch('requests.Session.request', side_effect=mock_request) as request:
+            PaymentProcessor().get_order('4MW805572N795704B')
+        assert self.token_requests == 2
+        assert request.call_args[1]['headers']['Authorization'] == 'Bearer token-2'
+        environment = PaymentProcessor().client.environment
+        assert caches['default'].get(_get_access_token_key(environment))[0] == 'token-2'
+
+    def test_unauthorized_request_is_only_retried_once(self):
+        def mock_request(method, url, **kwargs):
+            if url.endswith('/v1/oauth2/token'):
+                return self.mock_request(method, url, **kwargs)
+            return Mock(status_code=401, text=json.dumps({'error': 'invalid_token'}),
+                        headers={'Content-Type': 'application/json'})
+
+        with patch('requests.Session.request', side_effect=mock_request):
+            with self.assertRaises(HttpError) as cm:
+                PaymentProcessor().get_order('4MW805572N795704B')
+        assert cm.exception.status_code == 401
+        assert self.token_requests == 2
+
+    def test_expired_token_is_not_returned(self):
+        self.get_order()
+        environment = PaymentProcessor().client.environment
+        with patch('time.time', return_value=time.time() + 32400):
+            assert get_access_token(environment) is None
+
+
+class AsyncPaymentProcessorTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        clear_access_tokens()
+        self.requests = []
+
+    def tearDown(self):
+        clear_access_tokens()
+        super().tearDown()
+
+    def handler(self, request):
+        self.requests.append(request)
+        if request.url.path == '/v1/oauth2/token':
+            data = {'access_token': 'token-1', 'token_type': 'Bearer', 'expires_in': 32400}
+        else:
+            data = GET_ORDER_RESULT_DATA
+        return httpx.Response(200, json=data)
+
+    def get_order(self):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
+        with patch('paypal.gateway.get_async_client', return_value=client):
+            return async_to_sync(PaymentProcessor().aget_order)('4MW805572N795704B')
+
+    def test_get_order(self):
+        result = self.get_order()
+        assert result.id == GET_ORDER_RESULT_DATA['id']
+        assert self.requests[-1].headers['Authorization'] == 'Bearer token-1'
+
+    def test_access_token_is_fetched_once(self):
+        self.get_order()
+        self.get_order()
+        token_requests = [r for r in self.requests if r.url.path == '/v1/oauth2/token']
+        assert len(token_requests) == 1
+        assert get_access_token(PaymentProcessor().client.environment).access_token == 'token-1'
+
+    def test_revoked_token_is_replaced(self):
+        self.get_order()
+
+        def handler(request):
+            self.requests.append(request)
+            if request.url.path == '/v1/oauth2/token':
+                return httpx.Response(200, json={'access_token': 'token-2', 'token_type': 'Bearer',
+                                                 'expires_in': 32400})
+            if request.headers['Authorization'] == 'Bearer token-1':
+                return httpx.Response(401, json={'error': 'invalid_token'})
+            return httpx.Response(200, json=GET_ORDER_RESULT_DATA)
+
+        self.handler = handler
+        result = self.get_order()
+        assert result.id == GET_ORDER_RESULT_DATA['id']
+        assert self.requests[-1].headers['Authorization'] == 'Bearer token-2'
+        assert get_access_token(PaymentProcessor().client.environment).access_token == 'token-2'
@@ -138,6 +138,57 @@ class PreviewOrderTests(BasketMixin, TestCase):
             response = self.client.get(self.url_with_query_string)
             assert reverse('basket:summary') == response.url
 
+    def test_place_order_reuses_previewed_transaction(self):
+        with patch('paypal.express_checkout.gateway.PaymentProcessor.get_order') as get_order:
+            get_order.return_value = construct_object('Result', GET_ORDER_RESULT_DATA)
+            self.client.get(self.url_with_query_string)
+
+        basket = Basket.objects.all().first()
+        url = reverse('express-checkout-place-order', kwargs={'basket_id': basket.id})
+        payload = {'action': 'place_order', 'payer_id': '0000000000001', 'token': '4MW805572N795704B'}
+        with patch('paypal.express_checkout.views.fetch_transaction_details') as fetch:
+            with patch('paypal.express_checkout.gateway.PaymentProcessor.capture_order') as capture_order:
+                capture_order.return_value = construct_object('Result', CAPTURE_ORDER_RESULT_DATA_MINIMAL)
+                self.client.post(url, payload)
+
+        fetch.assert_not_called()
+        assert Order.objects.all().first().guest_email == 'sherlock.holmes@example.com'
+
+    def test_place_order_loads_the_previewed_transaction_from_the_database(self):
+        with patch('paypal.express_checkout.gateway.PaymentProcessor.get_order') as get_order:
+            get_order.return_value = construct_object('Result', GET_ORDER_RESULT_DATA)
+            self.client.get(self.url_with_query_string)
+        # Eg updated by another request since the preview
+        ExpressCheckoutTransaction.objects.update(email='john.watson@example.com')
+
+        basket = Basket.objects.all().first()
+        url = reverse('express-checkout-place-order', kwargs={'basket_id': basket.id})
+        payload = {'action': 'place_order', 'payer_id': '0000000000001', 'token': '4MW805572N795704B'}
+        with patch('paypal.express_checkout.gateway.PaymentProcessor.capture_order') as capture_order:
+            capture_order.return_value = construct_object('Result', CAPTURE_ORDER_RESULT_DATA_MINIMAL)
+            self.client.post(url, payload)
+
+        assert Order.objects.all().first().guest_email == 'john.watson@example.com'
+
+    def test_previews_are_kept_by_token(self):
+        with patch('paypal.express_checkout.gateway.PaymentProcessor.get_order') as get_order:
+            get_order.return_value = construct_object('Result', GET_ORDER_RESULT_DATA)
+            self.client.get(self.url_with_query_string)
+        session = self.client.session
+        session['paypal_express_checkout_txn']['OTHER-TOKEN'] = 1
+        session.save()
+
+        basket = Basket.objects.all().first()
+        url = reverse('express-checkout-place-order', kwargs={'basket_id': basket.id})
+        payload = {'action': 'place_order', 'payer_id': '0000000000001', 'token': '4MW805572N795704B'}
+        with patch('paypal.express_checkout.views.fetch_transaction_details') as fetch:
+            with patch('paypal.express_checkout.gateway.PaymentProcessor.capture_order') as capture_order:
+                capture_order.return_value = construct_object('Result', CAPTURE_ORDER_RESULT_DATA_MINIMAL)
+                self.client.post(url, payload)
+
+        fetch.assert_not_called()
+        assert {'OTHER-TOKEN': 1} == self.client.session['paypal_express_checkout_txn']
+
 
 class SubmitOrderMixin(BasketMixin):
     fixtures = ['countries.json']
@@ -1,7 +1,12 @@
 from unittest import mock
+from urllib.parse import parse_qsl
 
-from django.test import TestCase
+import httpx
+import requests
+from asgiref.sync import async_to_sync
+from django.test import TestCase, override_settings
 
+from paypal import exceptions, gateway
 from paypal.gateway import post
 
 # Fixtures
@@ -11,7 +16,7 @@ ERROR_RESPONSE = 'RESULT=126&PNREF=V25A2BB645A7&RESPMSG=Under review by Fraud Se
 class TestErrorResponse(TestCase):
 
     def setUp(self):
-        with mock.patch('requests.post') as mock_post:
+        with mock.patch('requests.Session.post') as mock_post:
             response = mock.Mock()
             response.status_code = 200
             response.text = ERROR_RESPONSE
@@ -38,3 +43,201 @@ class TestErrorResponse(TestCase):
                     '_response_time']
         for key in expected:
             self.assertTrue(key in self.pairs)
+
+
+class TestPayload(TestCase):
+
+    def setUp(self):
+        self.payload = gateway.Payload({'METHOD': 'SetExpressCheckout', 'NOTE': 'Fish & chips'})
+        self.payload.add_item(0, [('L_NAME', 'Café crème'), ('L_QTY', 2)])
+        self.payload.add_item(1, [('L_NAME', 'Tea'), ('L_QTY', 1)])
+
+    def test_encodes_fields_and_items(self):
+        self.assertEqual([
+            ('METHOD', 'SetExpressCheckout'),
+            ('NOTE', 'Fish & chips'),
+            ('L_NAME0', 'Café crème'),
+            ('L_QTY0', '2'),
+            ('L_NAME1', 'Tea'),
+            ('L_QTY1', '1'),
+        ], parse_qsl(self.payload.encode()))
+
+    def test_fields_can_be_replaced(self):
+        self.payload['NOTE'] = 'Pie'
+        self.assertEqual('Pie', self.payload['NOTE'])
+        self.assertIn('NOTE=Pie&', self.payload.encode())
+
+    def test_items_are_included_in_items(self):
+        self.assertIn(('L_NAME0', 'Café crème'), self.payload.items())
+
+    def test_post_encodes_payload(self):
+        with mock.patch('requests.Session.post') as mock_post:
+            mock_post.return_value = mock.Mock(status_code=200, text='ACK=Success')
+            post('http://example.com', self.payload)
+        self.assertEqual(self.payload.encode(), mock_post.call_args[0][1])
+
+
+class TestSharedSession(TestCase):
+
+    def tearDown(self):
+        gateway.reset_session()
+
+    def test_session_is_shared_between_calls(self):
+        self.assertIs(gateway.get_session(), gateway.get_session())
+
+    def test_reset_creates_a_new_session(self):
+        session = gateway.get_session()
+        gateway.reset_session()
+        self.assertIsNot(session, gateway.get_session())
+
+    @override_settings(PAYPAL_HTTP_POOL_SIZE=25)
+    def test_pool_size_is_configurable(self):
+        gateway.reset_session()
+        adapter = gateway.get_session().get_adapter('https://api-3t.paypal.com/nvp')
+        self.assertEqual(25, adapter._pool_maxsize)
+
+    def test_connection_stats_report_reuse(self):
+        adapter = gateway.get_session().get_adapter('https://api-3t.paypal.com/nvp')
+        pool = adapter.poolmanager.connection_from_url('https://api-3t.paypal.com/nvp')
+        pool.num_connections = 1
+        pool.num_requests = 3
+        stats = gateway.connection_stats()
+        self.assertEqual({'connections': 1, 'requests': 3, 'reused': 2},
+                         stats['api-3t.paypal.com'])
+
+
+class TestTimeouts(TestCase):
+
+    def test_default_timeout(self):
+        self.assertEqual(gateway.DEFAULT_TIMEOUT, gateway.get_timeout('GetExpressCheckoutDetails'))
+
+    @override_settings(PAYPAL_TIMEOUT=10, PAYPAL_OPERATION_TIMEOUTS={'GetExpressCheckoutDetails': (2, 4)})
+    def test_timeout_can_be_set_per_operation(self):
+        self.assertEqual((2, 4), gateway.get_timeout('GetExpressCheckoutDetails'))
+        self.assertEqual((10, 10), gateway.get_timeout('DoExpressCheckoutPayment'))
+
+    def test_deadline_caps_timeout(self):
+        with gateway.deadline(1):
+            connect, read = gateway.get_timeout('DoExpressCheckoutPayment')
+        self.assertLessEqual(connect, 1)
+        self.assertLessEqual(read, 1)
+
+    def test_nested_deadline_cannot_extend_outer_one(self):
+        with gateway.deadline(1):
+            with gateway.deadline(60):
+                __, read = gateway.get_timeout()
+        self.assertLessEqual(read, 1)
+
+    def test_expired_deadline_raises_error(self):
+        with gateway.deadline(0):
+            with self.assertRaises(exceptions.DeadlineExceeded):
+                post('http://example.com', {})
+
+    def test_timeout_is_passed_to_session(self):
+        with mock.patch('requests.Session.post') as mock_post:
+            mock_post.return_value = mock.Mock(status_code=200, text='')
+            post('http://example.com', {}, timeout=(1, 2))
+        self.assertEqual((1, 2), mock_post.call_args[1]['timeout'])
+
+    def test_timeout_raises_paypal_error(self):
+        with mock.patch('requests.Session.post') as mock_post:
+            mock_post.side_effect = requests.Timeout()
+            with self.assertRaises(exceptions.PayPalError):
+                post('http://example.com', {})
+
+
+class TestAsyncPost(TestCase):
+
+    def apost(self, handler, **kwargs):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with mock.patch('paypal.gateway.get_async_client', return_value=client):
+            return async_to_sync(gateway.apost)('http://example.com', {'METHOD': 'Test'}, **kwargs)
+
+    def test_returns_pairs(self):
+        pairs = self.apost(lambda request: httpx.Response(200, text=ERROR_RESPONSE))
+        self.assertEqual('126', pairs['RESULT'])
+        self.assertEqual('METHOD=Test', pairs['_raw_request'])
+        self.assertEqual(ERROR_RESPONSE, pairs['_raw_response'])
+
+    def test_non_200_response_raises_paypal_error(self):
+        with self.assertRaises(exceptions.PayPalError):
+            self.apost(lambda request: httpx.Response(500))
+
+    def test_timeout_raises_paypal_error(self):
+        def handler(request):
+            raise httpx.ReadTimeout('Timed out', request=request)
+
+        with self.assertRaises(exceptions.PayPalError):
+            self.apost(handler)
+
+    def test_timeout_is_passed_to_client(self):
+        timeouts = []
+
+        def handler(request):
+            timeouts.append(request.extensions['timeout'])
+            return httpx.Response(200, text=ERROR_RESPONSE)
+
+        self.apost(handler, timeout=(2, 7))
+        self.assertEqual(2, timeouts[0]['connect'])
+        self.assertEqual(7, timeouts[0]['read'])
+
+    def test_client_is_shared_within_event_loop(self):
+        async def get_clients():
+            return gateway.get_async_client(), gateway.get_async_client()
+
+        first, second = async_to_sync(get_clients)()
+        self.assertIs(first, second)
+
+
+@override_settings(PAYPAL_RETRY_BACKOFF=0)
+class TestRetries(TestCase):
+
+    def setUp(self):
+        gateway.reset_retry_stats()
+        self.addCleanup(gateway.reset_retry_stats)
+
+    def test_transient_errors_are_retried(self):
+        func = mock.Mock(side_effect=[exceptions.CommunicationError("Down"), 'pairs'])
+        self.assertEqual('pairs', gateway.call_with_retries(func, 'GetExpressCheckoutDetails'))
+        self.assertEqual(2, func.call_count)
+        self.assertEqual({'GetExpressCheckoutDetails': {'retries': 1, 'recovered': 1, 'failed': 0}},
+                         gateway.get_retry_stats())
+
+    def test_client_errors_are_not_retried(self):
+        func = mock.Mock(side_effect=exceptions.CommunicationError("Bad request", 400))
+        with self.assertRaises(exceptions.CommunicationError):
+            gateway.call_with_retries(func)
+        self.assertEqual(1, func.call_count)
+
+    @override_settings(PAYPAL_RETRY_ATTEMPTS=2)
+    def test_gives_up_after_last_attempt(self):
+        func = mock.Mock(side_effect=exceptions.CommunicationError("Unavailable", 503))
+        with self.assertRaises(exceptions.CommunicationError):
+            gateway.call_with_retries(func, 'Delayed capture')
+        self.assertEqual(2, func.call_count)
+        self.assertEqual(1, gateway.get_retry_stats()['Delayed capture']['failed'])
+
+    @override_settings(PAYPAL_RETRY_BACKOFF=10, PAYPAL_RETRY_MAX_BACKOFF=10)
+    def test_does_not_wait_past_deadline(self):
+        func = mock.Mock(side_effect=exceptions.CommunicationError("Down"))
+        with mock.patch('paypal.gateway.random.uniform', return_value=5):
+            with gateway.deadline(1):
+                with self.assertRaises(exceptions.CommunicationError):
+                    gateway.call_with_retries(func)
+        self.assertEqual(1, func.call_count)
+
+    def test_async_calls_are_retried(self):
+        responses = [httpx.Response(503), httpx.Response(200, text='ACK=Success')]
+        client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: responses.pop(0)))
+        with mock.patch('paypal.gateway.get_async_client', return_value=client):
+            pairs = async_to_sync(gateway.acall_with_retries)(lambda: gateway.apost('http://example.com', {}))
+        self.assertEqual('Success', pairs['ACK'])
+
+    def test_backoff_is_jittered_and_capped(self):
+        with override_settings(PAYPAL_RETRY_BACKOFF=1, PAYPAL_RETRY_MAX_BACKOFF=3):
+            with mock.patch('paypal.gateway.random.uniform', return_value=0) as uniform:
+                gateway._get_retry_delay(exceptions.CommunicationError("Down"), 1, None)
+                gateway._get_retry_delay(exceptions.CommunicationError("Down"), 2, None)
+                with override_settings(PAYPAL_RETRY_ATTEMPTS=5):
+                    gateway._get_retry_delay(exceptions.CommunicationError("Down"), 3, None)
+        self.assertEqual([mock.call(0, 1), mock.call(0, 2), mock.call(0, 3)], uniform.call_args_list)
@@ -0,0 +1,110 @@
+from decimal import Decimal as D
+from unittest import mock
+
+import requests
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+from paypalcheckoutsdk.orders import OrdersGetRequest
+from paypalhttp.http_error import HttpError
+
+from paypal import exceptions, instrumentation
+from paypal.express import gateway as express_gateway
+from paypal.express_checkout.gateway import PaymentProcessor
+from paypal.payflow import gateway as payflow_gateway
+
+calls = []
+
+
+class RecordingBackend(instrumentation.Backend):
+
+    def record(self, call):
+        calls.append(call)
+
+
+class BrokenBackend(instrumentation.Backend):
+
+    def record(self, call):
+        raise ValueError("Unable to record")
+
+
+GET_TXN_RESPONSE = ('ACK=Success&CORRELATIONID=bdd6641577803&PAYMENTREQUEST_0_AMT=10.00'
+                    '&PAYMENTREQUEST_0_CURRENCYCODE=GBP')
+
+
+def response(status_code=200, text=GET_TXN_RESPONSE):
+    return mock.Mock(status_code=status_code, text=text, headers={})
+
+
+@override_settings(PAYPAL_INSTRUMENTATION_BACKENDS=['tests.unit.instrumentation_tests.RecordingBackend'],
+                   PAYPAL_RETRY_BACKOFF=0)
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        calls.clear()
+
+    def test_records_nvp_calls(self):
+        with mock.patch('requests.Session.post', return_value=response()):
+            express_gateway.get_txn('EC-8P797793UC466090M')
+        call, = calls
+        self.assertEqual('GetExpressCheckoutDetails', call.operation)
+        self.assertEqual('https://api-3t.sandbox.paypal.com/nvp', call.endpoint)
+        self.assertEqual('Success', call.outcome)
+        self.assertGreater(call.payload_size, 0)
+        self.assertGreaterEqual(call.latency, 0)
+        self.assertEqual(0, call.retries)
+
+    def test_counts_retries(self):
+        with mock.patch('requests.Session.post', side_effect=[response(503), response()]):
+            express_gateway.get_txn('EC-8P797793UC466090M')
+        self.assertEqual(1, calls[0].retries)
+
+    def test_records_failed_calls(self):
+        with mock.patch('requests.Session.post', side_effect=requests.ConnectionError()):
+            with self.assertRaises(exceptions.CommunicationError):
+                express_gateway.do_void('4MW805572N795704B')
+        self.assertEqual('error', calls[0].outcome)
+
+    def test_records_payflow_result(self):
+        text = 'RESULT=0&PNREF=V19R3EF62FBE&RESPMSG=Approved'
+        with mock.patch('requests.Session.post', return_value=response(text=text)):
+            payflow_gateway.delayed_capture('1234', 'V19R3EF62FBE', D('10.00'))
+        self.assertEqual(('Delayed capture', '0'), (calls[0].operation, calls[0].outcome))
+
+    def test_records_rest_calls(self):
+        client = PaymentProcessor().client
+        request = OrdersGetRequest('4MW805572N795704B')
+        request.headers['Authorization'] = 'Bearer token'
+        with mock.patch('requests.Session.request', return_value=response(text='')):
+            client.execute(request, operation='get_order')
+        with mock.patch('requests.Session.request', return_value=response(422, text='')):
+            with self.assertRaises(HttpError):
+                client.execute(request, operation='get_order')
+        self.assertEqual([('get_order', '200'), ('get_order', '422')],
+                         [(call.operation, call.outcome) for call in calls])
+        self.assertEqual('https://api.sandbox.paypal.com', calls[0].endpoint)
+
+    @override_settings(PAYPAL_INSTRUMENTATION_BACKENDS=['tests.unit.instrumentation_tests.BrokenBackend'])
+    def test_backend_errors_are_logged(self):
+        with mock.patch('requests.Session.post', return_value=response()):
+            with self.assertLogs('paypal.instrumentation', 'ERROR'):
+                express_gateway.get_txn('EC-8P797793UC466090M')
+
+
+class TestBackends(TestCase):
+
+    @mock.patch('paypal.instrumentation.prometheus_client', None)
+    def test_prometheus_backend_requires_prometheus_client(self):
+        with self.assertRaises(ImproperlyConfigured):
+            instrumentation.PrometheusBackend()
+
+    def test_statsd_backend_sends_metrics(self):
+        with mock.patch('paypal.instrumentation.statsd') as statsd:
+            backend = instrumentation.StatsdBackend()
+        call = instrumentation.Call('Delayed capture', 'https://pilot-payflowpro.paypal.com')
+        call.outcome, call.latency, call.payload_size, call.retries = '0', 0.25, 100, 1
+        backend.record(call)
+        pipe = statsd.StatsClient.return_value.pipeline.return_value
+        pipe.timing.assert_any_call('delayed_capture.latency', 250)
+        pipe.incr.assert_any_call('delayed_capture.0')
+        pipe.incr.assert_any_call('delayed_capture.retries', 1)
+        pipe.send.assert_called_once_with()
@@ -1,8 +1,10 @@
 from decimal import Decimal as D
 from unittest import mock
 
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from django.test import TestCase, override_settings
 
+from paypal.exceptions import CommunicationError
 from paypal.payflow import gateway
 
 
@@ -84,3 +86,62 @@ class TestReferenceTransaction(TestCase):
             gateway.reference_transaction(order_number='12345',
                                           pnref='111222',
                                           amt=D('12.23'))
+
+
+@override_settings(PAYPAL_RETRY_BACKOFF=0)
+class TestRetries(TestCase):
+
+    def setUp(self):
+        self.response = {
+            'RESULT': '0',
+            'PNREF': 'V25A2BB645A7',
+            'RESPMSG': 'Approved',
+            '_raw_request': '',
+            '_raw_response': '',
+            '_response_time': 1000
+        }
+
+    def test_delayed_capture_is_retried(self):
+        with mock.patch('paypal.gateway.post') as mock_post:
+            mock_post.side_effect = [CommunicationError("Unable to communicate with PayPal"), self.response]
+            txn = gateway.delayed_capture('12345', 'V25A2BB645A6')
+        self.assertTrue(txn.is_approved)
+        self.assertEqual(2, mock_post.call_count)
+
+    def test_sale_is_not_retried(self):
+        with mock.patch('paypal.gateway.post') as mock_post:
+            mock_post.side_effect = CommunicationError("Unable to communicate with PayPal")
+            with self.assertRaises(CommunicationError):
+                gateway.sale(order_number='12345', card_number='4111111111111111', cvv='123',
+                             expiry_date='0113', amt=D('10.80'))
+        self.assertEqual(1, mock_post.call_count)
+
+
+class TestAsyncFunctions(TestCase):
+
+    def setUp(self):
+        self.response = {
+            'RESULT': '0',
+            'PNREF': 'V25A2BB645A7',
+            'RESPMSG': 'Approved',
+            '_raw_request': '',
+            '_raw_response': '',
+            '_response_time': 1000
+        }
+
+    def test_sale_returns_a_saved_txn_instance(self):
+        with mock.patch('paypal.gateway.apost', new=mock.AsyncMock(return_value=self.response)):
+            txn = async_to_sync(gateway.asale)(
+                order_number='1234',
+                card_number='4111111111111111',
+                cvv='123',
+                expiry_date='1214',
+                amt=D('10.00'))
+        self.assertTrue(txn.is_approved)
+        self.assertIsNotNone(txn.pk)
+
+    def test_delayed_capture_uses_operation_timeout(self):
+        with mock.patch('paypal.gateway.apost', new=mock.AsyncMock(return_value=self.response)) as mock_post, \
+                self.settings(PAYPAL_OPERATION_TIMEOUTS={'Delayed capture': (1, 2)}):
+            async_to_sync(gateway.adelayed_capture)('1234', 'V25A2BB645A7')
+        self.assertEqual((1, 2), mock_post.call_args[1]['timeout'])
@@ -0,0 +1,164 @@
+import threading
+from decimal import Decimal as D
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from oscar.apps.shipping.methods import Free
+from paypalhttp.http_error import HttpError
+
+from paypal import exceptions
+from paypal.express import facade as express_facade
+from paypal.express import gateway as express_gateway
+from paypal.express_checkout.gateway import PaymentProcessor, clear_access_tokens
+from paypal.payflow import gateway as payflow_gateway
+from paypal.simulator import Simulator, make_server
+
+
+class SimulatorTestCase(TestCase):
+    simulator_options = {}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.simulator = Simulator(seed=1, **cls.simulator_options)
+        cls.server = make_server('127.0.0.1', 0, cls.simulator)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        url = 'http://%s:%d' % cls.server.server_address[:2]
+        cls.settings_override = override_settings(
+            PAYPAL_NVP_URL=url + '/nvp', PAYPAL_PAYFLOW_URL=url + '/payflow', PAYPAL_REST_API_URL=url)
+        cls.settings_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+
+class ExpressTests(SimulatorTestCase):
+
+    def create_basket(self):
+        basket = mock.Mock()
+        basket.total_incl_tax = D('10.00')
+        basket.all_lines = mock.Mock(return_value=[])
+        basket.offer_discounts = []
+        basket.voucher_discounts = []
+        basket.shipping_discounts = []
+        return basket
+
+    def test_checkout_capture_and_refund(self):
+        url = express_gateway.set_txn(self.create_basket(), [Free()], 'GBP', 'http://localhost/success',
+                                      'http://localhost/cancel', action=express_gateway.AUTHORIZATION)
+        token = url.split('token=')[1]
+
+        txn = express_gateway.get_txn(token)
+        self.assertEqual(D('10.00'), txn.amount)
+        self.assertEqual('Sam Buyer', txn.value('PAYMENTREQUEST_0_SHIPTONAME'))
+
+        txn = express_gateway.do_txn(txn.value('PAYERID'), token, D('10.00'), 'GBP',
+                                     action=express_gateway.AUTHORIZATION)
+        authorization_id = txn.value('PAYMENTINFO_0_TRANSACTIONID')
+        txn = express_gateway.do_capture(authorization_id, D('10.00'), 'GBP')
+        txn = express_gateway.refund_txn(txn.value('TRANSACTIONID'))
+        self.assertEqual('10.00', txn.value('GROSSREFUNDAMT'))
+
+    def test_facade_refunds_the_capture_of_an_authorization(self):
+        url = express_gateway.set_txn(self.create_basket(), [Free()], 'GBP', 'http://localhost/success',
+                                      'http://localhost/cancel', action=express_gateway.AUTHORIZATION)
+        token = url.split('token=')[1]
+        txn = express_gateway.get_txn(token)
+        express_gateway.do_txn(txn.value('PAYERID'), token, D('10.00'), 'GBP', action=express_gateway.AUTHORIZATION)
+        with self.assertRaisesMessage(exceptions.PayPalError, "has not been captured"):
+            express_facade.refund_transaction(token, D('10.00'), 'GBP')
+
+        capture = express_facade.capture_authorization(token)
+        refund = express_facade.refund_transaction(token, D('10.00'), 'GBP')
+        self.assertIn('TRANSACTIONID=%s' % capture.value('TRANSACTIONID'), refund.raw_request)
+        self.assertEqual(token, refund.token)
+
+    def test_unknown_token_raises_error(self):
+        with self.assertRaises(exceptions.PayPalError):
+            express_gateway.get_txn('EC-UNKNOWN')
+
+
+class PayflowTests(SimulatorTestCase):
+
+    def test_authorize_capture_and_credit(self):
+        txn = payflow_gateway.authorize('1234', '4111111111111111', '123', '1230', D('10.00'))
+        self.assertTrue(txn.is_approved)
+        capture_txn = payflow_gateway.delayed_capture('1234', txn.pnref)
+        self.assertTrue(capture_txn.is_approved)
+        credit_txn = payflow_gateway.credit('1234', capture_txn.pnref, D('5.00'))
+        self.assertTrue(credit_txn.is_approved)
+
+    def test_unknown_original_transaction_is_rejected(self):
+        txn = payflow_gateway.void('1234', 'UNKNOWN')
+        self.assertFalse(txn.is_approved)
+        self.assertEqual('19', txn.result)
+
+
+class ExpressCheckoutTests(SimulatorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        clear_access_tokens()
+
+    def create_order(self, intent):
+        processor = PaymentProcessor()
+        request = processor._get_create_order_request({
+            'intent': intent,
+            'purchase_units': [{'amount': {'currency_code': 'GBP', 'value': '10.00'}}],
+        }, 'minimal')
+        return processor.client.execute(request).result
+
+    def test_authorize_capture_and_refund(self):
+        processor = PaymentProcessor()
+        order = self.create_order('AUTHORIZE')
+        self.assertEqual('CREATED', order.status)
+        self.assertEqual('approve', order.links[0].rel)
+
+        result = processor.get_order(order.id)
+        self.assertEqual('APPROVED', result.status)
+        self.assertEqual('buyer@example.com', result.payer.email_address)
+
+        result = processor.authorize_order(order.id)
+        authorization_id = result.purchase_units[0].payments.authorizations[0].id
+        result = processor.capture_order(authorization_id, 'AUTHORIZE')
+        result = processor.refund_order(result.id, D('10.00'), 'GBP')
+        self.assertEqual('COMPLETED', result.status)
+
+    def test_capture_and_void(self):
+        processor = PaymentProcessor()
+        order = self.create_order('CAPTURE')
+        result = processor.capture_order(order.id, 'CAPTURE')
+        self.assertEqual('COMPLETED', result.purchase_units[0].payments.captures[0].status)
+
+        order = self.create_order('AUTHORIZE')
+        result = processor.authorize_order(order.id)
+        processor.void_authorized_order(result.purchase_units[0].payments.authorizations[0].id)
+
+    def test_unknown_order_raises_error(self):
+        with self.assertRaises(HttpError) as cm:
+            PaymentProcessor().get_order('UNKNOWN')
+        self.assertEqual(404, cm.exception.status_code)
+
+
+class ErrorInjectionTests(SimulatorTestCase):
+    simulator_options = {'error_rate': 1}
+
+    def test_nvp_calls_fail(self):
+        with self.assertRaises(exceptions.PayPalError):
+            express_gateway.get_txn('EC-UNKNOWN')
+
+    def test_payflow_calls_are_declined(self):
+        txn = payflow_gateway.sale('1234', '4111111111111111', '123', '1230', D('10.00'))
+        self.assertEqual('12', txn.result)
+
+
+class HttpErrorInjectionTests(SimulatorTestCase):
+    simulator_options = {'http_error_rate': 1}
+
+    def test_calls_fail(self):
+        with self.assertRaises(exceptions.PayPalError):
+            payflow_gateway.sale('1234', '4111111111111111', '123', '1230', D('10.00'))